@@ -0,0 +1,262 @@
+"""Drive handler() against the stub WebUI and report throughput, latency percentiles and memory.
+
+    python bench/run_bench.py --jobs 200 --concurrency 4 --mix inference=6,img2img=2,face_swap=1,get_models=1
+
+The stub server runs as a separate process so the reported peak RSS is the worker's own.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import asyncio
+import resource
+import tempfile
+import subprocess
+import faulthandler
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+sys.path.insert(0, BENCH_DIR)
+
+from stub_server import png_b64
+
+def parse_mix(mix):
+    """Parse action=weight pairs."""
+    weights = {}
+    for part in mix.split(","):
+        action, _, weight = part.partition("=")
+        weights[action.strip()] = float(weight or 1)
+    return weights
+
+def make_event(action, args, rng, checkpoints):
+    """Build a realistic job payload for an action."""
+    if action in ("inference", "img2img"):
+        payload = {
+            "action": action,
+            "prompt": rng.choice(["a castle on a hill", "portrait of an astronaut", "a bowl of fruit, studio light"]),
+            "negative_prompt": "blurry, low quality",
+            "steps": args.steps,
+            "width": args.width,
+            "height": args.height,
+            "seed": rng.randint(0, 10) if rng.random() < args.repeat_ratio else -1,
+            "model_name": rng.choice(checkpoints),
+        }
+        if action == "img2img":
+            payload["init_images"] = [png_b64(args.width, args.height)]
+        if args.output_format:
+            payload["output"] = {"format": args.output_format, "quality": 85}
+        return {"input": payload}
+    if action == "face_swap":
+        return {"input": {"action": "face_swap", "source_image": png_b64(256, 256), "target_image": png_b64(args.width, args.height)}}
+    return {"input": {"action": action}}
+
+def percentile(values, fraction):
+    """Return a percentile of a list of numbers using nearest rank."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def start_stub(args, checkpoints, port):
+    """Start the stub server in a subprocess and return it with its base URL."""
+    command = [
+        sys.executable, os.path.join(BENCH_DIR, "stub_server.py"),
+        "--port", str(port),
+        "--base-latency-ms", str(args.base_latency_ms),
+        "--step-latency-ms", str(args.step_latency_ms),
+    ]
+    for checkpoint in checkpoints:
+        command += ["--checkpoint", checkpoint]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline().strip()
+    return process, line.rsplit(" ", 1)[-1]
+
+def configure_worker(workdir, checkpoints):
+    """Point the worker's state at a scratch directory before importing it."""
+    os.environ.setdefault("RESULT_CACHE_DIR", os.path.join(workdir, "result-cache"))
+    os.environ.setdefault("MODEL_STORE_DIR", os.path.join(workdir, "models", ".blobs"))
+    os.environ.setdefault("MODEL_INDEX_FILE", os.path.join(workdir, "models", ".model-index.json"))
+    os.environ.setdefault("OUTPUT_DIR", os.path.join(workdir, "outputs"))
+    os.environ.setdefault("WEBUI_CACHE_DIR", os.path.join(workdir, "webui-cache"))
+    os.environ.setdefault("WEBUI_CACHE_FILE", os.path.join(workdir, "cache.json"))
+    os.environ.setdefault("TRACE_FILE", os.path.join(workdir, "traces", "jobs.jsonl"))
+    sys.path.insert(0, SRC_DIR)
+    import handler
+
+    for model_type, (_, extensions) in list(handler.directories.items()):
+        dir_path = os.path.join(workdir, "models", model_type)
+        os.makedirs(dir_path, exist_ok=True)
+        handler.directories[model_type] = (dir_path, extensions)
+    for checkpoint in checkpoints:
+        with open(os.path.join(handler.directories["checkpoints"][0], checkpoint), "wb") as f:
+            # Smallest valid safetensors file: an empty header followed by filler
+            f.write(b"\x02\0\0\0\0\0\0\0{}" + b"\0" * 1024)
+    handler.EXTENSIONS_DIR = os.path.join(workdir, "extensions")
+    handler.INSIGHTFACE_DIR = os.path.join(workdir, "insightface")
+    handler.REACTOR_FACES_DIR = os.path.join(workdir, "reactor_faces")
+    return handler
+
+def run_sync(handler, events, concurrency, job_peaks=None):
+    """Run events through handler() on a thread pool, recording per-job allocation peaks when asked."""
+    def run(event):
+        if job_peaks is not None:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        error = None
+        try:
+            handler.handler(event)
+        except Exception as e:
+            error = str(e)
+        action = event["input"].get("action", "inference")
+        if job_peaks is not None:
+            job_peaks.setdefault(action, []).append(tracemalloc.get_traced_memory()[1] - baseline)
+        return action, time.perf_counter() - started, error
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(run, events))
+
+def run_async(handler, events, concurrency, executor_threads=None):
+    """Run events through async_handler() with bounded concurrency, on a fixed-size default executor when asked."""
+    async def main():
+        if executor_threads:
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=executor_threads))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(event):
+            async with semaphore:
+                started = time.perf_counter()
+                error = None
+                try:
+                    await handler.async_handler(event)
+                except Exception as e:
+                    error = str(e)
+                return event["input"].get("action", "inference"), time.perf_counter() - started, error
+
+        return await asyncio.gather(*(run(event) for event in events))
+
+    return asyncio.run(main())
+
+def counter_total(metrics, name, **labels):
+    """Sum a worker counter over the series matching the given labels."""
+    total = 0
+    for key, value in metrics.counters.get(name, {}).items():
+        if all(dict(key).get(label) == wanted for label, wanted in labels.items()):
+            total += value
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the worker against a stub WebUI")
+    parser.add_argument("--jobs", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--mix", default="inference=6,img2img=2,face_swap=1,get_models=1")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--checkpoints", type=int, default=2, help="Number of distinct checkpoints jobs pick from")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="Fraction of jobs with a small fixed seed range")
+    parser.add_argument("--output-format", default=None, help="Request output re-encoding (webp, jpeg)")
+    parser.add_argument("--base-latency-ms", type=float, default=20)
+    parser.add_argument("--step-latency-ms", type=float, default=2)
+    parser.add_argument("--stub-port", type=int, default=0)
+    parser.add_argument("--stub-url", action="append", default=None, help="Use an already running stub instead of starting one (repeatable)")
+    parser.add_argument("--backends", type=int, default=1, help="Number of stub servers to start as separate WebUI backends")
+    parser.add_argument("--trace-memory", action="store_true", help="Report Python allocation peaks, per job when --concurrency is 1 (slower)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the report to this file")
+    parser.add_argument("--executor-threads", type=int, default=None, help="Size of the event loop's default executor in async mode")
+    parser.add_argument("--timeout", type=float, default=0, help="Dump every thread's stack and exit non-zero if the run takes longer (0 disables)")
+    args = parser.parse_args()
+    if args.timeout > 0:
+        faulthandler.dump_traceback_later(args.timeout, exit=True)
+
+    checkpoints = [f"bench_{index}.safetensors" for index in range(max(1, args.checkpoints))]
+    stubs = []
+    if args.stub_url:
+        base_urls = [url.rstrip("/") for url in args.stub_url]
+    else:
+        base_urls = []
+        for index in range(max(1, args.backends)):
+            stub, base_url = start_stub(args, checkpoints, args.stub_port + index if args.stub_port else 0)
+            stubs.append(stub)
+            base_urls.append(base_url)
+
+    workdir = tempfile.mkdtemp(prefix="worker-bench-")
+    try:
+        handler = configure_worker(workdir, checkpoints)
+        handler.configure_backends(base_urls)
+        for backend in handler.backends:
+            with handler.use_backend(backend):
+                handler.sync_webui_state()
+
+        rng = random.Random(args.seed)
+        weights = parse_mix(args.mix)
+        actions = rng.choices(list(weights), weights=list(weights.values()), k=args.jobs)
+        events = [make_event(action, args, rng, checkpoints) for action in actions]
+
+        # Per-job peaks are only meaningful when jobs do not overlap
+        job_peaks = {} if args.trace_memory and args.mode == "sync" and args.concurrency == 1 else None
+        if args.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        if args.mode == "async":
+            results = run_async(handler, events, args.concurrency, args.executor_threads)
+        else:
+            results = run_sync(handler, events, args.concurrency, job_peaks)
+        elapsed = time.perf_counter() - started
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+
+        metrics = handler.metrics
+        report = {
+            "jobs": len(results),
+            "errors": sum(1 for _, _, error in results if error),
+            "seconds": round(elapsed, 3),
+            "throughput_jobs_per_s": round(len(results) / elapsed, 2),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "traced_peak_mb": round(traced_peak / (1024 * 1024), 1) if traced_peak is not None else None,
+            "bytes": {
+                "webui_in": counter_total(metrics, "worker_webui_bytes_total", direction="in"),
+                "webui_out": counter_total(metrics, "worker_webui_bytes_total", direction="out"),
+                "payload_in": counter_total(metrics, "worker_payload_bytes_total", direction="in"),
+                "payload_out": counter_total(metrics, "worker_payload_bytes_total", direction="out"),
+            },
+            "actions": {},
+            "config": vars(args),
+        }
+        for action in sorted(set(action for action, _, _ in results)):
+            latencies = [latency for name, latency, error in results if name == action and not error]
+            report["actions"][action] = {
+                "count": sum(1 for name, _, _ in results if name == action),
+                "errors": sum(1 for name, _, error in results if name == action and error),
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            }
+            if job_peaks and job_peaks.get(action):
+                report["actions"][action]["job_peak_mb"] = round(max(job_peaks[action]) / (1024 * 1024), 2)
+        first_error = next((error for _, _, error in results if error), None)
+        if first_error:
+            report["first_error"] = first_error
+    finally:
+        for stub in stubs:
+            stub.terminate()
+
+    print(f"{report['jobs']} jobs in {report['seconds']}s: {report['throughput_jobs_per_s']} jobs/s, "
+          f"{report['errors']} errors, peak RSS {report['peak_rss_mb']} MB")
+    print(f"{'action':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for action, stats in report["actions"].items():
+        print(f"{action:<16}{stats['count']:>7}{str(stats['p50_ms']):>10}{str(stats['p95_ms']):>10}{str(stats['p99_ms']):>10}")
+    print(json.dumps(report["bytes"]))
+    if job_peaks:
+        print(json.dumps({action: stats.get("job_peak_mb") for action, stats in report["actions"].items()}))
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
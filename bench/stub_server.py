@@ -0,0 +1,201 @@
+"""Stub A1111 WebUI + ReActor API for benchmarking the worker without a GPU.
+
+Implements the /sdapi/v1/* and /reactor/* endpoints the handler calls, with
+configurable latency and image sizes, so the worker's own overhead can be
+measured on a CPU-only machine.
+"""
+import os
+import json
+import time
+import zlib
+import struct
+import base64
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Pre-encoded noise PNGs keyed by (width, height)
+png_cache = {}
+png_lock = threading.Lock()
+
+def make_png(width, height):
+    """Encode an RGB noise image as PNG; noise keeps the size close to a worst-case SD output."""
+    raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+def png_b64(width, height):
+    """Return a cached base64 noise PNG of the given size."""
+    key = (int(width), int(height))
+    with png_lock:
+        if key not in png_cache:
+            png_cache[key] = base64.b64encode(make_png(*key)).decode()
+        return png_cache[key]
+
+class StubState:
+    """Mutable state shared by all requests to one stub server."""
+
+    def __init__(self, base_latency, step_latency, image_scale, checkpoints):
+        self.base_latency = base_latency
+        self.step_latency = step_latency
+        self.image_scale = image_scale
+        self.checkpoints = checkpoints
+        self.options = {"sd_model_checkpoint": checkpoints[0] if checkpoints else None, "sd_vae": "Automatic"}
+        self.progress = {"progress": 0.0, "eta_relative": 0.0, "state": {"sampling_step": 0, "sampling_steps": 0, "job_no": 0, "job_count": 0}}
+        self.interrupted = threading.Event()
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    def count(self, path):
+        """Count a request per path."""
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def generate(self, payload):
+        """Simulate sampling with progress updates, then return noise images."""
+        steps = int(payload.get("steps", 20))
+        batch_size = int(payload.get("batch_size", 1))
+        width = max(8, int(int(payload.get("width", 512)) * self.image_scale))
+        height = max(8, int(int(payload.get("height", 512)) * self.image_scale))
+        if payload.get("enable_hr"):
+            steps += int(payload.get("hr_second_pass_steps", steps))
+
+        self.interrupted.clear()
+        time.sleep(self.base_latency)
+        for step in range(steps):
+            if self.interrupted.is_set():
+                break
+            self.progress = {
+                "progress": step / steps,
+                "eta_relative": (steps - step) * self.step_latency * batch_size,
+                "state": {"sampling_step": step, "sampling_steps": steps, "job_no": 0, "job_count": 1},
+                "current_image": None
+            }
+            time.sleep(self.step_latency * batch_size)
+        self.progress = {"progress": 0.0, "eta_relative": 0.0, "state": {"sampling_step": 0, "sampling_steps": 0, "job_no": 0, "job_count": 0}}
+
+        seed = int(payload.get("seed", -1))
+        if seed == -1:
+            seed = random.randint(0, 2 ** 32 - 1)
+        seeds = [seed + index for index in range(batch_size)]
+        images = [png_b64(width, height) for _ in range(batch_size)]
+        if batch_size > 1 and not payload.get("do_not_save_grid"):
+            images.insert(0, png_b64(width, height))
+        info = {
+            "prompt": payload.get("prompt", ""),
+            "all_prompts": [payload.get("prompt", "")] * batch_size,
+            "seed": seed,
+            "all_seeds": seeds,
+            "subseed": -1,
+            "all_subseeds": [-1] * batch_size,
+            "infotexts": [f"{payload.get('prompt', '')}\nSteps: {steps}, Seed: {s}" for s in seeds],
+            "sd_model_name": self.options.get("sd_model_checkpoint"),
+        }
+        parameters = {key: value for key, value in payload.items() if key not in ("init_images", "mask")}
+        return {"images": images, "parameters": parameters, "info": json.dumps(info)}
+
+def make_handler(state):
+    """Build a request handler class bound to a stub state."""
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            state.count(path)
+            if path == "/sdapi/v1/sd-models":
+                self.send_json([{"title": name, "model_name": os.path.splitext(name)[0], "filename": name} for name in state.checkpoints])
+            elif path == "/sdapi/v1/options":
+                self.send_json(state.options)
+            elif path == "/sdapi/v1/samplers":
+                self.send_json([{"name": "DPM++ 2M", "aliases": [], "options": {}}, {"name": "Euler a", "aliases": [], "options": {}}])
+            elif path == "/sdapi/v1/schedulers":
+                self.send_json([{"name": "automatic", "label": "Automatic"}, {"name": "karras", "label": "Karras"}])
+            elif path == "/sdapi/v1/progress":
+                self.send_json(state.progress)
+            elif path == "/reactor/models":
+                self.send_json({"models": ["inswapper_128.onnx"]})
+            elif path == "/reactor/upscalers":
+                self.send_json({"upscalers": ["None"]})
+            elif path == "/reactor/facemodels":
+                self.send_json({"facemodels": []})
+            elif path == "/stub/stats":
+                self.send_json(state.requests)
+            else:
+                self.send_json({"detail": "Not Found"}, 404)
+
+        def do_POST(self):
+            path = self.path.split("?", 1)[0]
+            state.count(path)
+            payload = self.read_json()
+            if path in ("/sdapi/v1/txt2img", "/sdapi/v1/img2img"):
+                self.send_json(state.generate(payload))
+            elif path == "/sdapi/v1/options":
+                time.sleep(state.base_latency)
+                state.options.update(payload)
+                self.send_json(None)
+            elif path.startswith("/sdapi/v1/refresh-"):
+                self.send_json(None)
+            elif path in ("/sdapi/v1/interrupt", "/sdapi/v1/skip"):
+                state.interrupted.set()
+                self.send_json(None)
+            elif path == "/sdapi/v1/server-restart":
+                self.send_json(None)
+            elif path == "/reactor/image":
+                time.sleep(state.base_latency + state.step_latency * 4)
+                self.send_json({"image": payload.get("target_image", png_b64(512, 512))})
+            elif path == "/reactor/facemodels":
+                time.sleep(state.base_latency)
+                self.send_json({"facemodel": payload.get("name") or "facemodel"})
+            else:
+                self.send_json({"detail": "Not Found"}, 404)
+
+    return StubHandler
+
+def serve(port=0, base_latency=0.05, step_latency=0.01, image_scale=1.0, checkpoints=None):
+    """Start a stub server on a background thread and return it."""
+    state = StubState(base_latency, step_latency, image_scale, checkpoints or ["stub.safetensors"])
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub A1111 WebUI + ReActor API")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--base-latency-ms", type=float, default=50)
+    parser.add_argument("--step-latency-ms", type=float, default=10)
+    parser.add_argument("--image-scale", type=float, default=1.0, help="Scale returned images relative to the requested size")
+    parser.add_argument("--checkpoint", action="append", dest="checkpoints", help="Checkpoint filename to advertise (repeatable)")
+    args = parser.parse_args()
+
+    server = serve(args.port, args.base_latency_ms / 1000, args.step_latency_ms / 1000, args.image_scale, args.checkpoints)
+    print(f"Stub WebUI listening on http://127.0.0.1:{server.server_port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
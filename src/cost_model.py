@@ -0,0 +1,98 @@
+import os
+import threading
+
+# Prior cost until enough jobs have been observed: seconds per sampling step at 512x512 and per checkpoint switch
+STEP_SECONDS = float(os.environ.get("STEP_SECONDS", "0.1"))
+SWITCH_SECONDS = float(os.environ.get("MODEL_SWITCH_SECONDS", "10"))
+# Weight older observations keep each time a new one arrives, so the fit follows drift
+COST_DECAY = float(os.environ.get("COST_DECAY", "0.98"))
+MIN_SAMPLES = 3
+
+# (checkpoint, sampler) -> decayed sums for a least-squares line seconds = overhead + rate * work.
+# None in a key position pools observations across that dimension.
+fits = {}
+# checkpoint -> decayed average checkpoint switch seconds
+switch_times = {}
+cost_lock = threading.Lock()
+
+def work_units(request):
+    """Return the sampling work of a WebUI request in 512x512 step units: steps x pixels x hires pass x batch size."""
+    pixels = int(request.get("width", 512)) * int(request.get("height", 512)) / (512 * 512)
+    steps = int(request.get("steps", 20))
+    if request.get("init_images"):
+        # img2img only runs the denoised fraction of its steps
+        steps = max(1, int(steps * float(request.get("denoising_strength", 0.75))))
+    work = steps * pixels
+    if request.get("enable_hr"):
+        hr_steps = int(request.get("hr_second_pass_steps") or steps)
+        work += hr_steps * pixels * float(request.get("hr_scale", 2.0)) ** 2
+    return work * int(request.get("batch_size", 1)) * int(request.get("n_iter", 1))
+
+def fit_keys(model, sampler):
+    """Return the fits an observation updates, most specific first."""
+    return [(model, sampler), (model, None), (None, sampler), (None, None)]
+
+def observe(model, sampler, work, seconds):
+    """Add a measured generation to every fit it belongs to."""
+    with cost_lock:
+        for key in fit_keys(model, sampler):
+            stats = fits.setdefault(key, {"n": 0.0, "x": 0.0, "y": 0.0, "xx": 0.0, "xy": 0.0, "count": 0})
+            for name in ("n", "x", "y", "xx", "xy"):
+                stats[name] *= COST_DECAY
+            stats["n"] += 1
+            stats["x"] += work
+            stats["y"] += seconds
+            stats["xx"] += work * work
+            stats["xy"] += work * seconds
+            stats["count"] += 1
+
+def fit_line(stats):
+    """Solve overhead and rate from decayed sums, falling back to a line through the origin."""
+    n, x, y, xx, xy = stats["n"], stats["x"], stats["y"], stats["xx"], stats["xy"]
+    denominator = n * xx - x * x
+    if denominator > 1e-9 * max(1.0, n * xx):
+        rate = (n * xy - x * y) / denominator
+        overhead = (y - rate * x) / n
+        if rate > 0 and overhead >= 0:
+            return overhead, rate
+    return 0.0, (y / x if x > 0 else STEP_SECONDS)
+
+def predict(model, sampler, work):
+    """Predict generation seconds from the most specific fit with enough observations."""
+    with cost_lock:
+        for key in fit_keys(model, sampler):
+            stats = fits.get(key)
+            if stats and stats["count"] >= MIN_SAMPLES:
+                overhead, rate = fit_line(stats)
+                return overhead + rate * work, {"model": key[0], "sampler": key[1], "samples": stats["count"]}
+    return STEP_SECONDS * work, None
+
+def observe_switch(model, seconds):
+    """Record how long loading a checkpoint took."""
+    with cost_lock:
+        previous = switch_times.get(model)
+        switch_times[model] = seconds if previous is None else previous * 0.7 + seconds * 0.3
+
+def predict_switch(model):
+    """Predict checkpoint load seconds from this checkpoint's history, then any checkpoint's, then the prior."""
+    with cost_lock:
+        if model in switch_times:
+            return switch_times[model]
+        if switch_times:
+            return sum(switch_times.values()) / len(switch_times)
+    return SWITCH_SECONDS
+
+def snapshot():
+    """Return the fitted lines and switch times."""
+    with cost_lock:
+        lines = []
+        for (model, sampler), stats in sorted(fits.items(), key=lambda item: str(item[0])):
+            overhead, rate = fit_line(stats)
+            lines.append({
+                "model": model,
+                "sampler": sampler,
+                "samples": stats["count"],
+                "overhead_seconds": round(overhead, 4),
+                "seconds_per_unit": round(rate, 5)
+            })
+        return {"fits": lines, "switch_seconds": {model: round(seconds, 3) for model, seconds in switch_times.items()}}
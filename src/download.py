@@ -1,45 +1,232 @@
 import os
+import re
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
-def download_file(url, target_path):
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(target_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+# Parallel ranged download settings
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "8"))
+CHUNK_SIZE = 1024 * 1024
+MIN_SEGMENT_SIZE = 32 * 1024 * 1024
+STATE_SAVE_INTERVAL = 64 * 1024 * 1024
+SEGMENT_RETRIES = 5
+TIMEOUT = (10, 60)
+
+def extract_filename(response):
+    """Extract the filename from the response headers or URL."""
+    content_disposition = response.headers.get('Content-Disposition')
+    if content_disposition:
+        filename_match = re.search(r'filename="?(.+?)"?(;|$)', content_disposition)
+        if filename_match:
+            return filename_match.group(1)
+    url_filename = os.path.basename(response.url.split('?')[0])
+    return url_filename if url_filename else "downloaded_model.safetensors"
+
+def probe_url(url, headers=None):
+    """Resolve redirects and find the size, filename and Range support of a download."""
+    probe_headers = dict(headers or {})
+    probe_headers["Range"] = "bytes=0-0"
+    with requests.get(url, headers=probe_headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code not in (200, 206):
+            raise Exception(f"Failed to download file: {r.status_code} {r.reason}")
+        size = None
+        content_range = r.headers.get("Content-Range", "")
+        if r.status_code == 206 and "/" in content_range and not content_range.endswith("/*"):
+            size = int(content_range.rsplit("/", 1)[1])
+        elif r.status_code == 200 and r.headers.get("Content-Length"):
+            size = int(r.headers["Content-Length"])
+        return {
+            "url": r.url,
+            "size": size,
+            "ranges": r.status_code == 206 and size is not None,
+            "filename": extract_filename(r),
+            "etag": r.headers.get("ETag"),
+        }
+
+def sha256_file(path):
+    """Compute the sha256 of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(8 * CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_state(state_path, url, size, etag):
+    """Load the progress of a partial download, or None if it is for another URL, size or ETag."""
+    try:
+        with open(state_path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("size") != size or state.get("url") != url or state.get("etag") != etag:
+        return None
+    return state
 
-def process_filelist(filelist_path, base_dir):
-    if not os.path.exists(filelist_path):
-        print(f"Warning: {filelist_path} does not exist. Skipping...")
-        return
+def resume_headers(headers, start, end, etag):
+    """Build the headers of a ranged resume, asking for the whole file instead if it changed since etag."""
+    range_headers = dict(headers or {})
+    range_headers["Range"] = f"bytes={start}-{end}"
+    # If-Range only works with strong validators
+    if etag and not etag.startswith("W/"):
+        range_headers["If-Range"] = etag
+    return range_headers
 
-    with open(filelist_path, "r") as f:
-        lines = [line.strip() for line in f if line.strip()]
+def save_state(state_path, state):
+    """Persist segment progress so an interrupted download can resume."""
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+def plan_segments(size, connections):
+    """Split a file of the given size into [start, end, done] byte ranges."""
+    count = max(1, min(connections, size // MIN_SEGMENT_SIZE))
+    step = -(-size // count)
+    return [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+
+def fetch_segment(url, headers, part_path, segment, lock, state, state_path):
+    """Download one byte range into its offset of the .part file, resuming on errors."""
+    start, end, _ = segment
+    unsaved = 0
+    for attempt in range(SEGMENT_RETRIES):
+        offset = start + segment[2]
+        if offset > end:
+            return
+        range_headers = resume_headers(headers, offset, end, state.get("etag"))
+        try:
+            with requests.get(url, headers=range_headers, stream=True, timeout=TIMEOUT) as r:
+                if r.status_code == 200 and "If-Range" in range_headers:
+                    # The file changed on the server, so the bytes already on disk are useless
+                    with lock:
+                        state["changed"] = True
+                    return
+                if r.status_code != 206:
+                    raise Exception(f"Range request failed: {r.status_code} {r.reason}")
+                with open(part_path, "r+b") as f:
+                    f.seek(offset)
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        with lock:
+                            segment[2] += len(chunk)
+                            unsaved += len(chunk)
+                            if unsaved >= STATE_SAVE_INTERVAL:
+                                save_state(state_path, state)
+                                unsaved = 0
+            if start + segment[2] > end:
+                return
+        except Exception as e:
+            if attempt == SEGMENT_RETRIES - 1:
+                raise
+            print(f"Segment {start}-{end} interrupted ({e}), retrying...")
+            time.sleep(2 ** attempt)
+    raise Exception(f"Segment {start}-{end} did not complete")
+
+def fetch_stream(url, headers, part_path, state_path, state, ranges):
+    """Download with a single connection, appending to a .part file only this path wrote for the same ETag."""
+    previous = load_state(state_path, state["url"], state["size"], state["etag"])
+    if os.path.exists(part_path) and not (ranges and previous and previous.get("stream")):
+        # A segmented download preallocates the whole file, so its size says nothing about what arrived
+        os.remove(part_path)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if state["size"] is not None and offset >= state["size"]:
+        return offset
+    save_state(state_path, state)
+    stream_headers = resume_headers(headers, offset, "", state["etag"]) if offset else dict(headers or {})
+    with requests.get(url, headers=stream_headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code not in (200, 206):
+            raise Exception(f"Failed to download file: {r.status_code} {r.reason}")
+        if r.status_code == 200:
+            offset = 0
+        with open(part_path, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+    return offset
 
-    if not lines:
-        print(f"No entries in {filelist_path}. Skipping...")
-        return
+def download_file(url, target_path, headers=None, sha256=None, size=None, connections=None, probe=None):
+    """Download a file with parallel ranged requests, resume and verification, then rename it into place."""
+    probe = probe or probe_url(url, headers)
+    connections = connections or DOWNLOAD_CONNECTIONS
+    expected_size = size if size is not None else probe["size"]
+    part_path = target_path + ".part"
+    state_path = part_path + ".json"
+    started = time.time()
+    resumed = 0
+    request_headers = headers
+    if urlparse(probe["url"]).netloc != urlparse(url).netloc:
+        headers = None  # Credentials are not forwarded to the redirect target
 
-    os.makedirs(base_dir, exist_ok=True)
+    if probe["ranges"] and probe["size"] >= MIN_SEGMENT_SIZE and connections > 1:
+        state = load_state(state_path, url, probe["size"], probe["etag"])
+        if state is None or state.get("stream") or not os.path.exists(part_path):
+            state = {"url": url, "size": probe["size"], "etag": probe["etag"], "segments": plan_segments(probe["size"], connections)}
+            with open(part_path, "wb") as f:
+                f.truncate(probe["size"])
+        else:
+            resumed = sum(segment[2] for segment in state["segments"])
+        save_state(state_path, state)
 
-    for line in lines:
-        if "|" not in line:
-            print(f"Invalid line in {filelist_path}: {line}")
-            continue
+        lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=len(state["segments"])) as pool:
+            futures = [
+                pool.submit(fetch_segment, probe["url"], headers, part_path, segment, lock, state, state_path)
+                for segment in state["segments"]
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            finally:
+                with lock:
+                    save_state(state_path, state)
+        if state.get("changed"):
+            print(f"{url} changed on the server during the download, starting over")
+            os.remove(part_path)
+            os.remove(state_path)
+            return download_file(url, target_path, headers=request_headers, sha256=sha256, size=size, connections=connections)
+    else:
+        state = {"url": url, "size": probe["size"], "etag": probe["etag"], "stream": True}
+        resumed = fetch_stream(probe["url"], headers, part_path, state_path, state, probe["ranges"])
 
-        type_part, url_part = line.split("|", 1)
-        filename = os.path.basename(url_part.split("?")[0])
-        save_path = os.path.join(base_dir, filename)
+    actual_size = os.path.getsize(part_path)
+    if expected_size is not None and actual_size != expected_size:
+        raise Exception(f"Downloaded size {actual_size} does not match expected size {expected_size}")
+    digest = None
+    if sha256:
+        digest = sha256_file(part_path)
+        if digest.lower() != sha256.lower():
+            os.remove(part_path)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            raise ValueError(f"Checksum mismatch for {os.path.basename(target_path)}: expected {sha256}, got {digest}")
 
-        if os.path.exists(save_path):
-            print(f"Already exists: {save_path}")
-            continue
+    os.replace(part_path, target_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
 
-        print(f"Downloading {filename} to {save_path}")
-        download_file(url_part, save_path)
+    seconds = time.time() - started
+    transferred = actual_size - resumed
+    return {
+        "path": target_path,
+        "bytes": actual_size,
+        "resumed_bytes": resumed,
+        "seconds": round(seconds, 3),
+        "throughput": transferred / seconds if seconds > 0 else 0,
+        "etag": probe["etag"],
+        "sha256": digest,
+    }
 
-# Models download
-process_filelist("/models.txt", "/stable-diffusion-webui/models/Stable-diffusion")
+if __name__ == "__main__":
+    # Build-time model install shares the handler's manifest pipeline
+    from model_install import install_manifest, parse_manifest
 
-# Extensions install
-process_filelist("/extensions.txt", "/stable-diffusion-webui/extensions")
+    for result in install_manifest(parse_manifest("/models.txt")):
+        if "error" in result:
+            print(f"Failed: {result['line']}: {result['error']}")
+        elif result["status"] == "superseded":
+            print(f"Superseded: {result['line']}")
+        else:
+            print(f"{result['status'].capitalize()}: {result['path']} ({result['bytes']} bytes in {result['seconds']}s)")
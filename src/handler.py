@@ -4,41 +4,129 @@ import requests
 from requests.adapters import HTTPAdapter, Retry
 import os
 import json
+import copy
 import subprocess
 import shutil
 import time as time_module
 import re
 import base64
-
-LOCAL_URL = "http://127.0.0.1:3000/sdapi/v1"
-REACTOR_URL = "http://127.0.0.1:3000/reactor"
+import asyncio
+import threading
+import hashlib
+import contextvars
+import heapq
+import math
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import model_store
+from model_install import directories, model_type_mapping, prepare_model, fetch_model, parse_manifest, install_manifest, pending_bytes
+from outputs import process_outputs
+import inputs
+import metrics
+import tracing
+import cost_model
+import safetensors_index
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# WebUI instances this worker dispatches to, as comma separated base URLs (one per GPU or process)
+WEBUI_URLS = [url.strip().rstrip("/") for url in os.environ.get("WEBUI_URLS", "http://127.0.0.1:3000").split(",") if url.strip()]
 EXTENSIONS_DIR = "/stable-diffusion-webui/extensions"
 INSIGHTFACE_DIR = "/stable-diffusion-webui/models/insightface"
+REACTOR_FACES_DIR = "/stable-diffusion-webui/models/reactor/faces"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 MODELS_FILE = os.path.join(SCRIPT_DIR, "models.txt")
 EXTENSIONS_FILE = os.path.join(SCRIPT_DIR, "extensions.txt")
 
-# Configure session with retries
-automatic_session = requests.Session()
-retries = Retry(total=10, backoff_factor=0.1, status_forcelist=[502, 503, 504])
+# Cold-start sequence: overall readiness deadline, optional checkpoint preload and warmup generation
+STARTUP_TIMEOUT = float(os.environ.get("STARTUP_TIMEOUT", "600"))
+DEFAULT_MODEL = os.environ.get("DEFAULT_MODEL")
+WARMUP_STEPS = int(os.environ.get("WARMUP_STEPS", "0"))
+WARMUP_SIZE = int(os.environ.get("WARMUP_SIZE", "256"))
+PROCESS_START = float(os.environ.get("WORKER_START_TIME") or time.time())
+
+# Persistent model inventory, invalidated per directory by mtime
+MODEL_INDEX_FILE = os.environ.get("MODEL_INDEX_FILE", "/stable-diffusion-webui/models/.model-index.json")
+# Bumped when index entries gain fields, so older index files are rebuilt once
+MODEL_INDEX_VERSION = 2
+
+# WebUI's hash cache: a diskcache directory in current releases, a single JSON file in older ones
+WEBUI_CACHE_DIR = os.environ.get("WEBUI_CACHE_DIR", "/stable-diffusion-webui/cache")
+WEBUI_CACHE_FILE = os.environ.get("WEBUI_CACHE_FILE", "/stable-diffusion-webui/cache.json")
+
+# Parallel extension clones and how long to wait for WebUI to come back after a restart
+EXTENSION_WORKERS = int(os.environ.get("EXTENSION_WORKERS", "4"))
+RESTART_TIMEOUT = float(os.environ.get("RESTART_TIMEOUT", "300"))
+
+# How long a ReActor API availability probe result is trusted
+REACTOR_PROBE_TTL = float(os.environ.get("REACTOR_PROBE_TTL", "300"))
+# Face models built from repeated source images that are kept before the least recently used is deleted
+FACE_MODEL_CACHE_MAX = int(os.environ.get("FACE_MODEL_CACHE_MAX", "50"))
+
+# Concurrency and micro-batching of compatible txt2img jobs
+CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "1"))
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW_MS", "50")) / 1000
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+
+# Streaming mode yields progress events and per-image chunks through a generator handler
+STREAM_MODE = os.environ.get("STREAM_MODE", "false").lower() in ("1", "true", "yes")
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "0.5"))
+
+# On-disk cache of fixed-seed generation results
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/tmp/result-cache")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Lazy model hydration: registry of fetchable models and idle-time prefetch of popular ones
+MODEL_REGISTRY_FILE = os.environ.get("MODEL_REGISTRY_FILE", os.path.join(SCRIPT_DIR, "registry.txt"))
+MODEL_DEMAND_FILE = os.environ.get("MODEL_DEMAND_FILE", "/stable-diffusion-webui/models/.model-demand.json")
+PREFETCH_TOP = int(os.environ.get("PREFETCH_TOP", "0"))
+PREFETCH_IDLE = float(os.environ.get("PREFETCH_IDLE", "30"))
+# How often changed request counts are written to MODEL_DEMAND_FILE
+MODEL_DEMAND_SAVE_INTERVAL = float(os.environ.get("MODEL_DEMAND_SAVE_INTERVAL", "60"))
+
+# Disk budget for model directories: eviction is opt-in with MODEL_EVICTION=1 or a DISK_BUDGET_BYTES total
+# (0 = no limit beyond free space), DISK_RESERVE_BYTES of free space is kept, and PINNED_MODELS are never
+# evicted (type/filename or filename, comma separated)
+MODEL_EVICTION = os.environ.get("MODEL_EVICTION", "0") == "1"
+DISK_BUDGET_BYTES = int(os.environ.get("DISK_BUDGET_BYTES", "0"))
+DISK_RESERVE_BYTES = int(os.environ.get("DISK_RESERVE_BYTES", str(2 * 1024 * 1024 * 1024)))
+PINNED_MODELS = [name.strip() for name in os.environ.get("PINNED_MODELS", "").split(",") if name.strip()]
+
+# Checkpoint residency: RAM WebUI may use to keep checkpoints loaded (0 disables the manager), the most it may keep,
+# how many further likely checkpoints to pull into the page cache, how often to re-plan, and the popularity half-life
+RESIDENCY_RAM_BYTES = int(os.environ.get("RESIDENCY_RAM_BYTES", "0"))
+RESIDENCY_MAX_CHECKPOINTS = int(os.environ.get("RESIDENCY_MAX_CHECKPOINTS", "4"))
+READAHEAD_CHECKPOINTS = int(os.environ.get("READAHEAD_CHECKPOINTS", "2"))
+RESIDENCY_INTERVAL = float(os.environ.get("RESIDENCY_INTERVAL", "60"))
+POPULARITY_HALF_LIFE = float(os.environ.get("POPULARITY_HALF_LIFE", "3600"))
+
+# Deadlines: an explicit "deadline" in the input covers the whole job from dispatch. Without one, each generation
+# call gets DEADLINE_FACTOR times its estimated runtime plus DEADLINE_BASE seconds, capped at DEADLINE_MAX, counted
+# from when it holds the GPU with its checkpoint loaded, so downloads, queueing and model loads never count against it.
+DEADLINE_BASE = float(os.environ.get("DEADLINE_BASE", "30"))
+DEADLINE_FACTOR = float(os.environ.get("DEADLINE_FACTOR", "3"))
+DEADLINE_MAX = float(os.environ.get("DEADLINE_MAX", "600"))
+# How long WebUI gets to return partial results after an interrupt
+INTERRUPT_GRACE = float(os.environ.get("INTERRUPT_GRACE", "30"))
+
+# What to do with a job whose predicted completion misses its explicit deadline: "reject" or "downgrade"
+OVERLOAD_POLICY = os.environ.get("OVERLOAD_POLICY", "reject")
+MIN_DOWNGRADE_STEPS = int(os.environ.get("MIN_DOWNGRADE_STEPS", "10"))
+
+# Backend health checks: seconds between probes and consecutive failures before a backend is ejected
+HEALTH_INTERVAL = float(os.environ.get("HEALTH_INTERVAL", "10"))
+BACKEND_MAX_FAILURES = int(os.environ.get("BACKEND_MAX_FAILURES", "3"))
+
+# Configure session with retries. Only idempotent reads are retried on errors or 5xx;
+# a POST is only retried when the connection failed before it was sent, never after a generation started.
+automatic_session = metrics.TimedSession()
+retries = Retry(total=10, backoff_factor=0.1, status_forcelist=[502, 503, 504], allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]))
 automatic_session.mount('http://', HTTPAdapter(max_retries=retries))
 
-# Directory mappings for model types
-directories = {
-    "checkpoints": ("/stable-diffusion-webui/models/Stable-diffusion", [".safetensors", ".ckpt"]),
-    "loras": ("/stable-diffusion-webui/models/Lora", [".safetensors", ".pt"]),
-    "vaes": ("/stable-diffusion-webui/models/VAE", [".safetensors", ".pt"]),
-    "embeddings": ("/stable-diffusion-webui/embeddings", [".pt", ".bin", ".safetensors"]),
-}
-
-# Map singular to plural model types
-model_type_mapping = {
-    "checkpoint": "checkpoints",
-    "lora": "loras",
-    "vae": "vaes",
-    "embedding": "embeddings"
-}
-
 # Refresh endpoints for each model type
 refresh_endpoints = {
     "checkpoints": "refresh-checkpoints",
@@ -47,6 +135,72 @@ refresh_endpoints = {
     "embeddings": "refresh-embeddings"
 }
 
+# WebUI backends. Each keeps its own health, in-flight job count, mirror of WebUI options (seeded from
+# GET /options and updated after every write; None means stale), ReActor probe, generation slot and running generation.
+backends = []
+backends_lock = threading.Lock()
+current_backend = contextvars.ContextVar("current_backend", default=None)
+
+# Readiness state machine: starting -> api_up -> model_loaded -> warm (or failed)
+startup_state = {"state": "starting", "timeline": [{"phase": "process_start", "at": 0.0}]}
+
+# Model inventory: model_type -> {"mtime": directory mtime, "files": {name: {"size", "mtime", "inode", "header", "sha256"}}}
+# where "header" is the safetensors header summary and "sha256" is known when the worker downloaded the file
+model_index = None
+model_index_lock = threading.RLock()
+webui_cache_lock = threading.Lock()
+
+# Source image hash -> ReActor face model built from it, least recently used first, and hashes of
+# source images seen once and those being built; a face model is only built the second time a source image shows up
+source_face_models = None
+source_face_sightings = OrderedDict()
+source_face_builds = set()
+source_face_lock = threading.Lock()
+source_face_load_lock = threading.Lock()
+
+
+# The job running in the current context ({"deadline": monotonic time or None, ...})
+current_job = contextvars.ContextVar("current_job", default=None)
+
+# Pending txt2img batches keyed by their shared request parameters
+pending_batches = {}
+
+# WebUI options that change generation output without appearing in the request
+RESULT_CACHE_OPTIONS = ["sd_model_checkpoint", "sd_vae", "CLIP_stop_at_last_layers", "eta_noise_seed_delta", "randn_source"]
+
+# Result cache entries in LRU order (key -> size), in-flight generations and counters
+result_cache_entries = None
+result_cache_lock = threading.Lock()
+inflight_generations = {}
+result_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+# Registry (model_type, filename) -> manifest entry, per-model usage and in-progress hydrations
+model_registry = None
+model_registry_lock = threading.Lock()
+# "type/filename" -> {"requests": count, "last_used": timestamp}, and whether it changed since the last save
+model_demand = None
+model_demand_dirty = False
+model_demand_lock = threading.Lock()
+hydrating = {}
+
+# Runtime pins on top of PINNED_MODELS, (model_type, filename) -> running jobs that reference it,
+# and the most recent eviction decisions
+pinned_models = set(PINNED_MODELS)
+job_models = {}
+eviction_log = []
+disk_lock = threading.Lock()
+
+# Checkpoint residency plan and checkpoint path -> when its file was last pulled into the page cache
+residency_state = {"limit": None, "ranking": [], "planned": None}
+readahead_times = {}
+
+# Jobs currently running and when the last one finished, for idle-time prefetch
+activity = {"active": 0, "last": time.time()}
+activity_lock = threading.Lock()
+
+# LoRA/LyCORIS references in prompts: <lora:name:weight>
+LORA_PATTERN = re.compile(r"<(?:lora|lyco):([^:>]+)(?::[^>]*)?>")
+
 def format_size(size):
     """Convert file size to human-readable format."""
     if size < 1024:
@@ -58,21 +212,275 @@ def format_size(size):
     else:
         return f"{size / (1024 * 1024 * 1024):.2f} GB"
 
-def wait_for_service(url):
-    """Wait for the WebUI service to be ready."""
+def decode_response(response):
+    """Decode a WebUI JSON response once, from bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+def summarize_payload(value, limit=256):
+    """Replace long strings such as base64 images with their length and a fingerprint for logging."""
+    if isinstance(value, str):
+        if len(value) <= limit:
+            return value
+        edges = (value[:4096] + value[-4096:]).encode()
+        return f"<{len(value)} chars, fp {hashlib.blake2b(edges, digest_size=6).hexdigest()}>"
+    if isinstance(value, dict):
+        return {key: summarize_payload(item, limit) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [summarize_payload(item, limit) for item in value]
+    return value
+
+def summarize_response(response):
+    """Describe a WebUI response for logging without copying its body."""
+    return f"Status={response.status_code}, Bytes={len(response.content)}"
+
+def make_backend(url):
+    """Create the state kept for one WebUI instance."""
+    return {
+        "url": url,
+        "api": f"{url}/sdapi/v1",
+        "reactor": f"{url}/reactor",
+        "healthy": True,
+        "failures": 0,
+        "inflight": 0,
+        "options": None,
+        "reactor_probe": {"available": None, "checked": 0.0},
+        # Serializes checkpoint switches with the generation that depends on them. The slot is reentrant for its
+        # owner thread and handed to waiting jobs by priority, then arrival; waiting entries are [-priority, seq, estimate].
+        "slot": {"owner": None, "depth": 0, "seq": 0, "waiting": [], "running": None},
+        "slot_cond": threading.Condition(),
+        "active": {"id": None, "job": None},
+        # Checkpoints WebUI is likely holding in its own cache, most recent first, and its cache size
+        "resident": [],
+        "checkpoints_limit": 1
+    }
+
+def configure_backends(urls):
+    """Replace the backend pool with the given WebUI base URLs."""
+    backends[:] = [make_backend(url.rstrip("/")) for url in urls]
+
+configure_backends(WEBUI_URLS)
+
+def backend():
+    """Return the backend the current job was routed to, or the first healthy one for everything else."""
+    selected = current_backend.get()
+    if selected is not None:
+        return selected
+    return next((candidate for candidate in backends if candidate["healthy"]), backends[0])
+
+@contextmanager
+def use_backend(selected):
+    """Send the WebUI calls made in a block to one backend."""
+    token = current_backend.set(selected)
+    try:
+        yield selected
+    finally:
+        current_backend.reset(token)
+
+def job_model_name(input_data):
+    """Return the checkpoint a job needs, using the first sub-job that names one for batches."""
+    if input_data.get("model_name"):
+        return input_data["model_name"]
+    for job in input_data.get("jobs") or []:
+        if job.get("model_name"):
+            return job["model_name"]
+    return None
+
+def select_backend(input_data):
+    """Route a job to an idle healthy backend that has its checkpoint loaded, else to the least loaded one."""
+    model_name = job_model_name(input_data)
+    with backends_lock:
+        # Without any healthy backend keep trying them all rather than failing outright
+        candidates = [candidate for candidate in backends if candidate["healthy"]] or backends
+        loaded = lambda candidate: bool(model_name) and checkpoint_matches((candidate["options"] or {}).get("sd_model_checkpoint"), model_name)
+        selected = next((candidate for candidate in candidates if candidate["inflight"] == 0 and loaded(candidate)), None)
+        if selected is None:
+            selected = min(candidates, key=lambda candidate: (candidate["inflight"], not loaded(candidate)))
+        selected["inflight"] += 1
+    return selected
+
+def release_backend(selected):
+    """Count a job routed to a backend as finished."""
+    with backends_lock:
+        selected["inflight"] -= 1
+
+def record_backend_health(selected, healthy):
+    """Eject a backend after BACKEND_MAX_FAILURES consecutive failures and take it back once it answers again."""
+    with backends_lock:
+        if healthy:
+            if not selected["healthy"]:
+                print(f"Backend {selected['url']} is healthy again")
+                # A backend that comes back may have been restarted with an empty checkpoint cache
+                selected["options"] = None
+                selected["resident"].clear()
+                selected["reactor_probe"].update(available=None, checked=0.0)
+            selected.update(healthy=True, failures=0)
+        else:
+            selected["failures"] += 1
+            if selected["healthy"] and selected["failures"] >= BACKEND_MAX_FAILURES:
+                print(f"Ejecting backend {selected['url']} after {selected['failures']} failed checks")
+                selected["healthy"] = False
+                metrics.increment("worker_backend_ejections_total", backend=selected["url"])
+
+def check_backend(selected):
+    """Probe a backend's API and record the outcome."""
+    try:
+        response = requests.get(f"{selected['api']}/progress", params={"skip_current_image": "true"}, timeout=5)
+        healthy = response.status_code == 200
+    except requests.exceptions.RequestException:
+        healthy = False
+    record_backend_health(selected, healthy)
+    return healthy
+
+def health_loop():
+    """Check every backend every HEALTH_INTERVAL seconds."""
+    while True:
+        time_module.sleep(HEALTH_INTERVAL)
+        for selected in list(backends):
+            check_backend(selected)
+
+def for_each_backend(function, include_unhealthy=False):
+    """Call a function once per backend concurrently, returning (backend, result or exception) pairs."""
+    targets = [candidate for candidate in backends if include_unhealthy or candidate["healthy"]] or backends
+
+    def call(selected):
+        with use_backend(selected):
+            try:
+                return function()
+            except Exception as e:
+                return e
+
+    if len(targets) == 1:
+        return [(targets[0], call(targets[0]))]
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        return list(zip(targets, pool.map(call, targets)))
+
+def get_backends():
+    """Report each backend's health, load and loaded checkpoint."""
+    return {
+        "backends": [{
+            "url": candidate["url"],
+            "healthy": candidate["healthy"],
+            "failures": candidate["failures"],
+            "inflight": candidate["inflight"],
+            "queued": len(candidate["slot"]["waiting"]),
+            "checkpoint": (candidate["options"] or {}).get("sd_model_checkpoint")
+        } for candidate in backends]
+    }
+
+def wait_for_service(url, timeout=STARTUP_TIMEOUT):
+    """Wait for the WebUI service to be ready, giving up after the overall timeout."""
+    deadline = time.time() + timeout
     retries = 0
     while True:
         try:
-            requests.get(url, timeout=120)
-            return
+            response = requests.get(url, timeout=5)
+            if response.status_code == 200:
+                return
         except requests.exceptions.RequestException:
-            retries += 1
-            if retries % 15 == 0:
-                print("Service not ready yet. Retrying...")
+            pass
         except Exception as err:
             print(f"Error waiting for service: {err}")
+        retries += 1
+        if retries % 15 == 0:
+            print("Service not ready yet. Retrying...")
+        if time.time() >= deadline:
+            raise Exception(f"WebUI API did not become ready within {timeout:.0f}s")
         time.sleep(0.2)
 
+def mark_startup(state):
+    """Advance the readiness state machine and record the transition on the startup timeline."""
+    elapsed = round(time.time() - PROCESS_START, 3)
+    startup_state["state"] = state
+    startup_state["timeline"].append({"phase": state, "at": elapsed})
+    print(f"Startup: {state} at {elapsed}s")
+
+def warmup():
+    """Run a tiny txt2img so CUDA kernels and attention backends are initialized before the first job."""
+    payload = {
+        "prompt": "warmup",
+        "steps": WARMUP_STEPS,
+        "width": WARMUP_SIZE,
+        "height": WARMUP_SIZE,
+        "seed": 0,
+        "do_not_save_grid": True,
+        "do_not_save_samples": True
+    }
+    response = automatic_session.post(f"{backend()['api']}/txt2img", json=payload, timeout=600)
+    if response.status_code != 200:
+        raise Exception(f"Warmup generation failed: {response.text}")
+
+def startup_phase(function):
+    """Run a startup step on every healthy backend, ejecting the ones it fails on and failing when none are left."""
+    for selected, result in for_each_backend(function):
+        if isinstance(result, Exception):
+            print(f"Startup failed on backend {selected['url']}: {str(result)}")
+            selected["healthy"] = False
+    if not any(candidate["healthy"] for candidate in backends):
+        raise Exception("No WebUI backend came up")
+
+def optional_startup_phase(name, function):
+    """Run a startup step the worker can serve without, recording failures in the startup state instead of ejecting backends."""
+    failures = {selected["url"]: str(result) for selected, result in for_each_backend(function) if isinstance(result, Exception)}
+    for url, error in failures.items():
+        print(f"Startup {name} failed on backend {url}: {error}")
+    if failures:
+        startup_state.setdefault("warnings", []).append({"phase": name, "errors": failures})
+    return not failures
+
+def load_default_model():
+    """Sync the options mirror and load DEFAULT_MODEL on the current backend."""
+    sync_webui_state()
+    if DEFAULT_MODEL:
+        set_model(DEFAULT_MODEL)
+
+def run_startup():
+    """Bring every backend from process start to warm: API up, default checkpoint loaded, warmup done."""
+    try:
+        startup_phase(lambda: wait_for_service(url=f"{backend()['api']}/sd-models"))
+        mark_startup("api_up")
+        if DEFAULT_MODEL:
+            errors = hydrate_models([("checkpoints", DEFAULT_MODEL)])
+            if errors:
+                print(f"Failed to fetch default model: {json.dumps(errors)}")
+                startup_state.setdefault("warnings", []).append({"phase": "hydrate_default_model", "errors": errors})
+        # A worker without its checkpoint yet still serves installs and downloads, so these steps only warn
+        optional_startup_phase("load_default_model", load_default_model)
+        mark_startup("model_loaded")
+        if WARMUP_STEPS > 0:
+            optional_startup_phase("warmup", warmup)
+        mark_startup("warm")
+    except Exception as e:
+        startup_state["error"] = str(e)
+        mark_startup("failed")
+        raise
+
+def get_startup():
+    """Report the readiness state and the startup timeline with per-phase durations."""
+    timeline = []
+    previous = 0.0
+    for entry in startup_state["timeline"]:
+        timeline.append({**entry, "duration": round(entry["at"] - previous, 3)})
+        previous = entry["at"]
+    result = {"state": startup_state["state"], "timeline": timeline}
+    if "error" in startup_state:
+        result["error"] = startup_state["error"]
+    if startup_state.get("warnings"):
+        result["warnings"] = startup_state["warnings"]
+    return result
+
+def strip_checkpoint_hash(title):
+    """Remove the trailing [hash] WebUI appends to checkpoint titles."""
+    return re.sub(r"\s*\[[0-9a-fA-F]+\]$", "", title)
+
+def checkpoint_matches(title, model_name):
+    """Check whether a WebUI checkpoint title refers to the given checkpoint filename."""
+    if not title:
+        return False
+    title = strip_checkpoint_hash(title)
+    return os.path.splitext(title)[0] == os.path.splitext(model_name)[0]
+
 def set_model(model_name):
     """Set the checkpoint model by its filename, stripping extension for title."""
     model_dir = directories["checkpoints"][0]
@@ -80,89 +488,739 @@ def set_model(model_name):
     if not os.path.isfile(model_path):
         raise ValueError(f"Model file {model_name} not found at {model_path}")
 
+    record_model_demand([("checkpoints", model_name)], count=False)
+
+    options = backend()["options"]
+    if options is None:
+        options = sync_webui_state()
+    if options is not None and checkpoint_matches(options.get("sd_model_checkpoint"), model_name):
+        return False
+
     model_title = os.path.splitext(model_name)[0]
     payload = {"sd_model_checkpoint": model_title}
-    response = automatic_session.post(f"{LOCAL_URL}/options", json=payload, timeout=60)
+    source = switch_source(model_name, model_path)
+    tracing.annotate(model=model_name, source=source)
+    started = time.perf_counter()
+    try:
+        response = automatic_session.post(f"{backend()['api']}/options", json=payload, timeout=60)
+    except Exception:
+        invalidate_webui_state()
+        raise
     if response.status_code != 200:
+        invalidate_webui_state()
         raise Exception(f"Failed to set model: {response.text}")
+    metrics.observe(
+        "worker_checkpoint_switch_seconds",
+        time.perf_counter() - started,
+        residency="on" if RESIDENCY_RAM_BYTES > 0 else "off",
+        source=source
+    )
+    update_webui_state(payload)
+    resident = backend()["resident"]
+    if model_name in resident:
+        resident.remove(model_name)
+    resident.insert(0, model_name)
+    del resident[max(1, backend()["checkpoints_limit"]):]
+    return True
 
 def refresh_model_type(model_type):
     """Refresh the model list for a specific type."""
     if model_type not in refresh_endpoints:
         raise ValueError(f"Invalid model type for refresh: {model_type}")
     endpoint = refresh_endpoints[model_type]
-    response = automatic_session.post(f"{LOCAL_URL}/{endpoint}", timeout=60)
-    if response.status_code != 200:
-        raise Exception(f"Failed to refresh {model_type}: {response.text}")
+
+    # Model directories are shared, so every backend needs to see the change
+    def refresh():
+        response = automatic_session.post(f"{backend()['api']}/{endpoint}", timeout=60)
+        if response.status_code != 200:
+            raise Exception(f"Failed to refresh {model_type} on {backend()['url']}: {response.text}")
+
+    for _, result in for_each_backend(refresh):
+        if isinstance(result, Exception):
+            raise result
     print(f"{model_type.capitalize()} refreshed successfully.")
 
 def restart_server():
     """Restart the WebUI server via API."""
     try:
-        response = automatic_session.post(f"{LOCAL_URL}/server-restart", timeout=60)
+        response = automatic_session.post(f"{backend()['api']}/server-restart", timeout=60)
         if response.status_code == 200:
             print("Server restart initiated.")
+            invalidate_webui_state()
+            backend()["resident"].clear()
+            invalidate_reactor_probe()
             return {"status": "restart initiated", "success": True}
         else:
             return {"status": f"Failed to restart server: HTTP {response.status_code} - {response.text}", "success": False}
     except Exception as e:
         return {"status": f"Failed to restart server: {str(e)}", "success": False}
 
-def extract_filename(response):
-    """Extract the filename from the response headers or URL."""
-    content_disposition = response.headers.get('Content-Disposition')
-    if content_disposition:
-        filename_match = re.search(r'filename="?(.+?)"?(;|$)', content_disposition)
-        if filename_match:
-            return filename_match.group(1)
-    url_filename = os.path.basename(response.url.split('?')[0])
-    return url_filename if url_filename else "downloaded_model.safetensors"
+def restart_and_wait():
+    """Restart the WebUI server and block until its API answers again."""
+    started = time.time()
+    result = restart_server()
+    if not result["success"]:
+        return result
+
+    # Wait for the old process to go away so we don't mistake it for the new one
+    while time.time() - started < 30:
+        try:
+            requests.get(f"{backend()['api']}/sd-models", timeout=2)
+        except requests.exceptions.RequestException:
+            break
+        time.sleep(0.2)
+
+    try:
+        wait_for_service(url=f"{backend()['api']}/sd-models", timeout=RESTART_TIMEOUT)
+    except Exception as e:
+        return {"status": f"Server did not come back after restart: {str(e)}", "success": False}
+    sync_webui_state()
+    seconds = round(time.time() - started, 3)
+    print(f"Server restarted in {seconds}s.")
+    return {"status": "restarted", "success": True, "seconds": seconds}
+
+def restart_backends(restart):
+    """Restart every backend with the given restart function, reporting per backend when there are several."""
+    results = for_each_backend(restart, include_unhealthy=True)
+    if len(results) == 1:
+        if isinstance(results[0][1], Exception):
+            raise results[0][1]
+        return results[0][1]
+    backend_results = []
+    for selected, result in results:
+        if isinstance(result, Exception):
+            result = {"status": f"Failed to restart server: {str(result)}", "success": False}
+        backend_results.append({"url": selected["url"], **result})
+    success = all(result["success"] for result in backend_results)
+    return {"status": "restarted" if success else "restart failed on some backends", "success": success, "backends": backend_results}
+
+def format_install_result(result):
+    """Format a model fetch result for the API response."""
+    if "error" in result or result["status"] == "superseded":
+        return result
+    modified = time_module.strftime("%Y-%m-%d %H:%M:%S", time_module.localtime(os.path.getmtime(result["path"])))
+    return {
+        "name": result["name"],
+        "type": result["type"][:-1],
+        "size": format_size(result["bytes"]),
+        "modified": modified,
+        "path": result["path"],
+        "status": result["status"],
+        "bytes": result["bytes"],
+        "seconds": result["seconds"],
+        "throughput": f"{format_size(round(result['throughput']))}/s",
+        "resumed": format_size(result["resumed_bytes"]),
+        "sha256": result["sha256"],
+        "deduplicated": result["status"] in ("cached", "deduplicated")
+    }
 
 def download_model(input_data):
     """Download a model file from a URL and save it to the appropriate directory."""
-    model_type = input_data["type"]
-    url = input_data["url"]
-    filename = input_data.get("filename")
-    token = input_data.get("token")
+    prepared = prepare_model({
+        "type": input_data["type"],
+        "url": input_data["url"],
+        "filename": input_data.get("filename"),
+        "token": input_data.get("token"),
+        "sha256": input_data.get("sha256"),
+        "size": input_data.get("size"),
+        "connections": input_data.get("connections")
+    })
+    make_room([prepared])
+    result = fetch_model(prepared)
+    print(f"Fetched {result['name']} ({result['status']}): {format_size(result['bytes'])} in {result['seconds']}s")
+    index_model_file(result["type"], result["name"], result.get("sha256"))
 
-    # Map singular to plural model type if necessary
-    model_type = model_type_mapping.get(model_type, model_type)
+    # Refresh the model list for this type
+    refresh_model_type(result["type"])
+    return format_install_result(result)
+
+def install_model_manifest(entries, concurrency=None):
+    """Install manifest entries concurrently, evicting unused models to make room, then refresh each affected model type once."""
+    results = install_manifest(entries, concurrency=concurrency, make_room=make_room)
+    changed_types = set()
+    for result in results:
+        if "error" not in result and result["status"] != "superseded":
+            index_model_file(result["type"], result["name"], result.get("sha256"))
+            if result["status"] != "skipped":
+                changed_types.add(result["type"])
+
+    for model_type in sorted(changed_types):
+        try:
+            refresh_model_type(model_type)
+        except Exception as e:
+            print(f"Failed to refresh {model_type}: {str(e)}")
+    return [format_install_result(result) for result in results]
+
+def load_model_registry():
+    """Load the registry of models that can be fetched on first use."""
+    global model_registry
+    with model_registry_lock:
+        if model_registry is None:
+            model_registry = {}
+            for entry in parse_manifest(MODEL_REGISTRY_FILE):
+                try:
+                    register_model(entry)
+                except ValueError as e:
+                    print(f"Skipping registry line {entry.get('line')}: {str(e)}")
+        return model_registry
+
+def register_model(entry):
+    """Add a model that can be fetched on first use; the filename is how jobs refer to it."""
+    model_type = model_type_mapping.get(entry.get("type"), entry.get("type"))
     if model_type not in directories:
-        raise ValueError(f"Invalid model type: {model_type}")
-
-    dir_path, extensions = directories[model_type]
+        raise ValueError(f"Invalid model type: {entry.get('type')}")
+    if not entry.get("url") or not entry.get("filename"):
+        raise ValueError("Registry entries need a url and a filename")
+    model_registry[(model_type, entry["filename"])] = {**entry, "type": model_type}
+
+def register_models(models):
+    """Add models to the registry at runtime."""
+    load_model_registry()
+    with model_registry_lock:
+        for entry in models:
+            register_model(entry)
+    return get_model_registry()
+
+def registry_entry(model_type, name):
+    """Find the registry entry for a model referenced by filename or by name without extension."""
+    registry = load_model_registry()
+    if (model_type, name) in registry:
+        return registry[(model_type, name)]
+    for (entry_type, filename), entry in registry.items():
+        if entry_type == model_type and os.path.splitext(filename)[0] == name:
+            return entry
+    return None
+
+def model_present(model_type, name):
+    """Check whether a model referenced by filename or by name without extension is on disk."""
+    files = refresh_model_index(model_type)["files"]
+    return name in files or any(os.path.splitext(filename)[0] == name for filename in files)
+
+def model_references(input_data):
+    """Collect the (model_type, name) pairs a generation job needs: checkpoint, VAE, LoRAs and registered embeddings."""
+    references = []
+    if input_data.get("model_name"):
+        references.append(("checkpoints", input_data["model_name"]))
+    vae = (input_data.get("override_settings") or {}).get("sd_vae")
+    if vae and vae not in ("Automatic", "None"):
+        references.append(("vaes", vae))
+
+    text = f"{input_data.get('prompt', '')}\n{input_data.get('negative_prompt', '')}"
+    for name in LORA_PATTERN.findall(text):
+        references.append(("loras", name.strip()))
+    for model_type, filename in list(load_model_registry()):
+        if model_type == "embeddings":
+            stem = os.path.splitext(filename)[0]
+            if re.search(rf"(?<![\w-]){re.escape(stem)}(?![\w-])", text):
+                references.append(("embeddings", filename))
+    return list(dict.fromkeys(references))
+
+def load_model_demand():
+    """Load per-model request counts once per process."""
+    global model_demand
+    if model_demand is None:
+        try:
+            with open(MODEL_DEMAND_FILE, "r") as f:
+                model_demand = json.load(f)
+            # Older files stored bare request counts
+            model_demand = {key: value if isinstance(value, dict) else {"requests": value, "last_used": None} for key, value in model_demand.items()}
+        except (OSError, ValueError):
+            model_demand = {}
+    return model_demand
+
+def save_model_demand():
+    """Persist per-model request counts so popularity survives restarts."""
+    global model_demand_dirty
+    with model_demand_lock:
+        if model_demand is None:
+            return
+        model_demand_dirty = False
+        try:
+            os.makedirs(os.path.dirname(MODEL_DEMAND_FILE), exist_ok=True)
+            tmp_path = MODEL_DEMAND_FILE + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(model_demand, f)
+            os.replace(tmp_path, MODEL_DEMAND_FILE)
+        except OSError as e:
+            model_demand_dirty = True
+            print(f"Failed to save model demand: {str(e)}")
+
+def demand_save_loop():
+    """Save changed request counts every MODEL_DEMAND_SAVE_INTERVAL seconds."""
+    while True:
+        time_module.sleep(MODEL_DEMAND_SAVE_INTERVAL)
+        if model_demand_dirty:
+            save_model_demand()
+
+def resolve_model_name(model_type, name):
+    """Map a reference that may omit the extension to the filename on disk or in the registry."""
+    files = refresh_model_index(model_type)["files"]
+    if name in files:
+        return name
+    for filename in files:
+        if os.path.splitext(filename)[0] == name:
+            return filename
+    entry = registry_entry(model_type, name)
+    return entry["filename"] if entry else name
+
+def record_model_demand(references, count=True):
+    """Mark referenced models as used now, counting a request for each unless count is False."""
+    global model_demand_dirty
+    now = time.time()
+    with model_demand_lock:
+        model_demand_dirty = True
+        demand = load_model_demand()
+        for model_type, name in references:
+            key = f"{model_type}/{resolve_model_name(model_type, name)}"
+            usage = demand.setdefault(key, {"requests": 0, "last_used": None})
+            if count:
+                usage["requests"] += 1
+                usage["score"] = popularity(usage, now) + 1
+                usage["score_at"] = now
+            usage["last_used"] = now
+
+def popularity(usage, now=None):
+    """Return a model's request count decayed by POPULARITY_HALF_LIFE, so frequent and recent both rank high."""
+    if not usage.get("score"):
+        return 0.0
+    elapsed = (now or time.time()) - usage["score_at"]
+    return usage["score"] * math.pow(0.5, elapsed / POPULARITY_HALF_LIFE)
+
+def hydrate_models(references):
+    """Fetch every referenced model that is missing but registered, concurrently, and return errors by name."""
+    missing = []
+    for model_type, name in references:
+        if not model_present(model_type, name):
+            entry = registry_entry(model_type, name)
+            if entry is not None:
+                missing.append(entry)
+    if not missing:
+        return {}
+
+    # Another job may already be fetching some of these; wait for it instead of downloading twice
+    with model_registry_lock:
+        owned = [entry for entry in missing if (entry["type"], entry["filename"]) not in hydrating]
+        waiting = [hydrating[(entry["type"], entry["filename"])] for entry in missing if entry not in owned]
+        for entry in owned:
+            hydrating[(entry["type"], entry["filename"])] = threading.Event()
+
+    errors = {}
+    try:
+        if owned:
+            print(f"Hydrating {len(owned)} missing model(s): {', '.join(entry['filename'] for entry in owned)}")
+            with metrics.phase("hydrate_models"):
+                results = install_model_manifest(owned)
+            for entry, result in zip(owned, results):
+                if "error" in result:
+                    errors[entry["filename"]] = result["error"]
+    finally:
+        with model_registry_lock:
+            for entry in owned:
+                hydrating.pop((entry["type"], entry["filename"])).set()
+
+    if waiting:
+        with metrics.phase("hydrate_wait"):
+            for event in waiting:
+                event.wait()
+    for entry in missing:
+        if entry["filename"] not in errors and not model_present(entry["type"], entry["filename"]):
+            errors[entry["filename"]] = "Model is still missing after hydration"
+    return errors
+
+def hydrate_job(input_data):
+    """Make sure every model a generation job references is on disk and fits its checkpoint before it queues for the GPU."""
+    references = model_references(input_data)
+    record_model_demand(references)
+    hold_job_models(references)
+    errors = hydrate_models(references)
+    if errors:
+        raise Exception(f"Failed to fetch models: {json.dumps(errors)}")
+    problems = check_job_models(input_data)
+    if problems:
+        metrics.increment("worker_admission_total", decision="incompatible")
+        raise ValueError(f"Job rejected: {'; '.join(problems)}")
+
+def get_model_registry():
+    """List registered models with whether each is on disk and how often it was requested."""
+    registry = load_model_registry()
+    demand = load_model_demand()
+    models = []
+    for (model_type, filename), entry in sorted(registry.items()):
+        models.append({
+            "type": model_type,
+            "filename": filename,
+            "url": entry["url"],
+            "present": model_present(model_type, filename),
+            "requests": (demand.get(f"{model_type}/{filename}") or {}).get("requests", 0)
+        })
+    return {"models": models}
+
+def prefetch_popular_models():
+    """Fetch the most requested registered models that are not on disk yet."""
+    popular = [model for model in get_model_registry()["models"] if model["requests"] > 0]
+    popular.sort(key=lambda model: -model["requests"])
+    references = [(model["type"], model["filename"]) for model in popular[:PREFETCH_TOP] if not model["present"]]
+    if references:
+        print(f"Prefetching popular models: {', '.join(name for _, name in references)}")
+        errors = hydrate_models(references)
+        if errors:
+            print(f"Prefetch failed: {json.dumps(errors)}")
+    save_model_demand()
+
+def prefetch_loop():
+    """Prefetch popular models whenever the worker has been idle for PREFETCH_IDLE seconds."""
+    while True:
+        time_module.sleep(PREFETCH_IDLE)
+        with activity_lock:
+            idle = activity["active"] == 0 and time.time() - activity["last"] >= PREFETCH_IDLE
+        if not idle:
+            continue
+        try:
+            prefetch_popular_models()
+        except Exception as e:
+            print(f"Prefetch failed: {str(e)}")
+
+def track_activity(delta):
+    """Count a job starting (1) or finishing (-1)."""
+    with activity_lock:
+        activity["active"] += delta
+        activity["last"] = time.time()
+
+def is_pinned(model_type, name):
+    """Check whether a model must never be evicted."""
+    if f"{model_type}/{name}" in pinned_models or name in pinned_models or os.path.splitext(name)[0] in pinned_models:
+        return True
+    if (model_type, name) in hydrating or job_models.get((model_type, name)):
+        return True
+    if model_type == "checkpoints":
+        if DEFAULT_MODEL and name == DEFAULT_MODEL:
+            return True
+        # Any backend's loaded checkpoint counts, since affinity routing sends its jobs there
+        return any(checkpoint_matches((candidate["options"] or {}).get("sd_model_checkpoint"), name) for candidate in backends)
+    return False
+
+def hold_job_models(references):
+    """Keep the models a running job references from being evicted until the job ends."""
+    job = current_job.get()
+    if job is None:
+        return
+    held = [(model_type, resolve_model_name(model_type, name)) for model_type, name in references]
+    with disk_lock:
+        for key in held:
+            job_models[key] = job_models.get(key, 0) + 1
+    job.setdefault("models", []).extend(held)
+
+def release_job_models(job):
+    """Let the models a finished job referenced be evicted again."""
+    with disk_lock:
+        for key in job.get("models", []):
+            job_models[key] -= 1
+            if job_models[key] <= 0:
+                del job_models[key]
+
+def pin_models(models, pinned=True):
+    """Pin or unpin models (type/filename or filename) for this process."""
+    for name in models:
+        if pinned:
+            pinned_models.add(name)
+        else:
+            pinned_models.discard(name)
+    return get_disk_budget()
+
+def eviction_candidates(device=None):
+    """Return unpinned model files in directories on a device, grouped by inode, least recently used first."""
+    demand = load_model_demand()
+    groups = {}
+    for model_type, (dir_path, _) in directories.items():
+        # Match on the model directory: with a store on another filesystem the inode is the blob's
+        if device is not None and (not os.path.isdir(dir_path) or os.stat(dir_path).st_dev != device):
+            continue
+        for name, info in refresh_model_index(model_type)["files"].items():
+            group = groups.setdefault(tuple(info["inode"]), {"size": info["size"], "names": [], "last_used": 0, "pinned": False})
+            group["names"].append((model_type, name))
+            usage = demand.get(f"{model_type}/{name}") or {}
+            # Models this worker never used fall back to their file time
+            group["last_used"] = max(group["last_used"], usage.get("last_used") or info["mtime"])
+            group["pinned"] = group["pinned"] or is_pinned(model_type, name)
+    return sorted((group for group in groups.values() if not group["pinned"]), key=lambda group: group["last_used"])
+
+def model_bytes():
+    """Return the unique bytes used by all model directories."""
+    inodes = {}
+    for model_type in directories:
+        for info in refresh_model_index(model_type)["files"].values():
+            inodes[tuple(info["inode"])] = info["size"]
+    return sum(inodes.values())
+
+def available_bytes(dir_path):
+    """Return how many more model bytes fit under the free-space reserve and the disk budget."""
+    room = shutil.disk_usage(dir_path).free - DISK_RESERVE_BYTES
+    if DISK_BUDGET_BYTES > 0:
+        room = min(room, DISK_BUDGET_BYTES - model_bytes())
+    return room
+
+def evict_models(needed, device, dir_path):
+    """Delete least recently used unpinned models on a device until needed bytes fit, returning the evictions."""
+    evicted = []
+    changed_types = set()
+    room = available_bytes(dir_path)
+    for group in eviction_candidates(device):
+        if room >= needed:
+            break
+        for model_type, name in group["names"]:
+            path = os.path.join(directories[model_type][0], name)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            unindex_model_file(model_type, name)
+            changed_types.add(model_type)
+        room += group["size"]
+        decision = {
+            "models": [f"{model_type}/{name}" for model_type, name in group["names"]],
+            "bytes": group["size"],
+            "last_used": group["last_used"],
+            "needed": needed,
+            "at": time.time()
+        }
+        print(f"Evicted {', '.join(decision['models'])} ({format_size(group['size'])}) to make room for {format_size(needed)}")
+        evicted.append(decision)
 
-    headers = {}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
+    if evicted:
+        # Store blobs whose last model name was removed hold the actual bytes
+        model_store.prune_blobs([dir_path for dir_path, _ in directories.values()])
+        for model_type in sorted(changed_types):
+            try:
+                refresh_model_type(model_type)
+            except Exception as e:
+                print(f"Failed to refresh {model_type}: {str(e)}")
+        eviction_log.extend(evicted)
+        del eviction_log[:-100]
+    if room < needed:
+        print(f"Could not free enough space: {format_size(needed)} needed, {format_size(max(room, 0))} available")
+    return evicted
+
+def make_room(prepared_entries):
+    """Evict least recently used models so pending downloads fit the disk budget, when eviction is enabled."""
+    if not MODEL_EVICTION and DISK_BUDGET_BYTES <= 0:
+        return
+    with disk_lock:
+        for device, needed in pending_bytes(prepared_entries).items():
+            dir_path = next(os.path.dirname(prepared["path"]) for prepared in prepared_entries
+                            if os.stat(os.path.dirname(prepared["path"])).st_dev == device)
+            if available_bytes(dir_path) < needed:
+                evict_models(needed, device, dir_path)
+
+def get_disk_budget():
+    """Report disk usage, the budget, pinned models, the current eviction order and recent evictions."""
+    dir_path = directories["checkpoints"][0]
+    usage = shutil.disk_usage(dir_path) if os.path.isdir(dir_path) else None
+    used = model_bytes()
+    return {
+        "model_bytes": used,
+        "model_size": format_size(used),
+        "eviction": MODEL_EVICTION or DISK_BUDGET_BYTES > 0,
+        "budget_bytes": DISK_BUDGET_BYTES or None,
+        "reserve_bytes": DISK_RESERVE_BYTES,
+        "free_bytes": usage.free if usage else None,
+        "available_bytes": available_bytes(dir_path) if usage else None,
+        "pinned": sorted(pinned_models),
+        "eviction_order": [
+            {"models": [f"{model_type}/{name}" for model_type, name in group["names"]], "bytes": group["size"], "last_used": group["last_used"]}
+            for group in eviction_candidates()
+        ],
+        "evictions": list(eviction_log)
+    }
 
-    response = requests.get(url, headers=headers, stream=True)
-    if response.status_code != 200:
-        raise Exception(f"Failed to download file: {response.status_code} {response.reason}")
+def switch_source(model_name, model_path):
+    """Guess where a checkpoint switch loads weights from: WebUI's cache, the page cache or disk."""
+    if model_name in backend()["resident"]:
+        return "webui_cache"
+    warmed = readahead_times.get(model_path)
+    if warmed is not None and time.time() - warmed < 2 * RESIDENCY_INTERVAL:
+        return "page_cache"
+    return "disk"
+
+def rank_checkpoints():
+    """Rank checkpoints on disk by decayed request popularity, most likely to be needed first."""
+    demand = load_model_demand()
+    now = time.time()
+    files = refresh_model_index("checkpoints")["files"]
+    ranking = []
+    for name, info in files.items():
+        usage = demand.get(f"checkpoints/{name}") or {}
+        ranking.append({"name": name, "bytes": info["size"], "score": round(popularity(usage, now), 4), "last_used": usage.get("last_used")})
+    ranking.sort(key=lambda entry: (-entry["score"], -(entry["last_used"] or 0)))
+    return ranking
+
+def readahead_file(path):
+    """Ask the kernel to pull a file into the page cache in the background."""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+    readahead_times[path] = time.time()
+    return True
+
+def plan_residency():
+    """Size WebUI's checkpoint cache to the popular checkpoints that fit the RAM budget and warm the next ones."""
+    ranking = rank_checkpoints()
+    popular = [entry for entry in ranking if entry["score"] > 0]
+    limit = 0
+    used = 0
+    for entry in popular[:RESIDENCY_MAX_CHECKPOINTS]:
+        if used + entry["bytes"] > RESIDENCY_RAM_BYTES:
+            break
+        used += entry["bytes"]
+        limit += 1
+    limit = max(1, limit)
+
+    # Several cached checkpoints only fit when the inactive ones wait in CPU RAM instead of VRAM
+    options = {"sd_checkpoints_limit": limit, "sd_checkpoints_keep_in_cpu": limit > 1}
+
+    def apply_limit():
+        current = backend()["options"]
+        if current is not None and all(current.get(key) == value for key, value in options.items()):
+            return
+        # Resizing the cache makes WebUI drop or move checkpoints, which must not happen under a running job
+        with hold_generation(timeout=RESIDENCY_INTERVAL):
+            set_options(options)
 
-    if not filename:
-        filename = extract_filename(response)
-        if not any(filename.endswith(ext) for ext in extensions):
-            raise ValueError(f"Extracted filename {filename} does not have a valid extension for {model_type}")
+    for selected, result in for_each_backend(apply_limit):
+        if isinstance(result, Exception):
+            print(f"Failed to set checkpoint cache on {selected['url']}: {str(result)}")
+        else:
+            selected["checkpoints_limit"] = limit
+            del selected["resident"][limit:]
+
+    warmed = []
+    checkpoints_dir = directories["checkpoints"][0]
+    for entry in popular[:limit + READAHEAD_CHECKPOINTS]:
+        path = os.path.join(checkpoints_dir, entry["name"])
+        # Re-reading recently warmed files costs I/O without changing anything
+        if time.time() - readahead_times.get(path, 0) >= RESIDENCY_INTERVAL and readahead_file(path):
+            warmed.append(entry["name"])
+    residency_state.update(limit=limit, ranking=ranking[:RESIDENCY_MAX_CHECKPOINTS + READAHEAD_CHECKPOINTS], planned=time.time())
+    if warmed:
+        print(f"Checkpoint residency: cache limit {limit}, warmed {', '.join(warmed)}")
+    return residency_state
+
+def residency_loop():
+    """Re-plan checkpoint residency every RESIDENCY_INTERVAL seconds."""
+    while True:
+        try:
+            plan_residency()
+        except Exception as e:
+            print(f"Residency planning failed: {str(e)}")
+        time_module.sleep(RESIDENCY_INTERVAL)
 
-    target_path = os.path.join(dir_path, filename)
+def get_residency():
+    """Report the checkpoint ranking, WebUI cache limit, warmed files and per-backend resident checkpoints."""
+    return {
+        "enabled": RESIDENCY_RAM_BYTES > 0,
+        "ram_budget_bytes": RESIDENCY_RAM_BYTES,
+        "limit": residency_state["limit"],
+        "planned": residency_state["planned"],
+        "ranking": residency_state["ranking"] or rank_checkpoints()[:RESIDENCY_MAX_CHECKPOINTS + READAHEAD_CHECKPOINTS],
+        "warmed": {os.path.basename(path): at for path, at in readahead_times.items()},
+        "backends": [{"url": candidate["url"], "resident": list(candidate["resident"]), "limit": candidate["checkpoints_limit"]} for candidate in backends]
+    }
 
-    with open(target_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+def parse_extension_spec(spec):
+    """Split an extension spec of the form url[@ref] into its URL, ref and directory name."""
+    spec = spec.strip().rstrip('/')
+    url, ref = spec, None
+    last_segment = spec.rsplit('/', 1)[-1]
+    if '@' in last_segment:
+        url, ref = spec.rsplit('@', 1)
+    name = os.path.basename(url.rstrip('/'))
+    if name.endswith(".git"):
+        name = name[:-4]
+    return url, ref, name
+
+def git(*args, cwd=None):
+    """Run a git command and return its stripped output."""
+    result = subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True)
+    return result.stdout.strip()
+
+def remote_commit(url, ref):
+    """Resolve a ref on a remote without fetching it, or None if it is not a named ref."""
+    patterns = [ref, f"{ref}^{{}}"] if ref else ["HEAD"]
+    output = git("ls-remote", url, *patterns)
+    commits = {}
+    for line in output.splitlines():
+        sha, name = line.split("\t", 1)
+        commits[name] = sha
+    for name, sha in commits.items():
+        if name.endswith("^{}"):
+            return sha  # Peeled annotated tag
+    return next(iter(commits.values()), None)
+
+def sync_extension(spec):
+    """Shallow-clone an extension, or fast-forward it only when its commit does not match."""
+    started = time.time()
+    url, ref, name = parse_extension_spec(spec)
+    extension_path = os.path.join(EXTENSIONS_DIR, name)
+    target = remote_commit(url, ref)
+    if target is None and ref and re.fullmatch(r"[0-9a-fA-F]{7,40}", ref):
+        target = ref  # Pinned commit sha
+
+    if os.path.isdir(os.path.join(extension_path, ".git")):
+        try:
+            current = git("rev-parse", "HEAD", cwd=extension_path)
+            origin = git("remote", "get-url", "origin", cwd=extension_path)
+        except subprocess.CalledProcessError:
+            current, origin = None, None
+        if origin == url and current and target and current.startswith(target.lower()):
+            return {"status": "unchanged", "extension": name, "commit": current, "seconds": round(time.time() - started, 3)}
+        if origin == url:
+            git("fetch", "--depth", "1", "origin", target or ref or "HEAD", cwd=extension_path)
+            git("reset", "--hard", "FETCH_HEAD", cwd=extension_path)
+            commit = git("rev-parse", "HEAD", cwd=extension_path)
+            return {"status": "updated", "extension": name, "commit": commit, "seconds": round(time.time() - started, 3)}
 
-    # Refresh the model list for this type
-    refresh_model_type(model_type)
+    if os.path.exists(extension_path):
+        shutil.rmtree(extension_path)
+    os.makedirs(extension_path)
+    git("init", "-q", cwd=extension_path)
+    git("remote", "add", "origin", url, cwd=extension_path)
+    git("fetch", "--depth", "1", "origin", target or ref or "HEAD", cwd=extension_path)
+    git("checkout", "-q", "FETCH_HEAD", cwd=extension_path)
+    commit = git("rev-parse", "HEAD", cwd=extension_path)
+    return {"status": "installed", "extension": name, "commit": commit, "seconds": round(time.time() - started, 3)}
+
+def sync_extensions(specs):
+    """Install or update several extensions in parallel."""
+    def sync(spec):
+        try:
+            return sync_extension(spec)
+        except subprocess.CalledProcessError as e:
+            return {"error": (e.stderr or str(e)).strip(), "line": spec}
+        except Exception as e:
+            return {"error": str(e), "line": spec}
+
+    # Only the last spec for an extension directory is applied, so parallel clones never collide
+    latest = {parse_extension_spec(spec)[2]: index for index, spec in enumerate(specs)}
+    os.makedirs(EXTENSIONS_DIR, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=EXTENSION_WORKERS) as pool:
+        futures = {index: pool.submit(sync, specs[index]) for index in latest.values()}
+    results = []
+    for index, spec in enumerate(specs):
+        if index in futures:
+            results.append(futures[index].result())
+        else:
+            results.append({"status": "superseded", "extension": parse_extension_spec(spec)[2], "line": spec})
+    return results
 
-    size = os.path.getsize(target_path)
-    modified = time_module.strftime("%Y-%m-%d %H:%M:%S", time_module.localtime(os.path.getmtime(target_path)))
-    return {
-        "name": filename,
-        "type": model_type[:-1],
-        "size": format_size(size),
-        "modified": modified,
-        "path": target_path
-    }
+def extensions_changed(results):
+    """Check whether any extension result requires a WebUI restart."""
+    return any(result.get("status") in ("installed", "updated", "deleted") for result in results)
 
 def install_from_file(file_path, install_type):
     """Install models or extensions from a file."""
@@ -170,43 +1228,21 @@ def install_from_file(file_path, install_type):
         return []
 
     with open(file_path, 'r') as f:
-        lines = f.readlines()
-
-    results = []
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-
-        if install_type == "models":
-            try:
-                model_type, url = line.split('|', 1)
-                model_type = model_type.strip()
-                url = url.strip()
-                result = download_model({"type": model_type, "url": url})
-                results.append(result)
-            except Exception as e:
-                results.append({"error": str(e), "line": line})
-        elif install_type == "extensions":
-            try:
-                extension_name = os.path.basename(line.rstrip('/'))
-                extension_path = os.path.join(EXTENSIONS_DIR, extension_name)
-                if os.path.exists(extension_path):
-                    shutil.rmtree(extension_path)
-                subprocess.run(["git", "clone", line, extension_path], check=True)
-                results.append({"status": "installed", "extension": extension_name})
-            except Exception as e:
-                results.append({"error": str(e), "line": line})
+        lines = [line.strip() for line in f if line.strip()]
 
-    return results
+    if install_type == "extensions":
+        return sync_extensions(lines)
+    if install_type == "models":
+        return install_model_manifest(parse_manifest(file_path))
+    return []
 
 def install_all():
     """Install all models and extensions from files."""
     models_results = install_from_file(MODELS_FILE, "models")
     extensions_results = install_from_file(EXTENSIONS_FILE, "extensions")
 
-    if extensions_results:
-        restart_result = restart_server()
+    if extensions_changed(extensions_results):
+        restart_result = restart_backends(restart_and_wait)
         extensions_results.append(restart_result)
 
     return {
@@ -221,8 +1257,8 @@ def install_models():
 def install_extensions():
     """Install extensions from extensions.txt."""
     results = install_from_file(EXTENSIONS_FILE, "extensions")
-    if results:
-        restart_result = restart_server()
+    if extensions_changed(results):
+        restart_result = restart_backends(restart_and_wait)
         results.append(restart_result)
     return results
 
@@ -239,92 +1275,374 @@ def list_extensions():
     return extensions
 
 def install_extension(url):
-    """Install a single extension from a URL."""
-    extension_name = os.path.basename(url.rstrip('/'))
-    extension_path = os.path.join(EXTENSIONS_DIR, extension_name)
-    if os.path.exists(extension_path):
-        shutil.rmtree(extension_path)
-    subprocess.run(["git", "clone", url, extension_path], check=True)
-    restart_result = restart_server()
-    return {"status": "installed", "extension": extension_name, "restart": restart_result}
+    """Install or update extensions from a URL or list of URLs, restarting once if anything changed."""
+    specs = url if isinstance(url, list) else [url]
+    results = sync_extensions(specs)
+    errors = [result for result in results if "error" in result]
+    if errors and not isinstance(url, list):
+        raise Exception(f"Failed to install extension: {errors[0]['error']}")
+
+    restart_result = restart_backends(restart_and_wait) if extensions_changed(results) else {"status": "not needed", "success": True}
+    if not isinstance(url, list):
+        return {**results[0], "restart": restart_result}
+    return {"extensions": results, "restart": restart_result}
 
 def delete_extension(extension_name):
-    """Delete an installed extension."""
-    extension_path = os.path.join(EXTENSIONS_DIR, extension_name)
-    if not os.path.exists(extension_path):
-        raise ValueError(f"Extension {extension_name} not found")
+    """Delete one or more installed extensions and restart once."""
+    names = extension_name if isinstance(extension_name, list) else [extension_name]
+    for name in names:
+        if not os.path.exists(os.path.join(EXTENSIONS_DIR, name)):
+            raise ValueError(f"Extension {name} not found")
+
+    for name in names:
+        shutil.rmtree(os.path.join(EXTENSIONS_DIR, name))
+    restart_result = restart_backends(restart_and_wait)
+    if not isinstance(extension_name, list):
+        return {"status": "deleted", "extension": extension_name, "restart": restart_result}
+    return {"status": "deleted", "extensions": names, "restart": restart_result}
+
+def load_model_index():
+    """Load the persisted model inventory once per process."""
+    global model_index
+    if model_index is None:
+        try:
+            with open(MODEL_INDEX_FILE, "r") as f:
+                model_index = json.load(f)
+        except (OSError, ValueError):
+            model_index = {}
+        if model_index.get("version") != MODEL_INDEX_VERSION:
+            model_index = {"version": MODEL_INDEX_VERSION}
+    return model_index
+
+def save_model_index():
+    """Persist the model inventory."""
+    try:
+        os.makedirs(os.path.dirname(MODEL_INDEX_FILE), exist_ok=True)
+        tmp_path = MODEL_INDEX_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(model_index, f)
+        os.replace(tmp_path, MODEL_INDEX_FILE)
+    except OSError as e:
+        print(f"Failed to save model index: {str(e)}")
+
+def stat_model_file(path):
+    """Return the inventory entry for a model file, or None if it is not a regular file."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+    info = {"size": stat.st_size, "mtime": stat.st_mtime, "inode": [stat.st_dev, stat.st_ino]}
+    if path.endswith(".safetensors"):
+        info["header"] = safetensors_index.summarize(path)
+    return info
+
+def refresh_model_index(model_type):
+    """Bring one directory of the inventory up to date, re-reading only files that are new or changed since the last scan."""
+    dir_path, extensions = directories[model_type]
+    with model_index_lock:
+        index = load_model_index()
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            index[model_type] = {"mtime": None, "files": {}}
+            return index[model_type]
+
+        entry = index.get(model_type)
+        if entry and entry["mtime"] == dir_mtime:
+            return entry
+
+        known = entry["files"] if entry else {}
+        files = {}
+        for name in os.listdir(dir_path):
+            if not name.endswith(tuple(extensions)):
+                continue
+            path = os.path.join(dir_path, name)
+            info = known.get(name)
+            if info is not None:
+                # A file replaced under the same name keeps nothing from its old entry, including its hash
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if info["mtime"] != stat.st_mtime or info["inode"] != [stat.st_dev, stat.st_ino] or info["size"] != stat.st_size:
+                    info = None
+            if info is None:
+                info = stat_model_file(path)
+            if info is not None:
+                files[name] = info
+        index[model_type] = {"mtime": dir_mtime, "files": files}
+        save_model_index()
+        return index[model_type]
+
+def index_model_file(model_type, name, sha256=None):
+    """Record a file the handler has just written without rescanning its directory, with its hash when known."""
+    dir_path = directories[model_type][0]
+    with model_index_lock:
+        entry = refresh_model_index(model_type)
+        previous = entry["files"].get(name) or {}
+        info = stat_model_file(os.path.join(dir_path, name))
+        if info is None:
+            entry["files"].pop(name, None)
+        else:
+            if sha256:
+                info["sha256"] = sha256.lower()
+            elif previous.get("sha256") and [previous.get(key) for key in ("size", "mtime", "inode")] == [info[key] for key in ("size", "mtime", "inode")]:
+                info["sha256"] = previous["sha256"]
+            entry["files"][name] = info
+        entry["mtime"] = os.stat(dir_path).st_mtime_ns
+        save_model_index()
+
+    if info is not None and info.get("sha256"):
+        try:
+            record_webui_hashes(model_type, name, info["sha256"])
+        except Exception as e:
+            print(f"Failed to record WebUI hash for {name}: {str(e)}")
 
-    shutil.rmtree(extension_path)
-    restart_result = restart_server()
-    return {"status": "deleted", "extension": extension_name, "restart": restart_result}
+def write_webui_hash_cache(entries, mtime):
+    """Store (section, key, sha256) entries where WebUI looks them up before hashing a file itself."""
+    try:
+        import diskcache
+    except ImportError:
+        diskcache = None
+    with webui_cache_lock:
+        if diskcache is not None and (os.path.isdir(WEBUI_CACHE_DIR) or not os.path.isfile(WEBUI_CACHE_FILE)):
+            for section, key, sha256 in entries:
+                # Same settings WebUI opens its caches with, so they are not overwritten
+                with diskcache.Cache(os.path.join(WEBUI_CACHE_DIR, section), size_limit=2**32, disk_min_file_size=2**18) as cache:
+                    cache[key] = {"mtime": mtime, "sha256": sha256}
+            return
+
+        # WebUI converts a legacy cache.json into its cache directory the first time it starts
+        try:
+            with open(WEBUI_CACHE_FILE, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        for section, key, sha256 in entries:
+            data.setdefault(section, {})[key] = {"mtime": mtime, "sha256": sha256}
+        tmp_path = WEBUI_CACHE_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, WEBUI_CACHE_FILE)
+
+def record_webui_hashes(model_type, name, sha256):
+    """Precompute the hashes WebUI shows in infotexts, which it never computes itself when started with --no-hashing."""
+    path = os.path.join(directories[model_type][0], name)
+    stem = os.path.splitext(name)[0]
+    if model_type == "checkpoints":
+        entries = [("hashes", f"checkpoint/{name}", sha256)]
+    elif model_type == "embeddings":
+        entries = [("hashes", f"textual_inversion/{stem}", sha256)]
+    elif model_type == "loras" and name.endswith(".safetensors"):
+        entries = [("hashes-addnet", f"lora/{stem}", safetensors_index.addnet_hash(path))]
+    elif model_type == "loras":
+        entries = [("hashes", f"lora/{stem}", sha256)]
+    else:
+        return  # WebUI does not hash VAEs
+    write_webui_hash_cache(entries, os.path.getmtime(path))
+
+def model_header(model_type, name):
+    """Return the safetensors header summary of a model referenced by filename or stem, or None."""
+    info = refresh_model_index(model_type)["files"].get(resolve_model_name(model_type, name))
+    return (info or {}).get("header")
+
+def check_job_models(input_data):
+    """Return why a job's models cannot work together: corrupt headers or LoRAs/VAEs built for another architecture."""
+    references = model_references(input_data)
+    checkpoint = input_data.get("model_name") or strip_checkpoint_hash((backend()["options"] or {}).get("sd_model_checkpoint") or "")
+    checkpoint_header = model_header("checkpoints", checkpoint) if checkpoint else None
+    if checkpoint and ("checkpoints", checkpoint) not in references:
+        references.insert(0, ("checkpoints", checkpoint))
+    checkpoint_architecture = (checkpoint_header or {}).get("architecture")
+
+    problems = []
+    for model_type, name in references:
+        header = model_header(model_type, name)
+        if not header:
+            continue
+        if header.get("error"):
+            problems.append(f"{model_type[:-1].capitalize()} {name} is corrupt: {header['error']}")
+        elif model_type in ("loras", "vaes") and not safetensors_index.compatible(checkpoint_architecture, model_type, header.get("architecture")):
+            problems.append(f"{model_type[:-1].capitalize()} {name} is {header['architecture']} but checkpoint {checkpoint} is {checkpoint_architecture}")
+    return problems
+
+def inspect_model(input_data):
+    """Return the tensor shapes, dtypes, architecture and metadata of a safetensors model from its header alone."""
+    model_type = model_type_mapping.get(input_data.get("type"), input_data.get("type"))
+    if model_type not in directories:
+        raise ValueError(f"Invalid model type: {input_data.get('type')}")
+    if not input_data.get("name"):
+        raise ValueError("name is required for inspect_model")
+    name = resolve_model_name(model_type, input_data["name"])
+    path = os.path.join(directories[model_type][0], name)
+    if not name.endswith(".safetensors") or not os.path.isfile(path):
+        raise ValueError(f"No safetensors {model_type[:-1]} named {input_data['name']}")
+    info = refresh_model_index(model_type)["files"].get(name) or {}
+    return {"name": name, "type": model_type[:-1], "sha256": info.get("sha256"), **safetensors_index.inspect(path)}
+
+def unindex_model_file(model_type, name):
+    """Drop a file the handler has just deleted without rescanning its directory."""
+    dir_path = directories[model_type][0]
+    with model_index_lock:
+        entry = refresh_model_index(model_type)
+        entry["files"].pop(name, None)
+        if os.path.exists(dir_path):
+            entry["mtime"] = os.stat(dir_path).st_mtime_ns
+        save_model_index()
+
+def get_models(input_data=None):
+    """List available models from the cached inventory, with optional filtering and paging."""
+    input_data = input_data or {}
+    requested_type = input_data.get("type")
+    if requested_type:
+        requested_type = model_type_mapping.get(requested_type, requested_type)
+        if requested_type not in directories:
+            raise ValueError(f"Invalid model type: {requested_type}")
+    search = (input_data.get("search") or "").lower()
+    # Keep checkpoints of this architecture and the LoRAs/VAEs that work with them
+    architecture = input_data.get("architecture")
+    offset = int(input_data.get("offset", 0))
+    limit = input_data.get("limit")
+    raw_sizes = input_data.get("raw_sizes", False)
 
-def get_models():
-    """List all available models with details."""
     result = {}
+    inodes = {}
+    apparent = 0
     for model_type, (dir_path, extensions) in directories.items():
-        if os.path.exists(dir_path):
-            files = [f for f in os.listdir(dir_path) if f.endswith(tuple(extensions)) and os.path.isfile(os.path.join(dir_path, f))]
-            file_list = []
-            for file in files:
-                path = os.path.join(dir_path, file)
-                size = os.path.getsize(path)
-                modified = time_module.strftime("%Y-%m-%d %H:%M:%S", time_module.localtime(os.path.getmtime(path)))
-                file_list.append({
-                    "name": file,
-                    "type": model_type[:-1],
-                    "size": format_size(size),
-                    "modified": modified,
-                    "path": path
-                })
-            result[model_type] = {
-                "count": len(files),
-                "files": file_list
-            }
-        else:
-            result[model_type] = {
-                "count": 0,
-                "files": []
+        entry = refresh_model_index(model_type)
+        for info in entry["files"].values():
+            apparent += info["size"]
+            inodes[tuple(info["inode"])] = info["size"]
+        if requested_type and model_type != requested_type:
+            continue
+
+        names = sorted(name for name in entry["files"] if search in name.lower())
+        if architecture:
+            names = [
+                name for name in names
+                if (entry["files"][name].get("header") or {}).get("architecture")
+                and safetensors_index.compatible(architecture, model_type, entry["files"][name]["header"]["architecture"])
+            ]
+        page = names[offset:offset + int(limit)] if limit is not None else names[offset:]
+        file_list = []
+        for name in page:
+            info = entry["files"][name]
+            item = {
+                "name": name,
+                "type": model_type[:-1],
+                "size": format_size(info["size"]),
+                "modified": time_module.strftime("%Y-%m-%d %H:%M:%S", time_module.localtime(info["mtime"])),
+                "path": os.path.join(dir_path, name)
             }
+            header = info.get("header")
+            if header:
+                item["architecture"] = header.get("architecture")
+                if header.get("lora_rank"):
+                    item["lora_rank"] = header["lora_rank"]
+                if header.get("error"):
+                    item["error"] = header["error"]
+            if info.get("sha256"):
+                item["sha256"] = info["sha256"]
+            if raw_sizes:
+                item["bytes"] = info["size"]
+            file_list.append(item)
+        result[model_type] = {
+            "count": len(names),
+            "files": file_list
+        }
+
+    unique = sum(inodes.values())
+    result["storage"] = {
+        "apparent_bytes": apparent,
+        "unique_bytes": unique,
+        "apparent": format_size(apparent),
+        "unique": format_size(unique),
+        "saved": format_size(apparent - unique)
+    }
     return result
 
 def get_sd_models():
     """Get the list of available Stable Diffusion models from the API."""
-    response = automatic_session.get(f"{LOCAL_URL}/sd-models", timeout=60)
+    response = automatic_session.get(f"{backend()['api']}/sd-models", timeout=60)
     if response.status_code != 200:
         raise Exception(f"Failed to get SD models: {response.text}")
     return response.json()
 
 def get_samplers():
     """Get the list of available samplers from the API."""
-    response = automatic_session.get(f"{LOCAL_URL}/samplers", timeout=60)
+    response = automatic_session.get(f"{backend()['api']}/samplers", timeout=60)
     if response.status_code != 200:
         raise Exception(f"Failed to get samplers: {response.text}")
     return response.json()
 
 def get_schedulers():
     """Get the list of available schedulers from the API."""
-    response = automatic_session.get(f"{LOCAL_URL}/schedulers", timeout=60)
+    response = automatic_session.get(f"{backend()['api']}/schedulers", timeout=60)
     if response.status_code != 200:
         raise Exception(f"Failed to get schedulers: {response.text}")
     return response.json()
 
 def get_options():
     """Get current WebUI options."""
-    response = automatic_session.get(f"{LOCAL_URL}/options", timeout=60)
+    response = automatic_session.get(f"{backend()['api']}/options", timeout=60)
     if response.status_code != 200:
         raise Exception(f"Failed to get options: {response.text}")
-    return response.json()
+    options = response.json()
+    backend()["options"] = dict(options)
+    return options
+
+def sync_webui_state():
+    """Re-seed the options mirror from WebUI, leaving it stale if WebUI is unreachable."""
+    try:
+        return get_options()
+    except Exception as e:
+        print(f"Failed to sync WebUI state: {str(e)}")
+        invalidate_webui_state()
+        return None
+
+def invalidate_webui_state():
+    """Mark the options mirror as stale so the next write re-reads it."""
+    backend()["options"] = None
+
+def update_webui_state(options):
+    """Record options that WebUI has accepted in the mirror."""
+    if backend()["options"] is not None:
+        backend()["options"].update(options)
 
 def set_options(options):
-    """Set WebUI options."""
-    response = automatic_session.post(f"{LOCAL_URL}/options", json=options, timeout=60)
+    """Set WebUI options, sending only the keys that differ from the mirrored state."""
+    current = backend()["options"]
+    if current is None:
+        current = sync_webui_state() or {}
+    changed = {key: value for key, value in options.items() if key not in current or current[key] != value}
+    if not changed:
+        return {"status": "options unchanged", "changed": []}
+
+    try:
+        response = automatic_session.post(f"{backend()['api']}/options", json=changed, timeout=60)
+    except Exception:
+        invalidate_webui_state()
+        raise
     if response.status_code != 200:
+        invalidate_webui_state()
         raise Exception(f"Failed to set options: {response.text}")
-    return {"status": "options updated"}
-
-def get_progress():
+    update_webui_state(changed)
+    return {"status": "options updated", "changed": sorted(changed)}
+
+def set_backend_options(options):
+    """Apply options on every backend so jobs behave the same wherever they are routed."""
+    results = for_each_backend(lambda: set_options(options))
+    for _, result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results[0][1]
+
+def get_progress(skip_current_image=False):
     """Get current progress of an ongoing task."""
-    response = automatic_session.get(f"{LOCAL_URL}/progress", timeout=60)
+    params = {"skip_current_image": "true"} if skip_current_image else None
+    response = automatic_session.get(f"{backend()['api']}/progress", params=params, timeout=60)
     if response.status_code != 200:
         raise Exception(f"Failed to get progress: {response.text}")
     return response.json()
@@ -347,13 +1665,14 @@ def check_reactor_status():
         status["details"]["extension_files"] = os.listdir(reactor_path)[:10]  # Limit to 10 files for brevity
 
     # Check if insightface model directory exists
-    status["model_available"] = os.path.exists(INSIGHTFACE_DIR) and "inswapper_128.onnx" in os.listdir(INSIGHTFACE_DIR)
+    insightface_files = os.listdir(INSIGHTFACE_DIR) if os.path.exists(INSIGHTFACE_DIR) else []
+    status["model_available"] = "inswapper_128.onnx" in insightface_files
     status["details"]["insightface_dir"] = INSIGHTFACE_DIR
-    status["details"]["insightface_files"] = os.listdir(INSIGHTFACE_DIR) if os.path.exists(INSIGHTFACE_DIR) else []
+    status["details"]["insightface_files"] = insightface_files
 
     # Check ReActor API availability
     try:
-        response = automatic_session.get(f"{REACTOR_URL}/models", timeout=10)
+        response = automatic_session.get(f"{backend()['reactor']}/models", timeout=10)
         status["api_available"] = response.status_code == 200
         status["details"]["api_models_response"] = response.text
     except Exception as e:
@@ -372,21 +1691,21 @@ def check_reactor_status():
 
 def get_reactor_models():
     """Get the list of available ReActor models."""
-    response = automatic_session.get(f"{REACTOR_URL}/models", timeout=60)
+    response = automatic_session.get(f"{backend()['reactor']}/models", timeout=60)
     if response.status_code != 200:
         raise Exception(f"Failed to get ReActor models: {response.text}")
     return response.json()
 
 def get_reactor_upscalers():
     """Get the list of available ReActor upscalers."""
-    response = automatic_session.get(f"{REACTOR_URL}/upscalers", timeout=60)
+    response = automatic_session.get(f"{backend()['reactor']}/upscalers", timeout=60)
     if response.status_code != 200:
         raise Exception(f"Failed to get ReActor upscalers: {response.text}")
     return response.json()
 
 def get_reactor_facemodels():
     """Get the list of available ReActor face models."""
-    response = automatic_session.get(f"{REACTOR_URL}/facemodels", timeout=60)
+    response = automatic_session.get(f"{backend()['reactor']}/facemodels", timeout=60)
     if response.status_code != 200:
         raise Exception(f"Failed to get ReActor face models: {response.text}")
     return response.json()
@@ -398,26 +1717,121 @@ def create_reactor_facemodel(input_data):
         "name": input_data.get("name", ""),
         "compute_method": input_data.get("compute_method", 0)
     }
-    response = automatic_session.post(f"{REACTOR_URL}/facemodels", json=payload, timeout=600)
+    response = automatic_session.post(f"{backend()['reactor']}/facemodels", json=payload, timeout=600)
     if response.status_code != 200:
         raise Exception(f"Failed to create face model: {response.text}")
     return response.json()
 
-def face_swap_handler(input_data):
-    """Handle face swap using ReActor's external API with fallback to built-in API."""
+def invalidate_reactor_probe():
+    """Forget the cached ReActor API availability so the next face swap probes again."""
+    backend()["reactor_probe"]["available"] = None
+    backend()["reactor_probe"]["checked"] = 0.0
+
+def reactor_available():
+    """Check whether ReActor's external API is available, reusing a recent probe."""
+    if backend()["reactor_probe"]["available"] is not None and time.time() - backend()["reactor_probe"]["checked"] < REACTOR_PROBE_TTL:
+        return backend()["reactor_probe"]["available"]
+
     print("Checking ReActor API availability...")
-    api_available = False
+    available = False
     try:
-        test_response = automatic_session.get(f"{REACTOR_URL}/models", timeout=10)
-        api_available = test_response.status_code == 200
+        test_response = automatic_session.get(f"{backend()['reactor']}/models", timeout=10)
+        available = test_response.status_code == 200
         print(f"ReActor models response: Status={test_response.status_code}, Body={test_response.text}")
     except Exception as e:
         print(f"ReActor API test failed: {str(e)}")
+    backend()["reactor_probe"]["available"] = available
+    backend()["reactor_probe"]["checked"] = time.time()
+    return available
+
+def delete_source_face_model(filename):
+    """Delete a face model this worker built from ReActor's faces directory."""
+    try:
+        os.remove(os.path.join(REACTOR_FACES_DIR, filename))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Failed to delete face model {filename}: {str(e)}")
+
+def load_source_face_models():
+    """List the face models earlier processes built, oldest first, once per process."""
+    global source_face_models
+    with source_face_load_lock:
+        if source_face_models is not None:
+            return
+        # Face models persist in WebUI, so reuse the ones earlier processes created
+        models = OrderedDict()
+        try:
+            facemodels = get_reactor_facemodels()
+            names = facemodels.get("facemodels", []) if isinstance(facemodels, dict) else facemodels
+            existing = []
+            for entry in names:
+                stem = os.path.splitext(os.path.basename(str(entry)))[0]
+                if stem.startswith("src_"):
+                    path = os.path.join(REACTOR_FACES_DIR, f"{stem}.safetensors")
+                    existing.append((os.path.getmtime(path) if os.path.exists(path) else 0, stem))
+            for _, stem in sorted(existing):
+                models[stem[4:]] = f"{stem}.safetensors"
+        except Exception as e:
+            print(f"Failed to list ReActor face models: {str(e)}")
+        with source_face_lock:
+            source_face_models = models
+
+def source_face_model_for(source_image):
+    """Return a ReActor face model for a repeated source image, building it the second time the image is seen."""
+    digest = hashlib.sha256(source_image.split(",", 1)[-1].encode()).hexdigest()[:16]
+    name = f"src_{digest}"
+    load_source_face_models()
+    with source_face_lock:
+        if digest in source_face_models:
+            source_face_models.move_to_end(digest)
+            return source_face_models[digest]
+        if digest not in source_face_sightings:
+            # A one-off source image is cheaper to swap from directly than to build a model for
+            source_face_sightings[digest] = True
+            while len(source_face_sightings) > FACE_MODEL_CACHE_MAX * 20:
+                source_face_sightings.popitem(last=False)
+            return None
+        if FACE_MODEL_CACHE_MAX <= 0 or digest in source_face_builds:
+            # While another job builds this model, swap from the image instead of waiting
+            return None
+        source_face_builds.add(digest)
+
+    # The build can take minutes, so it runs without the lock and never holds up swaps of other sources
+    try:
+        with metrics.phase("build_face_model"):
+            create_reactor_facemodel({"source_images": [source_image], "name": name})
+    except Exception as e:
+        print(f"Failed to build face model for source image: {str(e)}")
+        with source_face_lock:
+            source_face_builds.discard(digest)
+        return None
+
+    evicted = []
+    with source_face_lock:
+        source_face_builds.discard(digest)
+        source_face_sightings.pop(digest, None)
+        source_face_models[digest] = f"{name}.safetensors"
+        while len(source_face_models) > FACE_MODEL_CACHE_MAX:
+            evicted.append(source_face_models.popitem(last=False)[1])
+    for filename in evicted:
+        delete_source_face_model(filename)
+    return f"{name}.safetensors"
+
+def resolve_face_swap_inputs(input_data, images):
+    """Fetch URL face swap inputs, shrinking them to fit width x height only when the job sets both."""
+    mode = presize_mode(input_data, "fit") if input_data.get("width") and input_data.get("height") else None
+    return inputs.resolve_images(images, input_data.get("width"), input_data.get("height"), mode)
+
+def face_swap_handler(input_data):
+    """Handle face swap using ReActor's external API with fallback to built-in API."""
+    api_available = reactor_available()
 
     source_image = input_data.get("source_image")
     target_image = input_data.get("target_image")
     if not source_image or not target_image:
         raise ValueError("Both source_image and target_image are required")
+    source_image, target_image = resolve_face_swap_inputs(input_data, [source_image, target_image])
 
     if api_available:
         # External API
@@ -446,17 +1860,32 @@ def face_swap_handler(input_data):
             "upscale_force": input_data.get("upscale_force", 0)
         }
 
-        print(f"Attempting face swap request to {REACTOR_URL}/image with payload: {json.dumps(payload, indent=2)}")
-        response = automatic_session.post(
-            f"{REACTOR_URL}/image",
-            json=payload,
-            headers={"accept": "application/json", "Content-Type": "application/json"},
-            timeout=600
-        )
-        print(f"Face swap response: Status={response.status_code}, Body={response.text}")
+        # Reuse the source face analysis across swaps of the same source image
+        if (input_data.get("cache_source_face", True) and payload["select_source"] == 0
+                and not payload["face_model"] and payload["source_faces_index"] == [0]):
+            face_model = source_face_model_for(source_image)
+            if face_model:
+                payload["select_source"] = 1
+                payload["face_model"] = face_model
+
+        print(f"Attempting face swap request to {backend()['reactor']}/image with payload: {json.dumps(summarize_payload(payload))}")
+        try:
+            response = automatic_session.post(
+                f"{backend()['reactor']}/image",
+                json=payload,
+                headers={"accept": "application/json", "Content-Type": "application/json"},
+                timeout=request_timeout()
+            )
+        except Exception:
+            invalidate_reactor_probe()
+            raise
+        if response.status_code >= 500:
+            invalidate_reactor_probe()
+        print(f"Face swap response: {summarize_response(response)}")
         if response.status_code != 200:
             raise Exception(f"Failed to perform face swap: {response.text}")
-        return response.json()
+        with metrics.phase("decode"):
+            return decode_response(response)
     else:
         # Fallback to built-in WebUI API
         print("Falling back to ReActor built-in WebUI API...")
@@ -498,19 +1927,38 @@ def face_swap_handler(input_data):
         if "scheduler" in input_data:
             payload["scheduler"] = input_data["scheduler"]
 
-        print(f"Attempting face swap via txt2img with ReActor script: {json.dumps(payload, indent=2)}")
-        response = automatic_session.post(f"{LOCAL_URL}/txt2img", json=payload, timeout=600)
-        print(f"Face swap response (built-in API): Status={response.status_code}, Body={response.text}")
+        print(f"Attempting face swap via txt2img with ReActor script: {json.dumps(summarize_payload(payload))}")
+        response = automatic_session.post(f"{backend()['api']}/txt2img", json=payload, timeout=request_timeout())
+        print(f"Face swap response (built-in API): {summarize_response(response)}")
         if response.status_code != 200:
             raise Exception(f"Failed to perform face swap (built-in API): {response.text}")
-        return response.json()
-
-def inference_handler(input_data):
-    """Handle image generation with flexible parameters."""
-    model_name = input_data.get("model_name")
-    if model_name:
-        set_model(model_name)
-
+        with metrics.phase("decode"):
+            return decode_response(response)
+
+def face_swap_batch_handler(input_data):
+    """Swap one source face onto many target images, analyzing the source face only once."""
+    target_images = input_data.get("target_images") or []
+    if not input_data.get("source_image") or not target_images:
+        raise ValueError("Both source_image and target_images are required")
+
+    # Fetch every URL input up front and concurrently instead of one per swap
+    resolved = resolve_face_swap_inputs(input_data, [input_data["source_image"]] + target_images)
+    item_input = {key: value for key, value in input_data.items() if key != "target_images"}
+    item_input["source_image"] = resolved[0]
+    item_input["presize_inputs"] = False
+    target_images = resolved[1:]
+    results = []
+    for index, target_image in enumerate(target_images):
+        try:
+            result = face_swap_handler({**item_input, "target_image": target_image})
+            result = apply_outputs(result, input_data.get("output"))
+            results.append({"index": index, "status": "ok", **result})
+        except Exception as e:
+            results.append({"index": index, "status": "error", "error": str(e)})
+    return {"results": results}
+
+def build_txt2img_request(input_data):
+    """Build the WebUI txt2img request for an inference job."""
     override_settings = input_data.get("override_settings", {})
 
     inference_request = {
@@ -535,51 +1983,900 @@ def inference_handler(input_data):
         inference_request["hr_second_pass_steps"] = input_data.get("hr_second_pass_steps", 20)
         inference_request["denoising_strength"] = input_data.get("denoising_strength", 0.55)
 
-    response = automatic_session.post(f"{LOCAL_URL}/txt2img", json=inference_request, timeout=600)
+    return inference_request
+
+def cost_model_key(model_name):
+    """Name the checkpoint a generation runs on for the cost model, defaulting to the loaded one."""
+    if not model_name:
+        model_name = strip_checkpoint_hash((backend()["options"] or {}).get("sd_model_checkpoint") or "")
+    return os.path.splitext(model_name)[0] or None
+
+def estimate_seconds(input_data):
+    """Predict a generation's GPU time from the cost model fitted on this worker's observed timings."""
+    seconds, _ = cost_model.predict(
+        cost_model_key(input_data.get("model_name")),
+        input_data.get("sampler_name", "DPM++ 2M"),
+        cost_model.work_units(input_data)
+    )
+    return seconds
+
+def generation_jobs(input_data):
+    """Return the generations a job will run, or an empty list for actions that do not generate."""
+    action = input_data.get("action", "inference")
+    if action in ("inference", "img2img", "face_swap"):
+        return [input_data]
+    if action == "face_swap_batch":
+        return [input_data] * len(input_data.get("target_images") or [])
+    if action == "batch":
+        return input_data.get("jobs") or []
+    return []
+
+def job_deadline(input_data):
+    """Return a job's explicit time budget in seconds, or None without one."""
+    if input_data.get("deadline"):
+        return float(input_data["deadline"])
+    return None
+
+def generation_budget(model_name, request):
+    """Return the derived time budget of one generation call from its predicted runtime."""
+    seconds, _ = cost_model.predict(cost_model_key(model_name), request.get("sampler_name"), cost_model.work_units(request))
+    return min(DEADLINE_MAX, DEADLINE_BASE + DEADLINE_FACTOR * seconds)
+
+def start_job(input_data):
+    """Route a job to a backend and create the state that carries its backend, deadline, priority and estimate."""
+    jobs = generation_jobs(input_data)
+    # Everything that can reject the input runs before a backend counts the job as in flight
+    priority = float(input_data.get("priority", 0))
+    deadline = job_deadline(input_data)
+    estimate = sum(estimate_seconds(job) for job in jobs)
+    return {
+        "backend": select_backend(input_data) if jobs else None,
+        "deadline": time_module.monotonic() + deadline if deadline else None,
+        "explicit_deadline": bool(input_data.get("deadline")),
+        "priority": priority,
+        "estimate": estimate
+    }
+
+def end_job(job):
+    """Release the backend a job was routed to and the models it kept from eviction."""
+    if job["backend"] is not None:
+        release_backend(job["backend"])
+    release_job_models(job)
+
+def acquire_generation(timeout=None):
+    """Wait for the generation slot in priority order, returning False if the timeout passes first."""
+    owner = threading.get_ident()
+    job = current_job.get() or {}
+    slot = backend()["slot"]
+    slot_cond = backend()["slot_cond"]
+    with slot_cond:
+        if slot["owner"] == owner:
+            slot["depth"] += 1
+            return True
+        waiting = slot["waiting"]
+        slot["seq"] += 1
+        entry = [-job.get("priority", 0), slot["seq"], job.get("estimate", 0)]
+        heapq.heappush(waiting, entry)
+        give_up = None if timeout is None else time_module.monotonic() + timeout
+        while slot["owner"] is not None or waiting[0] is not entry:
+            left = None if give_up is None else give_up - time_module.monotonic()
+            if left is not None and left <= 0:
+                waiting.remove(entry)
+                heapq.heapify(waiting)
+                slot_cond.notify_all()
+                return False
+            slot_cond.wait(left)
+        heapq.heappop(waiting)
+        slot.update(owner=owner, depth=1, running={"started": time_module.monotonic(), "estimate": entry[2]})
+        slot_cond.notify_all()
+        return True
+
+def release_generation():
+    """Release one hold on the generation slot, waking the next job when it is free."""
+    slot = backend()["slot"]
+    with backend()["slot_cond"]:
+        slot["depth"] -= 1
+        if slot["depth"] == 0:
+            slot.update(owner=None, running=None)
+            backend()["slot_cond"].notify_all()
+
+@contextmanager
+def hold_generation(timeout=None):
+    """Hold the generation slot for a block, raising TimeoutError if it cannot be had in time."""
+    with metrics.phase("queue_wait"):
+        acquired = acquire_generation(timeout)
+    if not acquired:
+        raise TimeoutError("Job deadline passed while waiting for the GPU")
+    try:
+        yield
+    finally:
+        release_generation()
+
+def queue_seconds(priority=0):
+    """Predict how long a job of the given priority waits for the GPU: the running job's rest plus jobs ahead of it."""
+    slot = backend()["slot"]
+    with backend()["slot_cond"]:
+        seconds = sum(entry[2] for entry in slot["waiting"] if -entry[0] >= priority)
+        running = slot["running"]
+        if running:
+            seconds += max(0, running["estimate"] - (time_module.monotonic() - running["started"]))
+    return seconds
+
+def forecast_job(input_data):
+    """Predict queue wait, checkpoint switches and generation time for a job without running it."""
+    jobs = generation_jobs(input_data)
+    loaded = (backend()["options"] or {}).get("sd_model_checkpoint")
+    switches = [name for name in dict.fromkeys(job.get("model_name") for job in jobs) if name and not checkpoint_matches(loaded, name)]
+    generation = sum(estimate_seconds(job) for job in jobs)
+    switch = sum(cost_model.predict_switch(cost_model_key(name)) for name in switches)
+    queue = queue_seconds(float(input_data.get("priority", 0)))
+    return {
+        "queue_seconds": round(queue, 3),
+        "switch_seconds": round(switch, 3),
+        "generation_seconds": round(generation, 3),
+        "total_seconds": round(queue + switch + generation, 3),
+        "work_units": round(sum(cost_model.work_units(job) for job in jobs), 3),
+        "model_switches": len(switches)
+    }
+
+def downgrade_job(input_data, budget):
+    """Cheapen an inference/img2img job to fit a generation time budget: drop hires fix, then steps."""
+    downgraded = dict(input_data)
+    changes = {}
+    if downgraded.get("enable_hr") and estimate_seconds(downgraded) > budget:
+        downgraded["enable_hr"] = False
+        changes["enable_hr"] = [True, False]
+    steps = int(downgraded.get("steps", 20))
+    estimate = estimate_seconds(downgraded)
+    # Scale steps down proportionally; the fixed per-job overhead can take a second pass
+    while estimate > budget and int(downgraded.get("steps", 20)) > MIN_DOWNGRADE_STEPS:
+        downgraded["steps"] = max(MIN_DOWNGRADE_STEPS, min(int(downgraded.get("steps", 20)) - 1, int(int(downgraded.get("steps", 20)) * budget / estimate)))
+        estimate = estimate_seconds(downgraded)
+    if downgraded.get("steps", 20) != steps:
+        changes["steps"] = [steps, downgraded["steps"]]
+    if not changes or estimate > budget:
+        return None, None
+    return downgraded, changes
+
+def admit_job(input_data):
+    """Reject or downgrade a generation whose predicted completion misses its explicit deadline."""
+    job = current_job.get()
+    if not job or not job["explicit_deadline"]:
+        return input_data, None
+    remaining = remaining_time()
+    forecast = forecast_job(input_data)
+    if forecast["total_seconds"] <= remaining:
+        return input_data, None
+
+    policy = input_data.get("on_overload", OVERLOAD_POLICY)
+    if policy == "downgrade" and input_data.get("action", "inference") in ("inference", "img2img"):
+        downgraded, changes = downgrade_job(input_data, remaining - forecast["queue_seconds"] - forecast["switch_seconds"])
+        if downgraded is not None:
+            print(f"Downgraded job to meet its deadline: {json.dumps(changes)}")
+            metrics.increment("worker_admission_total", decision="downgraded")
+            job["estimate"] = estimate_seconds(downgraded)
+            return downgraded, changes
+    metrics.increment("worker_admission_total", decision="rejected")
+    raise Exception(f"Job rejected: predicted completion in {forecast['total_seconds']}s exceeds the {round(remaining, 3)}s deadline ({json.dumps(forecast)})")
+
+def estimate_job(input_data):
+    """Predict a job's runtime and whether it would be admitted, without running it."""
+    job = input_data.get("job") or {key: value for key, value in input_data.items() if key != "action"}
+    job.setdefault("action", "inference")
+    forecast = forecast_job(job)
+    deadline = job_deadline(job)
+    forecast["deadline_seconds"] = deadline
+    forecast["admitted"] = deadline is None or forecast["total_seconds"] <= deadline
+    forecast["cost_model"] = cost_model.snapshot()
+    return forecast
+
+def remaining_time():
+    """Return the seconds left before the current job's deadline, or None without one."""
+    job = current_job.get()
+    if job is None or job["deadline"] is None:
+        return None
+    return job["deadline"] - time_module.monotonic()
+
+def request_timeout(default=600, remaining=None):
+    """Return an HTTP timeout that does not outlive the current job's deadline, or the given budget, by more than the interrupt grace."""
+    if remaining is None:
+        remaining = remaining_time()
+    if remaining is None:
+        return default
+    return max(1, min(default, remaining + INTERRUPT_GRACE))
+
+def interrupt_generation(generation_id=None):
+    """Ask WebUI to stop the running generation, only if it is still the given one."""
+    if generation_id is not None and backend()["active"]["id"] != generation_id:
+        return False
+    try:
+        response = automatic_session.post(f"{backend()['api']}/interrupt", timeout=10)
+        print(f"Interrupted generation: {response.status_code}")
+        return response.status_code == 200
+    except Exception as e:
+        print(f"Failed to interrupt generation: {str(e)}")
+        return False
+
+def interrupt_backends():
+    """Interrupt whatever is generating on every backend, reporting per backend when there are several."""
+    results = [(selected, result is True) for selected, result in for_each_backend(interrupt_generation, include_unhealthy=True)]
+    if len(results) == 1:
+        return {"interrupted": results[0][1]}
+    return {
+        "interrupted": any(interrupted for _, interrupted in results),
+        "backends": [{"url": selected["url"], "interrupted": interrupted} for selected, interrupted in results]
+    }
+
+def skip_generation():
+    """Ask WebUI to skip the image it is sampling and move on to the next one."""
+    response = automatic_session.post(f"{backend()['api']}/skip", timeout=10)
+    if response.status_code != 200:
+        raise Exception(f"Failed to skip: {response.text}")
+    return {"status": "skipped"}
+
+def run_generation(endpoint, model_name, inference_request):
+    """Switch to the requested checkpoint and POST a generation while holding the generation lock.
+
+    Returns the response and whether the job's deadline interrupted it, in which case the images are partial.
+    """
+    remaining = remaining_time()
+    with metrics.phase("queue_wait"):
+        acquired = acquire_generation(max(0, remaining) if remaining is not None else None)
+    if not acquired:
+        raise TimeoutError("Job deadline passed while waiting for the GPU")
+    generation_id = object()
+    watchdog = None
+    interrupted = threading.Event()
+    selected = backend()
+
+    def on_deadline():
+        # Timer threads do not inherit the job's context
+        with use_backend(selected):
+            if interrupt_generation(generation_id):
+                interrupted.set()
+    try:
+        if model_name:
+            started = time_module.perf_counter()
+            with metrics.phase("set_model"):
+                switched = set_model(model_name)
+            if switched:
+                cost_model.observe_switch(cost_model_key(model_name), time_module.perf_counter() - started)
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError("Job deadline passed before generation started")
+        if remaining is None:
+            # Without an explicit deadline only the generation itself is bounded, starting now
+            remaining = generation_budget(model_name, inference_request)
+        # WebUI answers an interrupt by finishing the current step and returning what it has
+        watchdog = threading.Timer(remaining, on_deadline)
+        watchdog.daemon = True
+        watchdog.start()
+        backend()["active"].update(id=generation_id, job=current_job.get())
+        started = time_module.perf_counter()
+        try:
+            response = automatic_session.post(f"{backend()['api']}/{endpoint}", json=inference_request, timeout=request_timeout(remaining=remaining))
+        except requests.exceptions.ConnectionError:
+            record_backend_health(selected, False)
+            raise
+        if response.status_code == 200 and not interrupted.is_set():
+            cost_model.observe(
+                cost_model_key(model_name),
+                inference_request.get("sampler_name"),
+                cost_model.work_units(inference_request),
+                time_module.perf_counter() - started
+            )
+    finally:
+        backend()["active"].update(id=None, job=None)
+        if watchdog is not None:
+            watchdog.cancel()
+        release_generation()
+    return response, interrupted.is_set()
+
+def mark_interrupted(result, interrupted):
+    """Flag a result cut short by its deadline so it is reported as partial and never cached."""
+    if interrupted:
+        metrics.increment("worker_interrupted_jobs_total")
+        result["interrupted"] = True
+    return result
+
+def run_txt2img(model_name, inference_request):
+    """Switch to the requested checkpoint and run txt2img while holding the generation lock."""
+    response, interrupted = run_generation("txt2img", model_name, inference_request)
     if response.status_code != 200:
         raise Exception(f"Failed to run inference: {response.text}")
-    return response.json()
+    with metrics.phase("decode"):
+        return mark_interrupted(decode_response(response), interrupted)
+
+def checkpoint_fingerprint(checkpoint):
+    """Identify the checkpoint file behind a filename or WebUI title by inode, size and mtime."""
+    if not checkpoint:
+        return None
+    name = strip_checkpoint_hash(checkpoint)
+    model_dir, extensions = directories["checkpoints"]
+    for candidate in [name] + [name + ext for ext in extensions]:
+        try:
+            stat = os.stat(os.path.join(model_dir, candidate))
+        except OSError:
+            continue
+        return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+    return None
+
+def model_fingerprints(request, options):
+    """Identify the LoRA, embedding and VAE files a request resolves to by inode, size and mtime."""
+    references = [reference for reference in model_references(request) if reference[0] != "checkpoints"]
+    vae = (request.get("override_settings") or {}).get("sd_vae") or options.get("sd_vae")
+    if vae and vae not in ("Automatic", "None"):
+        references.append(("vaes", vae))
+    text = f"{request.get('prompt', '')}\n{request.get('negative_prompt', '')}"
+    for filename in refresh_model_index("embeddings")["files"]:
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        if re.search(rf"(?<![\w-]){re.escape(stem)}(?![\w-])", text):
+            references.append(("embeddings", filename))
+
+    fingerprints = {}
+    for model_type, name in dict.fromkeys(references):
+        try:
+            stat = os.stat(os.path.join(directories[model_type][0], resolve_model_name(model_type, name)))
+            fingerprints[f"{model_type}/{name}"] = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+        except OSError:
+            fingerprints[f"{model_type}/{name}"] = None
+    return fingerprints
+
+def result_cache_key(kind, model_name, request):
+    """Return a canonical hash of a fully-resolved fixed-seed request, or None if it is not cacheable."""
+    if RESULT_CACHE_MAX_BYTES <= 0 or int(request.get("seed", -1)) == -1:
+        return None
+    options = backend()["options"]
+    if options is None:
+        options = sync_webui_state()
+        if options is None:
+            return None
+    checkpoint = model_name or options.get("sd_model_checkpoint")
+    fingerprint = checkpoint_fingerprint(checkpoint)
+    if fingerprint is None:
+        return None
+    state = {key: options.get(key) for key in RESULT_CACHE_OPTIONS}
+    state["sd_model_checkpoint"] = os.path.splitext(strip_checkpoint_hash(checkpoint))[0]
+    canonical = json.dumps([kind, fingerprint, model_fingerprints(request, options), state, request], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def load_result_cache():
+    """Build the in-memory LRU order of the result cache from the files on disk."""
+    global result_cache_entries
+    if result_cache_entries is None:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        entries = []
+        for name in os.listdir(RESULT_CACHE_DIR):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(RESULT_CACHE_DIR, name))
+                entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        result_cache_entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+    return result_cache_entries
+
+def result_cache_get(key):
+    """Return a cached result and mark it as recently used, or None on a miss."""
+    path = os.path.join(RESULT_CACHE_DIR, f"{key}.json")
+    with result_cache_lock:
+        entries = load_result_cache()
+        if key not in entries:
+            result_cache_stats["misses"] += 1
+            return None
+        try:
+            with open(path, "r") as f:
+                result = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            entries.pop(key, None)
+            result_cache_stats["misses"] += 1
+            return None
+        entries.move_to_end(key)
+        result_cache_stats["hits"] += 1
+        return result
+
+def result_cache_put(key, result):
+    """Store a result and evict least recently used entries until the cache fits its budget."""
+    path = os.path.join(RESULT_CACHE_DIR, f"{key}.json")
+    data = json.dumps(result)
+    with result_cache_lock:
+        entries = load_result_cache()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        entries[key] = len(data)
+        entries.move_to_end(key)
+        total = sum(entries.values())
+        while total > RESULT_CACHE_MAX_BYTES and len(entries) > 1:
+            old_key, old_size = entries.popitem(last=False)
+            try:
+                os.remove(os.path.join(RESULT_CACHE_DIR, f"{old_key}.json"))
+            except OSError:
+                pass
+            total -= old_size
+            result_cache_stats["evictions"] += 1
+
+def cached_generation(kind, model_name, request, compute):
+    """Serve fixed-seed requests from the result cache and coalesce identical in-flight requests."""
+    key = result_cache_key(kind, model_name, request)
+    if key is None:
+        return compute()
+    cached = result_cache_get(key)
+    if cached is not None:
+        return cached
+
+    flight, leader = join_generation(key)
+    if not leader:
+        flight["event"].wait()
+        return generation_outcome(flight)
+
+    try:
+        result = compute()
+        if not result.get("interrupted"):
+            result_cache_put(key, result)
+        flight["result"] = result
+        return result
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        finish_generation(key, flight)
+
+async def cached_generation_async(kind, model_name, request, compute):
+    """Like cached_generation for a coroutine compute, keeping every wait on the event loop.
+
+    Batched generations need an executor thread to flush, so no executor thread may block on one.
+    """
+    key = await asyncio.to_thread(result_cache_key, kind, model_name, request)
+    if key is None:
+        return await compute()
+    cached = await asyncio.to_thread(result_cache_get, key)
+    if cached is not None:
+        return cached
+
+    flight, leader = join_generation(key)
+    if not leader:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with result_cache_lock:
+            if flight["done"]:
+                future.set_result(None)
+            else:
+                flight["waiters"].append((loop, future))
+        await future
+        return generation_outcome(flight)
+
+    try:
+        result = await compute()
+        if not result.get("interrupted"):
+            await asyncio.to_thread(result_cache_put, key, result)
+        flight["result"] = result
+        return result
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        finish_generation(key, flight)
+
+def join_generation(key):
+    """Return the in-flight generation for a cache key and whether the caller has to run it."""
+    with result_cache_lock:
+        flight = inflight_generations.get(key)
+        if flight is not None:
+            result_cache_stats["coalesced"] += 1
+            return flight, False
+        flight = inflight_generations[key] = {"event": threading.Event(), "waiters": [], "done": False}
+        return flight, True
+
+def finish_generation(key, flight):
+    """Wake every thread and coroutine waiting on a finished generation."""
+    if "result" not in flight and "error" not in flight:
+        flight["error"] = Exception("Generation was cancelled")
+    with result_cache_lock:
+        inflight_generations.pop(key, None)
+        flight["done"] = True
+        waiters = flight["waiters"]
+    flight["event"].set()
+    for loop, future in waiters:
+        loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+def generation_outcome(flight):
+    """Return a finished generation's result or raise its error."""
+    if "error" in flight:
+        raise flight["error"]
+    return flight["result"]
+
+def get_result_cache():
+    """Report result cache counters and size."""
+    with result_cache_lock:
+        entries = load_result_cache()
+        size = sum(entries.values())
+        return {
+            **result_cache_stats,
+            "entries": len(entries),
+            "inflight": len(inflight_generations),
+            "size": format_size(size),
+            "size_bytes": size,
+            "max_size": format_size(RESULT_CACHE_MAX_BYTES)
+        }
+
+def inference_handler(input_data):
+    """Handle image generation with flexible parameters."""
+    model_name = input_data.get("model_name")
+    inference_request = build_txt2img_request(input_data)
+    return cached_generation("txt2img", model_name, inference_request, lambda: run_txt2img(model_name, inference_request))
+
+def batch_key(input_data):
+    """Return the key shared by txt2img jobs that can run as one batch, or None."""
+    if input_data.get("action", "inference") != "inference":
+        return None
+    request = build_txt2img_request(input_data)
+    request.pop("seed")
+    # A batch runs on one backend, so jobs routed to different backends never share one
+    return json.dumps([backend()["url"], input_data.get("model_name"), request], sort_keys=True, default=str)
+
+def split_seed_runs(jobs):
+    """Split batched jobs into groups that WebUI can generate with a single base seed."""
+    random_jobs = [job for job in jobs if int(job[0].get("seed", -1)) == -1]
+    seeded_jobs = sorted((job for job in jobs if int(job[0].get("seed", -1)) != -1), key=lambda job: int(job[0]["seed"]))
+
+    runs = [random_jobs[i:i + MAX_BATCH_SIZE] for i in range(0, len(random_jobs), MAX_BATCH_SIZE)]
+    run = []
+    for job in seeded_jobs:
+        # WebUI assigns seed, seed+1, ... to the images of a batch
+        if run and (int(job[0]["seed"]) != int(run[-1][0]["seed"]) + 1 or len(run) >= MAX_BATCH_SIZE):
+            runs.append(run)
+            run = []
+        run.append(job)
+    if run:
+        runs.append(run)
+    return runs
+
+def split_batch_result(result, count):
+    """Split a batched txt2img response into one response per image."""
+    images = result.get("images", [])
+    if len(images) == count + 1:
+        images = images[1:]  # Drop the grid WebUI prepends to multi-image batches
+    if len(images) != count:
+        raise Exception(f"Batched txt2img returned {len(images)} images for {count} jobs")
+
+    try:
+        info = json.loads(result.get("info") or "{}")
+    except ValueError:
+        info = {}
+
+    results = []
+    for index in range(count):
+        item_info = {}
+        for key, value in info.items():
+            item_info[key] = [value[index]] if isinstance(value, list) and len(value) == count else value
+        if "all_seeds" in info and len(info["all_seeds"]) == count:
+            item_info["seed"] = info["all_seeds"][index]
+        if "all_subseeds" in info and len(info["all_subseeds"]) == count:
+            item_info["subseed"] = info["all_subseeds"][index]
+        item_info["batch_size"] = 1
+        item_info["index_of_first_image"] = 0
+
+        parameters = dict(result.get("parameters") or {})
+        parameters["batch_size"] = 1
+        if "seed" in item_info:
+            parameters["seed"] = item_info["seed"]
+
+        item = {
+            "images": [images[index]],
+            "parameters": parameters,
+            "info": json.dumps(item_info)
+        }
+        if result.get("interrupted"):
+            item["interrupted"] = True
+        results.append(item)
+    return results
+
+def run_txt2img_batch(jobs):
+    """Run a group of compatible txt2img jobs as one WebUI call and return per-job results."""
+    input_data = jobs[0][0]
+    inference_request = build_txt2img_request(input_data)
+    if len(jobs) == 1:
+        # Fixed-seed jobs were already looked up in the result cache before they queued
+        return [run_txt2img(input_data.get("model_name"), inference_request)]
+
+    inference_request["batch_size"] = len(jobs)
+    inference_request["do_not_save_grid"] = True
+    print(f"Running {len(jobs)} txt2img jobs as one batch")
+    result = run_txt2img(input_data.get("model_name"), inference_request)
+    return split_batch_result(result, len(jobs))
+
+def job_context():
+    """Capture the current job's phase timings and span so work shared with other jobs can be attributed to it."""
+    return {"timings": metrics.current_timings.get(), "span": tracing.current_span.get()}
+
+def run_for_jobs(contexts, function, *args):
+    """Run work shared by several jobs, adding its phase timings and spans to every one of them."""
+    timings = {}
+    metrics.current_timings.set(timings)
+    traced = [context["span"] for context in contexts if context["span"] is not None]
+    shared = tracing.new_span("batch", {"jobs": len(contexts)}) if traced else None
+    tracing.current_span.set(shared)
+    try:
+        return function(*args)
+    except Exception as e:
+        if shared is not None:
+            shared["error"] = f"{type(e).__name__}: {str(e)}"
+        raise
+    finally:
+        for context in contexts:
+            if context["timings"] is not None:
+                for name, seconds in timings.items():
+                    context["timings"][name] = round(context["timings"].get(name, 0) + seconds, 4)
+        if shared is not None:
+            shared["duration"] = round(time.perf_counter() - shared["start"], 6)
+            for span in traced:
+                span["children"].append(copy.deepcopy(shared))
+
+async def flush_batch(key):
+    """Run every job queued under a batch key and resolve their futures."""
+    jobs = pending_batches.pop(key, None)
+    if not jobs:
+        return
+    for run in split_seed_runs(jobs):
+        try:
+            # The batch would otherwise run in the context of whichever job opened the window
+            results = await asyncio.to_thread(run_for_jobs, [context for _, _, context in run], run_txt2img_batch, run)
+        except Exception as e:
+            for _, future, _ in run:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        for (_, future, _), result in zip(run, results):
+            if not future.done():
+                future.set_result(result)
+
+async def submit_txt2img(key, input_data):
+    """Queue a txt2img job for the current batching window and wait for its result."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    jobs = pending_batches.get(key)
+    if jobs is None:
+        jobs = pending_batches[key] = []
+        loop.call_later(BATCH_WINDOW, lambda: asyncio.ensure_future(flush_batch(key)))
+    jobs.append((input_data, future, job_context()))
+    if len(jobs) >= MAX_BATCH_SIZE:
+        asyncio.ensure_future(flush_batch(key))
+    return await future
+
+def presize_mode(input_data, default):
+    """Return how inputs should be pre-sized for a job, or None to send them as given."""
+    if not input_data.get("presize_inputs", inputs.PRESIZE_INPUTS):
+        return None
+    return default
 
 def img2img_handler(input_data):
     """Handle image-to-image generation."""
     model_name = input_data.get("model_name")
-    if model_name:
-        set_model(model_name)
+    width = input_data.get("width", 512)
+    height = input_data.get("height", 512)
+
+    # WebUI resizes inputs to width x height itself for resize modes 0 and 1, so doing it here first only saves bytes
+    resize_mode = input_data.get("resize_mode", 0)
+    mode = presize_mode(input_data, {0: "resize", 1: "crop"}.get(resize_mode))
+    init_images = input_data.get("init_images", [])
+    mask = input_data.get("mask")
+    resolved = inputs.resolve_images(init_images + ([mask] if mask else []), width, height, mode)
 
     inference_request = {
-        "init_images": input_data.get("init_images", []),
+        "init_images": resolved[:len(init_images)],
         "prompt": input_data.get("prompt", ""),
         "negative_prompt": input_data.get("negative_prompt", ""),
         "steps": input_data.get("steps", 20),
-        "width": input_data.get("width", 512),
-        "height": input_data.get("height", 512),
+        "width": width,
+        "height": height,
         "cfg_scale": input_data.get("cfg_scale", 7.5),
         "seed": input_data.get("seed", -1),
         "denoising_strength": input_data.get("denoising_strength", 0.75),
         "sampler_name": input_data.get("sampler_name", "DPM++ 2M"),
     }
 
+    if "resize_mode" in input_data:
+        inference_request["resize_mode"] = resize_mode
+
+    if mask:
+        inference_request["mask"] = resolved[-1]
+        for key in ("mask_blur", "inpainting_fill", "inpaint_full_res", "inpaint_full_res_padding", "inpainting_mask_invert"):
+            if key in input_data:
+                inference_request[key] = input_data[key]
+
     if "scheduler" in input_data:
         inference_request["scheduler"] = input_data["scheduler"]
 
-    response = automatic_session.post(f"{LOCAL_URL}/img2img", json=inference_request, timeout=600)
+    if "override_settings" in input_data:
+        inference_request["override_settings"] = input_data["override_settings"]
+
+    return cached_generation("img2img", model_name, inference_request, lambda: run_img2img(model_name, inference_request))
+
+def run_img2img(model_name, inference_request):
+    """Switch to the requested checkpoint and run img2img while holding the generation lock."""
+    response, interrupted = run_generation("img2img", model_name, inference_request)
     if response.status_code != 200:
         raise Exception(f"Failed to run img2img: {response.text}")
-    return response.json()
+    with metrics.phase("decode"):
+        return mark_interrupted(decode_response(response), interrupted)
+
+def batch_group_key(job):
+    """Return the checkpoint and VAE a batch sub-job needs loaded."""
+    override_settings = job.get("override_settings") or {}
+    return (job.get("model_name"), override_settings.get("sd_vae"))
+
+def schedule_batch(jobs):
+    """Order batch sub-jobs so each checkpoint/VAE group runs back-to-back with one switch.
+
+    Groups with a higher "priority" hint run first; otherwise the group for the
+    loaded checkpoint goes first, then groups in order of first appearance.
+    """
+    options = backend()["options"] or {}
+    groups = OrderedDict()
+    for index, job in enumerate(jobs):
+        groups.setdefault(batch_group_key(job), []).append(index)
+
+    def group_order(item):
+        (model_name, _), indices = item
+        loaded = model_name is None or checkpoint_matches(options.get("sd_model_checkpoint"), model_name)
+        return (-max(float(jobs[index].get("priority", 0)) for index in indices), 0 if loaded else 1, indices[0])
+
+    schedule = []
+    for key, indices in sorted(groups.items(), key=group_order):
+        indices.sort(key=lambda index: (-float(jobs[index].get("priority", 0)), index))
+        schedule.append((key, indices))
+    return schedule
+
+def run_batch_item(job, output):
+    """Run one batch sub-job and return its result with outputs applied."""
+    action = job.get("action", "inference")
+    if action == "inference":
+        result = inference_handler(job)
+    elif action == "img2img":
+        result = img2img_handler(job)
+    else:
+        raise ValueError(f"Unsupported batch action: {action}")
+    return apply_outputs(result, job.get("output", output))
+
+def batch_handler(input_data):
+    """Run a list of inference/img2img sub-jobs grouped by checkpoint to minimize model switches."""
+    jobs = input_data.get("jobs") or []
+    if not jobs:
+        raise ValueError("jobs is required for batch")
+    output = input_data.get("output")
+    results = [None] * len(jobs)
+    order = []
+    switches = 0
+
+    # Fetch missing models for every sub-job in one concurrent pass; failures surface per item at set_model
+    references = [reference for job in jobs for reference in model_references(job)]
+    record_model_demand(references)
+    hold_job_models(list(dict.fromkeys(references)))
+    errors = hydrate_models(list(dict.fromkeys(references)))
+    if errors:
+        print(f"Failed to fetch models for batch: {json.dumps(errors)}")
+    for index, job in enumerate(jobs):
+        problems = check_job_models(job)
+        if problems:
+            metrics.increment("worker_admission_total", decision="incompatible")
+            results[index] = {"index": index, "status": "error", "model_name": job.get("model_name"), "error": f"Job rejected: {'; '.join(problems)}"}
+
+    for (model_name, _), indices in schedule_batch(jobs):
+        indices = [index for index in indices if results[index] is None]
+        if not indices:
+            continue
+        # A group that cannot get the GPU before the deadline fails the batch instead of running late
+        remaining = remaining_time()
+        with hold_generation(timeout=max(0, remaining) if remaining is not None else None):
+            options = backend()["options"] or {}
+            if model_name and not checkpoint_matches(options.get("sd_model_checkpoint"), model_name):
+                switches += 1
+
+            # Identical txt2img requests that differ only by seed still go out as one WebUI batch
+            runs = OrderedDict()
+            for index in indices:
+                key = batch_key(jobs[index]) if MAX_BATCH_SIZE > 1 else None
+                runs.setdefault(key or index, []).append((jobs[index], index))
+
+            for members in runs.values():
+                for run in split_seed_runs(members) if len(members) > 1 else [members]:
+                    order.extend(index for _, index in run)
+                    try:
+                        if len(run) > 1:
+                            run_results = [apply_outputs(result, job.get("output", output)) for (job, _), result in zip(run, run_txt2img_batch(run))]
+                        else:
+                            run_results = [run_batch_item(run[0][0], output)]
+                        for (_, index), result in zip(run, run_results):
+                            results[index] = {"index": index, "status": "ok", "model_name": model_name, **result}
+                    except Exception as e:
+                        for _, index in run:
+                            results[index] = {"index": index, "status": "error", "model_name": model_name, "error": str(e)}
+
+    return {"results": results, "order": order, "model_switches": switches}
+
+def note_downgrade(result, changes):
+    """Report the settings admission control lowered to meet the deadline."""
+    if not changes:
+        return result
+    return {**result, "downgraded": changes}
+
+def apply_outputs(result, options):
+    """Run the output pipeline as its own timed phase."""
+    if not options:
+        return result
+    with metrics.phase("output"):
+        return process_outputs(result, options)
+
+def get_metrics():
+    """Return worker metrics in the Prometheus text format."""
+    return {"format": "prometheus", "metrics": metrics.render_prometheus()}
+
+def finish_job(action, input_data, result, timings):
+    """Count response bytes and attach per-job phase timings to generation results."""
+    metrics.increment("worker_payload_bytes_total", metrics.payload_size(result), action=action, direction="out")
+    if isinstance(result, dict) and (action in ("inference", "img2img", "face_swap", "face_swap_batch", "batch") or input_data.get("timings")):
+        result = {**result, "timings": timings}
+    return result
 
 def handler(event):
     """Main handler function to route actions."""
     input_data = event["input"]
     action = input_data.get("action", "inference")
+    with tracing.trace(action, event.get("id"), input_data.get("trace")):
+        track_activity(1)
+        job = None
+        token = current_job.set(None)
+        backend_token = current_backend.set(None)
+        try:
+            with metrics.job(action, metrics.payload_size(input_data)) as timings:
+                job = dispatch_job(input_data)
+                current_job.set(job)
+                current_backend.set(job["backend"])
+                result = route_action(input_data)
+        finally:
+            current_backend.reset(backend_token)
+            current_job.reset(token)
+            if job is not None:
+                end_job(job)
+            track_activity(-1)
+        return finish_job(action, input_data, result, timings)
+
+def dispatch_job(input_data):
+    """Start a job as a traced span, recording the backend, deadline and estimate it was given."""
+    with tracing.span("dispatch") as span:
+        job = start_job(input_data)
+        if span is not None:
+            span["attributes"].update(
+                backend=job["backend"]["url"] if job["backend"] else None,
+                deadline_seconds=round(job["deadline"] - time_module.monotonic(), 3) if job["deadline"] else None,
+                estimate_seconds=round(job["estimate"], 3)
+            )
+    return job
+
+def route_action(input_data):
+    """Route an action to its implementation."""
+    action = input_data.get("action", "inference")
+
+    downgraded = None
+    if action in ("inference", "img2img"):
+        hydrate_job(input_data)
+    if action in ("inference", "img2img", "batch"):
+        input_data, downgraded = admit_job(input_data)
 
     if action == "inference":
-        return inference_handler(input_data)
+        return note_downgrade(apply_outputs(inference_handler(input_data), input_data.get("output")), downgraded)
     elif action == "img2img":
-        return img2img_handler(input_data)
+        return note_downgrade(apply_outputs(img2img_handler(input_data), input_data.get("output")), downgraded)
     elif action == "face_swap":
-        return face_swap_handler(input_data)
+        return apply_outputs(face_swap_handler(input_data), input_data.get("output"))
+    elif action == "face_swap_batch":
+        return face_swap_batch_handler(input_data)
+    elif action == "batch":
+        return batch_handler(input_data)
     elif action == "get_models":
-        return get_models()
+        return get_models(input_data)
+    elif action == "inspect_model":
+        return inspect_model(input_data)
     elif action == "get_sd_models":
         return get_sd_models()
     elif action == "get_samplers":
@@ -589,9 +2886,35 @@ def handler(event):
     elif action == "get_options":
         return get_options()
     elif action == "set_options":
-        return set_options(input_data.get("options", {}))
+        return set_backend_options(input_data.get("options", {}))
+    elif action == "get_backends":
+        return get_backends()
+    elif action == "get_residency":
+        return get_residency()
+    elif action == "get_traces":
+        return tracing.get_traces(input_data)
     elif action == "get_progress":
         return get_progress()
+    elif action == "estimate":
+        return estimate_job(input_data)
+    elif action == "interrupt":
+        return interrupt_backends()
+    elif action == "skip":
+        return skip_generation()
+    elif action == "get_metrics":
+        return get_metrics()
+    elif action == "get_startup":
+        return get_startup()
+    elif action == "get_result_cache":
+        return get_result_cache()
+    elif action == "get_model_registry":
+        return get_model_registry()
+    elif action == "get_disk_budget":
+        return get_disk_budget()
+    elif action == "pin_models":
+        return pin_models(input_data.get("models", []), input_data.get("pinned", True))
+    elif action == "register_models":
+        return register_models(input_data.get("models", []))
     elif action == "download_model":
         return download_model(input_data)
     elif action == "install_all":
@@ -613,7 +2936,7 @@ def handler(event):
             raise ValueError("extension_name is required for delete_extension")
         return delete_extension(extension_name)
     elif action == "restart_server":
-        return restart_server()
+        return restart_backends(restart_and_wait if input_data.get("wait", False) else restart_server)
     elif action == "refresh_models":
         model_type = input_data.get("type")
         if model_type:
@@ -636,7 +2959,141 @@ def handler(event):
     else:
         raise ValueError(f"Unknown action: {action}")
 
+async def async_handler(event, dispatched=None):
+    """Concurrent handler that micro-batches compatible txt2img jobs.
+
+    dispatched, when given, receives the job state under "job" once the job is routed to a backend.
+    """
+    input_data = event["input"]
+    action = input_data.get("action", "inference")
+    with tracing.trace(action, event.get("id"), input_data.get("trace")):
+        track_activity(1)
+        job = None
+        token = current_job.set(None)
+        backend_token = current_backend.set(None)
+        try:
+            with metrics.job(action, metrics.payload_size(input_data)) as timings:
+                job = dispatch_job(input_data)
+                current_job.set(job)
+                current_backend.set(job["backend"])
+                if dispatched is not None:
+                    dispatched["job"] = job
+                result = await run_async_job(input_data)
+        except asyncio.CancelledError:
+            # RunPod cancelled the job; stop WebUI too if it is generating for this job
+            active = backend()["active"]
+            generation_id = active["id"]
+            if job is not None and generation_id is not None and active["job"] is job:
+                await asyncio.to_thread(interrupt_generation, generation_id)
+            raise
+        finally:
+            current_backend.reset(backend_token)
+            current_job.reset(token)
+            if job is not None:
+                end_job(job)
+            track_activity(-1)
+        return finish_job(action, input_data, result, timings)
+
+async def run_async_job(input_data):
+    """Run a job on the event loop, batching compatible txt2img jobs."""
+    key = batch_key(input_data) if BATCH_WINDOW > 0 and MAX_BATCH_SIZE > 1 else None
+    if key is None:
+        return await asyncio.to_thread(route_action, input_data)
+    await asyncio.to_thread(hydrate_job, input_data)
+    input_data, downgraded = await asyncio.to_thread(admit_job, input_data)
+    if downgraded:
+        key = batch_key(input_data)
+    if int(input_data.get("seed", -1)) == -1:
+        result = await submit_txt2img(key, input_data)
+    else:
+        # Fixed-seed jobs still batch, but go through the result cache first
+        model_name = input_data.get("model_name")
+        inference_request = build_txt2img_request(input_data)
+        compute = lambda: submit_txt2img(key, input_data)
+        result = await cached_generation_async("txt2img", model_name, inference_request, compute)
+
+    # Encoding runs outside the generation lock so it overlaps the next batch
+    if input_data.get("output"):
+        result = await asyncio.to_thread(apply_outputs, result, input_data["output"])
+    return note_downgrade(result, downgraded)
+
+async def stream_handler(event):
+    """Generator handler that yields progress events, then each image as its own chunk."""
+    input_data = event["input"]
+    action = input_data.get("action", "inference")
+    dispatched = {}
+    task = asyncio.ensure_future(async_handler(event, dispatched))
+
+    def poll_progress(selected, skip_current_image):
+        # Progress has to come from the backend running this job, not the stream's default one
+        with use_backend(selected):
+            return get_progress(skip_current_image)
+
+    if action in ("inference", "img2img", "face_swap"):
+        interval = float(input_data.get("progress_interval", PROGRESS_INTERVAL))
+        previews = bool(input_data.get("stream_previews", False))
+        last_step = None
+        while not task.done():
+            await asyncio.wait({task}, timeout=interval)
+            if task.done():
+                break
+            selected = (dispatched.get("job") or {}).get("backend")
+            if selected is None:
+                continue
+            try:
+                progress = await asyncio.to_thread(poll_progress, selected, not previews)
+            except Exception as e:
+                print(f"Failed to poll progress: {str(e)}")
+                continue
+            state = progress.get("state") or {}
+            step = (state.get("job_no"), state.get("sampling_step"))
+            if step == last_step:
+                continue
+            last_step = step
+            chunk = {
+                "type": "progress",
+                "progress": progress.get("progress"),
+                "eta_relative": progress.get("eta_relative"),
+                "step": state.get("sampling_step"),
+                "steps": state.get("sampling_steps"),
+                "job_no": state.get("job_no"),
+                "job_count": state.get("job_count")
+            }
+            if previews and progress.get("current_image"):
+                chunk["current_image"] = progress["current_image"]
+            yield chunk
+
+    result = await task
+    if not isinstance(result, dict) or not (result.get("images") or result.get("image")):
+        yield result
+        return
+
+    images = result.get("images") or [result["image"]]
+    for index, image in enumerate(images):
+        yield {"type": "image", "index": index, "image": image}
+    yield {"type": "result", **{key: value for key, value in result.items() if key not in ("images", "image")}}
+
+def concurrency_modifier(current_concurrency):
+    """Report how many jobs this worker accepts at once."""
+    return CONCURRENCY
+
 if __name__ == "__main__":
-    wait_for_service(url=f"{LOCAL_URL}/sd-models")
-    print("WebUI API Service is ready. Starting RunPod Serverless...")
-    runpod.serverless.start({"handler": handler})
+    run_startup()
+    threading.Thread(target=demand_save_loop, daemon=True).start()
+    if len(backends) > 1:
+        threading.Thread(target=health_loop, daemon=True).start()
+    if PREFETCH_TOP > 0:
+        threading.Thread(target=prefetch_loop, daemon=True).start()
+    if RESIDENCY_RAM_BYTES > 0:
+        threading.Thread(target=residency_loop, daemon=True).start()
+    print(f"WebUI API Service is ready. Starting RunPod Serverless... {json.dumps(get_startup())}")
+    if STREAM_MODE:
+        runpod.serverless.start({
+            "handler": stream_handler,
+            "concurrency_modifier": concurrency_modifier,
+            "return_aggregate_stream": True
+        })
+    elif CONCURRENCY > 1:
+        runpod.serverless.start({"handler": async_handler, "concurrency_modifier": concurrency_modifier})
+    else:
+        runpod.serverless.start({"handler": handler})
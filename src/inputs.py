@@ -0,0 +1,216 @@
+import os
+import io
+import json
+import base64
+import socket
+import hashlib
+import ipaddress
+from urllib.parse import urljoin, urlsplit
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+# Remote input fetching and caching settings
+INPUT_FETCH_WORKERS = int(os.environ.get("INPUT_FETCH_WORKERS", "8"))
+INPUT_FETCH_TIMEOUT = int(os.environ.get("INPUT_FETCH_TIMEOUT", "60"))
+INPUT_MAX_BYTES = int(os.environ.get("INPUT_MAX_BYTES", str(50 * 1024 * 1024)))
+INPUT_CACHE_DIR = os.environ.get("INPUT_CACHE_DIR", "/tmp/input-cache")
+INPUT_CACHE_MAX_BYTES = int(os.environ.get("INPUT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+PRESIZE_INPUTS = os.environ.get("PRESIZE_INPUTS", "0") == "1"
+# Input URLs resolving to loopback, private or link-local addresses are refused unless this is set
+ALLOW_PRIVATE_INPUTS = os.environ.get("ALLOW_PRIVATE_INPUTS", "0") == "1"
+INPUT_MAX_REDIRECTS = 5
+
+input_session = requests.Session()
+input_session.mount("http://", HTTPAdapter(pool_connections=INPUT_FETCH_WORKERS, pool_maxsize=INPUT_FETCH_WORKERS))
+input_session.mount("https://", HTTPAdapter(pool_connections=INPUT_FETCH_WORKERS, pool_maxsize=INPUT_FETCH_WORKERS))
+
+input_pool = None
+input_cache_lock = threading.Lock()
+
+def is_url(value):
+    """Return True when an image field holds a URL instead of inline base64."""
+    return isinstance(value, str) and value.startswith(("http://", "https://"))
+
+def get_input_pool():
+    """Return the thread pool used for fetching and resizing inputs."""
+    global input_pool
+    if input_pool is None:
+        input_pool = ThreadPoolExecutor(max_workers=INPUT_FETCH_WORKERS)
+    return input_pool
+
+def cache_paths(url):
+    """Return the data and metadata paths of a cached URL."""
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(INPUT_CACHE_DIR, f"{key}.bin"), os.path.join(INPUT_CACHE_DIR, f"{key}.json")
+
+def trim_input_cache():
+    """Delete the least recently used cached inputs until the cache fits its budget."""
+    with input_cache_lock:
+        entries = []
+        for name in os.listdir(INPUT_CACHE_DIR):
+            if name.endswith(".bin"):
+                path = os.path.join(INPUT_CACHE_DIR, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= INPUT_CACHE_MAX_BYTES:
+                break
+            for stale in (path, path[:-4] + ".json"):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+def check_input_host(url):
+    """Refuse input URLs whose host resolves to a loopback, private, link-local or reserved address."""
+    if ALLOW_PRIVATE_INPUTS:
+        return
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"Input {url} is not an http(s) URL")
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, parts.port or 443, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise ValueError(f"Input host {parts.hostname} does not resolve: {str(e)}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split("%", 1)[0])
+        if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast or ip.is_unspecified:
+            raise ValueError(f"Input host {parts.hostname} resolves to non-public address {ip}")
+
+def open_input(url, headers):
+    """GET an input URL, following redirects only to hosts that pass check_input_host."""
+    for _ in range(INPUT_MAX_REDIRECTS + 1):
+        check_input_host(url)
+        response = input_session.get(url, headers=headers, timeout=INPUT_FETCH_TIMEOUT, stream=True, allow_redirects=False)
+        if not response.is_redirect:
+            return response
+        location = response.headers.get("Location")
+        response.close()
+        url = urljoin(url, location)
+    raise Exception(f"Input {url} redirected more than {INPUT_MAX_REDIRECTS} times")
+
+def fetch_input(url):
+    """Fetch a remote input, revalidating a cached copy by ETag or Last-Modified."""
+    data_path, meta_path = cache_paths(url)
+    headers = {}
+    meta = None
+    if os.path.isfile(data_path) and os.path.isfile(meta_path):
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+    if meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with metrics.phase("fetch_input"):
+        response = open_input(url, headers)
+        try:
+            if response.status_code == 304 and meta:
+                with open(data_path, "rb") as f:
+                    data = f.read()
+                os.utime(data_path)
+                metrics.increment("worker_input_bytes_total", len(data), source="cache")
+                return data
+            if response.status_code != 200:
+                raise Exception(f"Failed to fetch input {url}: HTTP {response.status_code}")
+            length = response.headers.get("Content-Length")
+            if length and int(length) > INPUT_MAX_BYTES:
+                raise ValueError(f"Input {url} is {length} bytes, limit is {INPUT_MAX_BYTES}")
+            chunks = []
+            received = 0
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                received += len(chunk)
+                if received > INPUT_MAX_BYTES:
+                    raise ValueError(f"Input {url} exceeds {INPUT_MAX_BYTES} bytes")
+                chunks.append(chunk)
+            data = b"".join(chunks)
+        finally:
+            response.close()
+
+    metrics.increment("worker_input_bytes_total", len(data), source="fetch")
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag or last_modified:
+        # Only validatable responses are worth keeping
+        os.makedirs(INPUT_CACHE_DIR, exist_ok=True)
+        tmp_path = data_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, data_path)
+        with open(meta_path, "w") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "bytes": len(data)}, f)
+        trim_input_cache()
+    return data
+
+def presize_image(data, width, height, mode):
+    """Shrink an image the way WebUI would before it sees it, returning PNG bytes or None when unchanged.
+
+    mode "resize" stretches to width x height (WebUI resize_mode 0), "crop" scales to cover and
+    centre-crops (resize_mode 1), and "fit" scales down preserving the aspect ratio.
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    source_width, source_height = image.size
+    if source_width * source_height <= width * height:
+        return None  # Upscaling here would only add bytes
+
+    if mode == "resize":
+        image = image.resize((width, height), Image.LANCZOS)
+    elif mode == "crop":
+        ratio = max(width / source_width, height / source_height)
+        scaled_width, scaled_height = max(width, round(source_width * ratio)), max(height, round(source_height * ratio))
+        image = image.resize((scaled_width, scaled_height), Image.LANCZOS)
+        left, top = (scaled_width - width) // 2, (scaled_height - height) // 2
+        image = image.crop((left, top, left + width, top + height))
+    elif mode == "fit":
+        image.thumbnail((width, height), Image.LANCZOS)
+    else:
+        raise ValueError(f"Invalid presize mode: {mode}")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def resolve_image(value, width=None, height=None, mode=None):
+    """Turn a URL or base64 image into base64, pre-sized when a mode and size are given."""
+    if not value:
+        return value
+    if is_url(value):
+        data = fetch_input(value)
+    elif mode:
+        data = base64.b64decode(value.split(",", 1)[-1])
+    else:
+        return value
+
+    if mode and width and height:
+        with metrics.phase("presize_input"):
+            resized = presize_image(data, int(width), int(height), mode)
+        if resized is not None:
+            data = resized
+        elif not is_url(value):
+            return value
+    return base64.b64encode(data).decode()
+
+def resolve_images(values, width=None, height=None, mode=None):
+    """Resolve a list of image fields concurrently, fetching each distinct URL once."""
+    if not any(is_url(value) for value in values) and not mode:
+        return list(values)
+    distinct = list(dict.fromkeys(values))
+    # Copy the context so fetch phases land in the calling job's timings
+    futures = [get_input_pool().submit(contextvars.copy_context().run, resolve_image, value, width, height, mode) for value in distinct]
+    resolved = {value: future.result() for value, future in zip(distinct, futures)}
+    return [resolved[value] for value in values]
@@ -0,0 +1,165 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import requests
+import tracing
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# name -> {labels: value} for counters, name -> {labels: {"buckets", "sum", "count"}} for histograms
+counters = {}
+histograms = {}
+help_texts = {}
+metrics_lock = threading.Lock()
+
+# Phase timings of the job running in the current context
+current_timings = contextvars.ContextVar("current_timings", default=None)
+
+def describe(name, text):
+    """Set the HELP text of a metric."""
+    help_texts[name] = text
+
+def increment(name, value=1, **labels):
+    """Add to a counter."""
+    key = tuple(sorted(labels.items()))
+    with metrics_lock:
+        series = counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """Record a value in a histogram."""
+    key = tuple(sorted(labels.items()))
+    with metrics_lock:
+        series = histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+def record_phase(name, seconds):
+    """Record a phase duration globally and in the current job's timings."""
+    observe("worker_phase_duration_seconds", seconds, phase=name)
+    timings = current_timings.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0) + seconds, 4)
+
+@contextmanager
+def phase(name):
+    """Time a block as a named phase of the current job, and as a span when the job is traced."""
+    started = time.perf_counter()
+    try:
+        with tracing.span(name):
+            yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+@contextmanager
+def job(action, payload_bytes=0):
+    """Time a whole job, counting it and its errors per action, and collect its phase timings."""
+    timings = {}
+    token = current_timings.set(timings)
+    started = time.perf_counter()
+    increment("worker_jobs_total", action=action)
+    increment("worker_payload_bytes_total", payload_bytes, action=action, direction="in")
+    try:
+        yield timings
+    except Exception:
+        increment("worker_job_errors_total", action=action)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        timings["total"] = round(elapsed, 4)
+        observe("worker_job_duration_seconds", elapsed, action=action)
+        current_timings.reset(token)
+
+def payload_size(value):
+    """Approximate the serialized size of a JSON-like value without serializing it."""
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, dict):
+        return sum(len(str(key)) + 3 + payload_size(item) for key, item in value.items()) + 2
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(item) + 1 for item in value) + 2
+    return len(str(value))
+
+class TimedSession(requests.Session):
+    """Session that records the latency, status and bytes of every WebUI call."""
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = urlparse(url).path
+        started = time.perf_counter()
+        status = "error"
+        try:
+            with tracing.span(f"webui {method.upper()} {endpoint}") as span:
+                response = super().request(method, url, *args, **kwargs)
+                status = str(response.status_code)
+                increment("worker_webui_bytes_total", len(response.content or b""), direction="in")
+                if span is not None:
+                    # urllib3 keeps the attempts its Retry policy made before this response
+                    retries = getattr(getattr(response, "raw", None), "retries", None)
+                    history = getattr(retries, "history", None) or ()
+                    span["attributes"].update(status=response.status_code, bytes=len(response.content or b""), attempts=len(history) + 1)
+                    if history:
+                        span["attributes"]["retries"] = [{"status": attempt.status, "error": str(attempt.error) if attempt.error else None} for attempt in history]
+            return response
+        finally:
+            elapsed = time.perf_counter() - started
+            observe("worker_webui_request_duration_seconds", elapsed, endpoint=endpoint)
+            increment("worker_webui_requests_total", endpoint=endpoint, status=status)
+            if kwargs.get("json") is not None:
+                increment("worker_webui_bytes_total", payload_size(kwargs["json"]), direction="out")
+            record_phase(f"webui {method.upper()} {endpoint}", elapsed)
+
+def escape_label(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(key, extra=None):
+    """Format a label tuple in Prometheus syntax."""
+    labels = list(key) + (extra or [])
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+def render_prometheus():
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = []
+    with metrics_lock:
+        for name, series in sorted(counters.items()):
+            if name in help_texts:
+                lines.append(f"# HELP {name} {help_texts[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{format_labels(key)} {value}")
+        for name, series in sorted(histograms.items()):
+            if name in help_texts:
+                lines.append(f"# HELP {name} {help_texts[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in sorted(series.items()):
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{format_labels(key, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{format_labels(key, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{format_labels(key)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{format_labels(key)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+describe("worker_jobs_total", "Jobs handled per action.")
+describe("worker_job_errors_total", "Jobs that raised an error per action.")
+describe("worker_job_duration_seconds", "End-to-end job latency per action.")
+describe("worker_phase_duration_seconds", "Time spent in each phase of a job.")
+describe("worker_payload_bytes_total", "Approximate job payload bytes in and out per action.")
+describe("worker_webui_request_duration_seconds", "Latency of WebUI API calls per endpoint.")
+describe("worker_webui_requests_total", "WebUI API calls per endpoint and status.")
+describe("worker_webui_bytes_total", "Bytes sent to and received from the WebUI API.")
+describe("worker_input_bytes_total", "Bytes of URL job inputs fetched remotely or served from the input cache.")
+describe("worker_interrupted_jobs_total", "Generations interrupted at their deadline and returned as partial results.")
+describe("worker_admission_total", "Jobs downgraded or rejected because their predicted completion missed the deadline, or rejected for incompatible or corrupt models.")
+describe("worker_backend_ejections_total", "Times a WebUI backend was ejected after failing health checks.")
+describe("worker_checkpoint_switch_seconds", "Checkpoint switch latency by residency manager state and where the weights were likely loaded from.")
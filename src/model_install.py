@@ -0,0 +1,223 @@
+import os
+import re
+import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from download import download_file, probe_url
+import model_store
+
+# Concurrent downloads when installing a manifest
+MANIFEST_CONCURRENCY = int(os.environ.get("MANIFEST_CONCURRENCY", "4"))
+
+# Directory mappings for model types
+directories = {
+    "checkpoints": ("/stable-diffusion-webui/models/Stable-diffusion", [".safetensors", ".ckpt"]),
+    "loras": ("/stable-diffusion-webui/models/Lora", [".safetensors", ".pt"]),
+    "vaes": ("/stable-diffusion-webui/models/VAE", [".safetensors", ".pt"]),
+    "embeddings": ("/stable-diffusion-webui/embeddings", [".pt", ".bin", ".safetensors"]),
+}
+
+MODEL_EXTENSIONS = tuple(sorted({extension for _, extensions in directories.values() for extension in extensions}))
+
+# Map singular to plural model types
+model_type_mapping = {
+    "checkpoint": "checkpoints",
+    "lora": "loras",
+    "vae": "vaes",
+    "embedding": "embeddings"
+}
+
+def resolve_model_type(model_type):
+    """Map a singular or plural model type to its directories key."""
+    model_type = model_type_mapping.get(model_type, model_type)
+    if model_type not in directories:
+        raise ValueError(f"Invalid model type: {model_type}")
+    return model_type
+
+def prepare_model(entry):
+    """Resolve the type, headers, probe and target path of a model download."""
+    model_type = resolve_model_type(entry["type"])
+    dir_path, extensions = directories[model_type]
+
+    headers = {}
+    if entry.get("token"):
+        headers["Authorization"] = f"Bearer {entry['token']}"
+
+    probe = probe_url(entry["url"], headers)
+    filename = entry.get("filename")
+    if not filename:
+        filename = probe["filename"]
+        if not any(filename.endswith(ext) for ext in extensions):
+            raise ValueError(f"Extracted filename {filename} does not have a valid extension for {model_type}")
+
+    return {
+        **entry,
+        "type": model_type,
+        "headers": headers,
+        "probe": probe,
+        "filename": filename,
+        "path": os.path.join(dir_path, filename)
+    }
+
+def fetch_model(prepared, skip_existing=False):
+    """Download a prepared model into the store, or link it when its content is already there."""
+    started = time.time()
+    url = prepared["url"]
+    probe = prepared["probe"]
+    target_path = prepared["path"]
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+    result = {
+        "name": prepared["filename"],
+        "type": prepared["type"],
+        "path": target_path,
+        "url": url,
+        "resumed_bytes": 0,
+        "throughput": 0
+    }
+
+    if skip_existing and os.path.isfile(target_path) and (probe["size"] is None or os.path.getsize(target_path) == probe["size"]):
+        result.update({"status": "skipped", "bytes": os.path.getsize(target_path), "sha256": None})
+    else:
+        sha256 = prepared.get("sha256") or model_store.lookup_url(url, probe["etag"])
+        if model_store.has_blob(sha256):
+            # Same content is already in the store under another name or URL
+            model_store.link_blob(sha256, target_path)
+            result.update({"status": "cached", "bytes": os.path.getsize(target_path), "sha256": sha256.lower()})
+        else:
+            transfer = download_file(
+                url,
+                target_path,
+                headers=prepared["headers"],
+                sha256=prepared.get("sha256"),
+                size=prepared.get("size"),
+                connections=prepared.get("connections"),
+                probe=probe
+            )
+            sha256, deduplicated = model_store.ingest(target_path, transfer["sha256"])
+            model_store.record_url(url, probe["etag"], sha256, transfer["bytes"])
+            result.update({
+                "status": "deduplicated" if deduplicated else "downloaded",
+                "bytes": transfer["bytes"],
+                "sha256": sha256,
+                "resumed_bytes": transfer["resumed_bytes"],
+                "throughput": transfer["throughput"]
+            })
+
+    result["seconds"] = round(time.time() - started, 3)
+    return result
+
+def parse_manifest(file_path):
+    """Parse a manifest of type|url[|filename[|sha256]] lines."""
+    if not os.path.exists(file_path):
+        return []
+
+    entries = []
+    with open(file_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            type_part, url_part = line.split("|", 1) if "|" in line else (line, "")
+            entry = {"line": line, "type": type_part.strip(), "url": url_part.strip()}
+            # URLs may contain "|" themselves, so trailing fields only count as filename[|sha256]
+            # when the filename has a model extension and the sha256 is 64 hex digits
+            for count in (2, 1):
+                parts = [part.strip() for part in url_part.rsplit("|", count)]
+                if len(parts) != count + 1 or "/" in parts[1] or not parts[1].endswith(MODEL_EXTENSIONS):
+                    continue
+                if count == 2 and not re.fullmatch(r"[0-9a-fA-F]{64}", parts[2]):
+                    continue
+                entry.update({"url": parts[0], "filename": parts[1]})
+                if count == 2:
+                    entry["sha256"] = parts[2]
+                break
+            entries.append(entry)
+    return entries
+
+def check_disk_space(prepared_entries):
+    """Reserve space for pending downloads in order and return an error message per entry that does not fit."""
+    free = {}
+    errors = {}
+    for index, prepared in enumerate(prepared_entries):
+        size = prepared["probe"]["size"]
+        if size is None or os.path.isfile(prepared["path"]):
+            continue
+        if model_store.has_blob(prepared.get("sha256")) or model_store.lookup_url(prepared["url"], prepared["probe"]["etag"]):
+            continue
+        dir_path = os.path.dirname(prepared["path"])
+        os.makedirs(dir_path, exist_ok=True)
+        device = os.stat(dir_path).st_dev
+        if device not in free:
+            free[device] = shutil.disk_usage(dir_path).free
+        if size > free[device]:
+            errors[index] = f"Insufficient disk space for {prepared['filename']}: needs {size} bytes, {free[device]} free"
+            continue
+        free[device] -= size
+    return errors
+
+def pending_bytes(prepared_entries):
+    """Return the bytes each device still needs for downloads that are not already on disk or in the store."""
+    needed = {}
+    for prepared in prepared_entries:
+        size = prepared["probe"]["size"]
+        if size is None or os.path.isfile(prepared["path"]):
+            continue
+        if model_store.has_blob(prepared.get("sha256")) or model_store.lookup_url(prepared["url"], prepared["probe"]["etag"]):
+            continue
+        dir_path = os.path.dirname(prepared["path"])
+        os.makedirs(dir_path, exist_ok=True)
+        device = os.stat(dir_path).st_dev
+        needed[device] = needed.get(device, 0) + size
+    return needed
+
+def install_manifest(entries, concurrency=None, skip_existing=True, make_room=None):
+    """Probe, space-check and download manifest entries concurrently, returning one result per entry.
+
+    make_room, when given, is called with the prepared entries that will be fetched before disk space is checked.
+    """
+    concurrency = concurrency or MANIFEST_CONCURRENCY
+    results = [None] * len(entries)
+
+    def prepare(entry):
+        try:
+            return prepare_model(entry)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        prepared_entries = list(pool.map(prepare, entries))
+
+    pending = []
+    for index, prepared in enumerate(prepared_entries):
+        if isinstance(prepared, Exception):
+            results[index] = {"error": str(prepared), "line": entries[index].get("line")}
+        else:
+            pending.append(index)
+
+    # Only the last entry for a target path is fetched, so parallel downloads never write the same file
+    latest = {prepared_entries[index]["path"]: index for index in pending}
+    for index in pending:
+        prepared = prepared_entries[index]
+        if latest[prepared["path"]] != index:
+            results[index] = {"status": "superseded", "name": prepared["filename"], "path": prepared["path"], "line": entries[index].get("line")}
+    pending = [index for index in pending if results[index] is None]
+
+    if make_room is not None:
+        make_room([prepared_entries[index] for index in pending])
+    space_errors = check_disk_space([prepared_entries[index] for index in pending])
+    for position, message in space_errors.items():
+        index = pending[position]
+        results[index] = {"error": message, "line": entries[index].get("line")}
+    pending = [index for position, index in enumerate(pending) if position not in space_errors]
+
+    def fetch(index):
+        try:
+            return fetch_model(prepared_entries[index], skip_existing=skip_existing)
+        except Exception as e:
+            return {"error": str(e), "line": entries[index].get("line")}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index, result in zip(pending, pool.map(fetch, pending)):
+            results[index] = result
+    return results
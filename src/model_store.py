@@ -0,0 +1,125 @@
+import os
+import json
+import errno
+import shutil
+import threading
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from download import sha256_file
+
+# Content-addressed blob store backing the model directories
+STORE_DIR = os.environ.get("MODEL_STORE_DIR", "/stable-diffusion-webui/models/.blobs")
+INDEX_FILE = os.path.join(STORE_DIR, "index.json")
+
+# Query parameters that identify the caller rather than the file
+VOLATILE_PARAMS = {"token", "api_key", "apikey", "access_token"}
+
+store_lock = threading.Lock()
+
+def url_key(url):
+    """Normalize a download URL so that per-user credentials do not change its identity."""
+    parsed = urlparse(url)
+    query = [(k, v) for k, v in parse_qsl(parsed.query) if k.lower() not in VOLATILE_PARAMS]
+    return urlunparse(parsed._replace(query=urlencode(sorted(query)), fragment=""))
+
+def blob_path(sha256):
+    """Return the store path for a blob hash."""
+    return os.path.join(STORE_DIR, sha256[:2], sha256)
+
+def load_index():
+    """Load the URL index of the store."""
+    try:
+        with open(INDEX_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"urls": {}}
+
+def save_index(index):
+    """Persist the URL index of the store."""
+    os.makedirs(STORE_DIR, exist_ok=True)
+    tmp_path = INDEX_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, INDEX_FILE)
+
+def lookup_url(url, etag):
+    """Return the hash of a blob previously downloaded from this URL with the same ETag, or None."""
+    if not etag:
+        return None
+    with store_lock:
+        entry = load_index()["urls"].get(url_key(url))
+    if entry and entry.get("etag") == etag and os.path.exists(blob_path(entry["sha256"])):
+        return entry["sha256"]
+    return None
+
+def record_url(url, etag, sha256, size):
+    """Remember which blob a URL and ETag resolved to."""
+    if not etag:
+        return
+    with store_lock:
+        index = load_index()
+        index["urls"][url_key(url)] = {"etag": etag, "sha256": sha256, "size": size}
+        save_index(index)
+
+def has_blob(sha256):
+    """Check whether a blob is already in the store."""
+    return bool(sha256) and os.path.exists(blob_path(sha256.lower()))
+
+def link_blob(sha256, target_path):
+    """Point a model filename at a stored blob, with a hardlink or a symlink across filesystems."""
+    source = blob_path(sha256.lower())
+    tmp_path = target_path + ".link"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        os.symlink(source, tmp_path)
+    os.replace(tmp_path, target_path)
+
+def ingest(path, sha256=None):
+    """Move a downloaded file into the store and replace it with a link, deduplicating by hash."""
+    sha256 = (sha256 or sha256_file(path)).lower()
+    source = blob_path(sha256)
+    with store_lock:
+        os.makedirs(os.path.dirname(source), exist_ok=True)
+        if os.path.exists(source):
+            if not os.path.samefile(source, path):
+                link_blob(sha256, path)
+            return sha256, True
+        try:
+            os.link(path, source)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            # Renames fail across filesystems too, so move by copying when the store lives elsewhere
+            shutil.move(path, source)
+            os.symlink(source, path)
+    return sha256, False
+
+def prune_blobs(roots):
+    """Delete blobs that no model filename links to any more and return the bytes freed."""
+    freed = 0
+    if not os.path.isdir(STORE_DIR):
+        return freed
+    with store_lock:
+        # Scan links under the lock so a blob ingested mid-prune is seen with its symlink
+        linked = set()
+        for root in roots:
+            if os.path.isdir(root):
+                for name in os.listdir(root):
+                    path = os.path.join(root, name)
+                    if os.path.islink(path):
+                        linked.add(os.path.realpath(path))
+        for prefix in os.listdir(STORE_DIR):
+            prefix_dir = os.path.join(STORE_DIR, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, name)
+                stat = os.stat(path)
+                if stat.st_nlink == 1 and os.path.realpath(path) not in linked:
+                    os.remove(path)
+                    freed += stat.st_size
+    return freed
@@ -0,0 +1,137 @@
+import os
+import io
+import base64
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Output re-encoding and offload settings
+OUTPUT_WORKERS = int(os.environ.get("OUTPUT_WORKERS", "2"))
+OUTPUT_DIR = os.environ.get("OUTPUT_DIR", "/tmp/outputs")
+OUTPUT_SINK = os.environ.get("OUTPUT_SINK", "local")
+
+# Pillow save formats and MIME types for supported output formats
+image_formats = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+}
+
+# Object-store sinks: name -> function(name, data, content_type) returning a reference dict
+output_sinks = {}
+
+output_pool = None
+
+def encode_image(image_b64, image_format, quality, thumbnail):
+    """Re-encode a base64 image and optionally build a thumbnail; runs in the output process pool."""
+    from PIL import Image
+
+    raw = base64.b64decode(image_b64.split(",", 1)[-1])
+    image = Image.open(io.BytesIO(raw))
+    width, height = image.size
+
+    save_format, content_type = image_formats[image_format]
+    if save_format == "PNG" and quality is None:
+        data = raw
+    else:
+        if save_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format=save_format, quality=quality or 90)
+        data = buffer.getvalue()
+
+    thumbnail_data = None
+    if thumbnail:
+        preview = image.copy()
+        preview.thumbnail((thumbnail, thumbnail))
+        if preview.mode not in ("RGB", "L"):
+            preview = preview.convert("RGB")
+        buffer = io.BytesIO()
+        preview.save(buffer, format="JPEG", quality=80)
+        thumbnail_data = buffer.getvalue()
+
+    return {
+        "data": data,
+        "content_type": content_type,
+        "width": width,
+        "height": height,
+        "thumbnail": thumbnail_data
+    }
+
+def local_sink(name, data, content_type):
+    """Write an output to the local output directory."""
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    path = os.path.join(OUTPUT_DIR, name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return {"path": path, "url": f"file://{path}"}
+
+def register_output_sink(name, sink):
+    """Register an object-store sink for offloaded outputs."""
+    output_sinks[name] = sink
+
+register_output_sink("local", local_sink)
+
+def get_output_pool():
+    """Return the process pool used for encoding outputs."""
+    global output_pool
+    if output_pool is None:
+        output_pool = ProcessPoolExecutor(max_workers=OUTPUT_WORKERS)
+    return output_pool
+
+def process_image_list(images, options):
+    """Encode, thumbnail and optionally offload a list of base64 images."""
+    image_format = options.get("format", "png").lower()
+    if image_format not in image_formats:
+        raise ValueError(f"Invalid output format: {image_format}")
+    quality = options.get("quality")
+    thumbnail = options.get("thumbnail")
+    sink_name = options.get("sink", OUTPUT_SINK)
+    if options.get("offload") and sink_name not in output_sinks:
+        raise ValueError(f"Unknown output sink: {sink_name}")
+
+    count = len(images)
+    encoded = get_output_pool().map(
+        encode_image, images, [image_format] * count, [quality] * count, [thumbnail] * count
+    )
+
+    processed = []
+    thumbnails = []
+    extension = "jpg" if image_format == "jpeg" else image_format
+    for item in encoded:
+        if options.get("offload"):
+            name = f"{hashlib.sha256(item['data']).hexdigest()[:32]}.{extension}"
+            reference = output_sinks[sink_name](name, item["data"], item["content_type"])
+            reference.update({
+                "content_type": item["content_type"],
+                "bytes": len(item["data"]),
+                "width": item["width"],
+                "height": item["height"]
+            })
+            processed.append(reference)
+        else:
+            processed.append(base64.b64encode(item["data"]).decode())
+        if item["thumbnail"] is not None:
+            thumbnails.append(base64.b64encode(item["thumbnail"]).decode())
+    return processed, thumbnails
+
+def process_outputs(result, options):
+    """Apply the requested output pipeline to a generation result without modifying it."""
+    if not options:
+        return result
+    output = dict(result)
+    if not options.get("include_info", True):
+        output.pop("parameters", None)
+        output.pop("info", None)
+    if output.get("images"):
+        output["images"], thumbnails = process_image_list(output["images"], options)
+        if thumbnails:
+            output["thumbnails"] = thumbnails
+    if output.get("image"):
+        images, thumbnails = process_image_list([output["image"]], options)
+        output["image"] = images[0]
+        if thumbnails:
+            output["thumbnail"] = thumbnails[0]
+    return output
@@ -0,0 +1,213 @@
+import os
+import json
+import mmap
+import struct
+import hashlib
+
+# Headers larger than this are treated as corrupt rather than parsed
+MAX_HEADER_BYTES = 100 * 1024 * 1024
+
+# Metadata keys worth keeping in the model index; the full metadata is available from inspect()
+METADATA_KEYS = (
+    "ss_base_model_version", "ss_network_module", "ss_network_dim", "ss_network_alpha",
+    "modelspec.architecture", "modelspec.title", "format"
+)
+
+# Text conditioning width of the UNet cross-attention -> architecture
+CONTEXT_DIMS = {768: "sd15", 1024: "sd2", 1280: "sdxl", 2048: "sdxl"}
+
+# Key fragments that only occur in one architecture, checked in order
+CHECKPOINT_MARKERS = [
+    ("double_blocks.", "flux"),
+    ("joint_blocks.", "sd3"),
+    ("conditioner.embedders.", "sdxl"),
+    ("cond_stage_model.model.transformer.", "sd2"),
+    ("cond_stage_model.transformer.", "sd15"),
+]
+LORA_MARKERS = [
+    ("double_blocks", "flux"),
+    ("single_blocks", "flux"),
+    ("single_transformer_blocks", "flux"),
+    ("joint_blocks", "sd3"),
+    ("lora_te1_", "sdxl"),
+    ("lora_te2_", "sdxl"),
+    ("text_encoder_2.", "sdxl"),
+]
+LORA_DOWN_SUFFIXES = ("lora_down.weight", "lora.down.weight", "lora_A.weight", "hada_w1_b", "lokr_w1")
+
+# Metadata prefixes written by common trainers -> architecture
+METADATA_ARCHITECTURES = [
+    ("sdxl", "sdxl"),
+    ("stable-diffusion-xl", "sdxl"),
+    ("sd_v2", "sd2"),
+    ("stable-diffusion-v2", "sd2"),
+    ("sd_v1", "sd15"),
+    ("stable-diffusion-v1", "sd15"),
+    ("stable-diffusion-3", "sd3"),
+    ("flux", "flux"),
+]
+
+# VAE latent layouts -> checkpoint architectures that decode them
+VAE_FAMILIES = {"sd": ("sd15", "sd2", "sdxl"), "flux": ("flux", "sd3")}
+
+DTYPE_BYTES = {"F64": 8, "F32": 4, "F16": 2, "BF16": 2, "F8_E4M3": 1, "F8_E5M2": 1, "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1}
+
+def read_header(path):
+    """Read the JSON header of a safetensors file through mmap without touching the tensor data.
+
+    Returns the tensor table and the __metadata__ dict, raising ValueError when the header is
+    malformed or the file is shorter than the tensors it declares.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 8:
+            raise ValueError(f"File is {size} bytes, too small for a safetensors header")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            length = struct.unpack("<Q", mapped[:8])[0]
+            if length > MAX_HEADER_BYTES or 8 + length > size:
+                raise ValueError(f"Header length {length} does not fit a {size} byte file")
+            try:
+                header = json.loads(mapped[8:8 + length])
+            except ValueError as e:
+                raise ValueError(f"Header is not valid JSON: {str(e)}")
+    if not isinstance(header, dict):
+        raise ValueError("Header is not a JSON object")
+
+    metadata = header.pop("__metadata__", None) or {}
+    if not isinstance(metadata, dict):
+        raise ValueError("__metadata__ is not a JSON object")
+    end = 0
+    for name, tensor in header.items():
+        if not isinstance(tensor, dict):
+            raise ValueError(f"Tensor {name} is not a JSON object")
+        if not isinstance(tensor.get("dtype"), str):
+            raise ValueError(f"Tensor {name} has no dtype")
+        shape = tensor.get("shape")
+        if not isinstance(shape, list) or not all(isinstance(dimension, int) and not isinstance(dimension, bool) and dimension >= 0 for dimension in shape):
+            raise ValueError(f"Tensor {name} has an invalid shape: {shape!r}")
+        offsets = tensor.get("data_offsets")
+        if (not isinstance(offsets, list) or len(offsets) != 2
+                or not all(isinstance(offset, int) and not isinstance(offset, bool) for offset in offsets)
+                or not 0 <= offsets[0] <= offsets[1]):
+            raise ValueError(f"Tensor {name} has invalid data offsets: {offsets!r}")
+        end = max(end, offsets[1])
+    if 8 + length + end > size:
+        raise ValueError(f"File is truncated: tensors need {8 + length + end} bytes, file has {size}")
+    return header, metadata
+
+def find_shape(tensors, match):
+    """Return the shape of the first tensor whose name satisfies match, or None."""
+    for name, tensor in tensors.items():
+        if match(name):
+            return tensor["shape"]
+    return None
+
+def has_fragment(tensors, fragment):
+    """Check whether any tensor name contains a fragment."""
+    return any(fragment in name for name in tensors)
+
+def metadata_architecture(metadata):
+    """Guess the architecture from trainer metadata."""
+    for key in ("modelspec.architecture", "ss_base_model_version"):
+        value = str(metadata.get(key) or "").lower()
+        for prefix, architecture in METADATA_ARCHITECTURES:
+            if value.startswith(prefix):
+                return architecture
+    return None
+
+def model_kind(tensors):
+    """Tell a LoRA, embedding or VAE apart from a full checkpoint by its tensor names."""
+    if any(name.endswith(LORA_DOWN_SUFFIXES) for name in tensors):
+        return "lora"
+    if "emb_params" in tensors or "clip_l" in tensors or "clip_g" in tensors:
+        return "embedding"
+    if not has_fragment(tensors, "diffusion_model") and find_shape(tensors, lambda name: name.endswith("decoder.conv_in.weight")):
+        return "vae"
+    return "checkpoint"
+
+def detect_architecture(kind, tensors, metadata):
+    """Classify a model as sd15, sd2, sdxl, sd3 or flux (sd or flux latents for VAEs), or None when unsure."""
+    if kind == "vae":
+        shape = find_shape(tensors, lambda name: name.endswith("decoder.conv_in.weight"))
+        return {4: "sd", 16: "flux"}.get(shape[1]) if shape and len(shape) > 1 else None
+    if kind == "embedding":
+        if "clip_g" in tensors:
+            return "sdxl"
+        shape = tensors.get("emb_params", {}).get("shape") or tensors.get("clip_l", {}).get("shape")
+        return CONTEXT_DIMS.get(shape[-1]) if shape else None
+
+    markers = LORA_MARKERS if kind == "lora" else CHECKPOINT_MARKERS
+    for fragment, architecture in markers:
+        if has_fragment(tensors, fragment):
+            return architecture
+    # Fall back to the width of the cross-attention key projection
+    if kind == "lora":
+        shape = find_shape(tensors, lambda name: "attn2" in name and "to_k" in name and name.endswith(LORA_DOWN_SUFFIXES[:3]))
+    else:
+        shape = find_shape(tensors, lambda name: name.endswith("attn2.to_k.weight"))
+    if shape and len(shape) > 1 and shape[1] in CONTEXT_DIMS:
+        return CONTEXT_DIMS[shape[1]]
+    return metadata_architecture(metadata)
+
+def lora_rank(tensors):
+    """Return the largest rank among a LoRA's down projections."""
+    ranks = [tensor["shape"][0] for name, tensor in tensors.items() if name.endswith(LORA_DOWN_SUFFIXES[:3]) and tensor["shape"]]
+    return max(ranks) if ranks else None
+
+def summarize_tensors(tensors, metadata):
+    """Build the model index summary of a parsed header."""
+    kind = model_kind(tensors)
+    parameters = {}
+    for tensor in tensors.values():
+        count = 1
+        for dimension in tensor["shape"]:
+            count *= dimension
+        parameters[tensor["dtype"]] = parameters.get(tensor["dtype"], 0) + count
+    summary = {
+        "kind": kind,
+        "architecture": detect_architecture(kind, tensors, metadata),
+        "dtype": max(parameters, key=parameters.get) if parameters else None,
+        "tensors": len(tensors),
+        "parameters": sum(parameters.values()),
+        "metadata": {key: metadata[key] for key in METADATA_KEYS if key in metadata}
+    }
+    if kind == "lora":
+        summary["lora_rank"] = lora_rank(tensors)
+    return summary
+
+def summarize(path):
+    """Summarize a safetensors file for the model index, recording an error instead of raising for corrupt files."""
+    try:
+        tensors, metadata = read_header(path)
+        return summarize_tensors(tensors, metadata)
+    except ValueError as e:
+        return {"error": str(e)}
+    except Exception as e:
+        # One unreadable file must not break the inventory of its whole directory
+        return {"error": f"{type(e).__name__}: {str(e)}"}
+
+def inspect(path):
+    """Return the summary plus every tensor's dtype and shape and the full metadata."""
+    tensors, metadata = read_header(path)
+    summary = summarize_tensors(tensors, metadata)
+    summary["metadata"] = metadata
+    summary["tensor_shapes"] = {name: {"dtype": tensor["dtype"], "shape": tensor["shape"]} for name, tensor in sorted(tensors.items())}
+    return summary
+
+def compatible(checkpoint_architecture, model_type, architecture):
+    """Check whether a LoRA or VAE can be applied to a checkpoint; unknown architectures are assumed compatible."""
+    if not checkpoint_architecture or not architecture:
+        return True
+    if model_type == "vaes":
+        return checkpoint_architecture in VAE_FAMILIES.get(architecture, (architecture,))
+    return architecture == checkpoint_architecture
+
+def addnet_hash(path):
+    """Hash the tensor data after the header, which is how WebUI identifies safetensors LoRAs."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        length = struct.unpack("<Q", f.read(8))[0]
+        f.seek(8 + length)
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -1,26 +1,36 @@
 #!/usr/bin/env bash
 
 echo "Worker Initiated"
+export WORKER_START_TIME="$(date +%s.%N)"
 
 echo "Starting WebUI API"
 TCMALLOC="$(ldconfig -p | grep -Po "libtcmalloc.so.\d" | head -n 1)"
 export LD_PRELOAD="${TCMALLOC}"
 export PYTHONUNBUFFERED=true
-python /stable-diffusion-webui/webui.py \
-  --xformers \
-  --no-half-vae \
-  --skip-python-version-check \
-  --skip-torch-cuda-test \
-  --skip-install \
-  --opt-sdp-attention \
-  --disable-safe-unpickle \
-  --port 3000 \
-  --api \
-  --api-server-stop \
-  --nowebui \
-  --skip-version-check \
-  --no-hashing \
-  --no-download-sd-model &
+# Lets /sdapi/v1/server-restart work: WebUI leaves this file behind and exits, and the loop relaunches it
+export SD_WEBUI_RESTART=tmp/restart
+(
+  while true; do
+    rm -f /stable-diffusion-webui/tmp/restart
+    python /stable-diffusion-webui/webui.py \
+      --xformers \
+      --no-half-vae \
+      --skip-python-version-check \
+      --skip-torch-cuda-test \
+      --skip-install \
+      --opt-sdp-attention \
+      --disable-safe-unpickle \
+      --port 3000 \
+      --api \
+      --api-server-stop \
+      --nowebui \
+      --skip-version-check \
+      --no-hashing \
+      --no-download-sd-model
+    [[ -f /stable-diffusion-webui/tmp/restart ]] || break
+    echo "Restarting WebUI API"
+  done
+) &
 
 echo "Starting RunPod Handler"
 python -u /handler.py
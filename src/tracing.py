@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# Per-job span trees, opt-in for every job with TRACE_JOBS=1 or per job with "trace": true
+TRACE_JOBS = os.environ.get("TRACE_JOBS", "0") == "1"
+TRACE_FILE = os.environ.get("TRACE_FILE", "/tmp/traces/jobs.jsonl")
+TRACE_FILE_MAX_BYTES = int(os.environ.get("TRACE_FILE_MAX_BYTES", str(64 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = int(os.environ.get("TRACE_FILE_BACKUPS", "3"))
+# Finished traces kept in memory for get_traces
+TRACE_RECENT = int(os.environ.get("TRACE_RECENT", "200"))
+# Jobs still running after this many seconds get the whole process stack-sampled until they finish (0 disables)
+TRACE_SLOW_SECONDS = float(os.environ.get("TRACE_SLOW_SECONDS", "30"))
+TRACE_SAMPLE_INTERVAL = float(os.environ.get("TRACE_SAMPLE_INTERVAL", "0.02"))
+TRACE_MAX_STACKS = 100
+
+# The span new spans in the current context attach to
+current_span = contextvars.ContextVar("current_span", default=None)
+
+recent_traces = deque(maxlen=TRACE_RECENT)
+trace_file_lock = threading.Lock()
+
+def new_span(name, attributes):
+    """Create an open span."""
+    return {"name": name, "start": time.perf_counter(), "duration": None, "attributes": attributes, "children": []}
+
+def finish_span(span, origin):
+    """Convert a span tree's clock readings to seconds since the trace started."""
+    span["start"] = round(span["start"] - origin, 6)
+    for child in span["children"]:
+        finish_span(child, origin)
+
+@contextmanager
+def span(name, **attributes):
+    """Time a block as a child of the current span; does nothing outside a traced job."""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = new_span(name, attributes)
+    started = child["start"]
+    parent["children"].append(child)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child["error"] = f"{type(e).__name__}: {str(e)}"
+        raise
+    finally:
+        child["duration"] = round(time.perf_counter() - started, 6)
+        current_span.reset(token)
+
+def annotate(**attributes):
+    """Add attributes to the current span, if any."""
+    current = current_span.get()
+    if current is not None:
+        current["attributes"].update(attributes)
+
+def sample_stacks(stop, samples):
+    """Count folded stacks of every other thread until stopped; runs on the slow job's timer thread."""
+    own = threading.get_ident()
+    while not stop.is_set():
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            leaf = frame
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            stack[0] += f":{leaf.f_lineno}"
+            key = ";".join([names.get(ident, str(ident))] + stack[::-1])
+            samples["stacks"][key] = samples["stacks"].get(key, 0) + 1
+        samples["count"] += 1
+        stop.wait(TRACE_SAMPLE_INTERVAL)
+
+def write_trace(record):
+    """Append a trace to the JSONL file, rotating it to .1 .. .N when it grows past its limit."""
+    line = json.dumps(record, default=str) + "\n"
+    with trace_file_lock:
+        try:
+            os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) + len(line) > TRACE_FILE_MAX_BYTES:
+                for index in range(TRACE_FILE_BACKUPS - 1, 0, -1):
+                    if os.path.exists(f"{TRACE_FILE}.{index}"):
+                        os.replace(f"{TRACE_FILE}.{index}", f"{TRACE_FILE}.{index + 1}")
+                if TRACE_FILE_BACKUPS > 0:
+                    os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+                else:
+                    os.remove(TRACE_FILE)
+            with open(TRACE_FILE, "a") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"Failed to write trace: {str(e)}")
+
+@contextmanager
+def trace(action, job_id=None, enabled=None):
+    """Record a job's span tree when tracing is on, sampling stacks if it runs past TRACE_SLOW_SECONDS."""
+    if not (TRACE_JOBS if enabled is None else enabled):
+        yield None
+        return
+    root = new_span(action, {})
+    record = {"job_id": job_id, "action": action, "at": time.time()}
+    token = current_span.set(root)
+    stop = threading.Event()
+    samples = {"count": 0, "stacks": {}}
+    sampler = None
+    if TRACE_SLOW_SECONDS > 0:
+        sampler = threading.Timer(TRACE_SLOW_SECONDS, sample_stacks, args=(stop, samples))
+        sampler.daemon = True
+        sampler.start()
+    try:
+        yield root
+    except BaseException as e:
+        record["error"] = f"{type(e).__name__}: {str(e)}"
+        raise
+    finally:
+        root["duration"] = round(time.perf_counter() - root["start"], 6)
+        current_span.reset(token)
+        if sampler is not None:
+            sampler.cancel()
+            stop.set()
+            sampler.join(1)
+        finish_span(root, root["start"])
+        record["duration"] = root["duration"]
+        record["spans"] = root
+        if samples["count"]:
+            stacks = sorted(samples["stacks"].items(), key=lambda item: -item[1])[:TRACE_MAX_STACKS]
+            record["stack_samples"] = {
+                "after_seconds": TRACE_SLOW_SECONDS,
+                "interval": TRACE_SAMPLE_INTERVAL,
+                "samples": samples["count"],
+                "stacks": [{"stack": stack, "count": count} for stack, count in stacks]
+            }
+        recent_traces.append(record)
+        write_trace(record)
+
+def get_traces(input_data=None):
+    """Return the slowest recent traced jobs, optionally for one action, without span trees when summary is set."""
+    input_data = input_data or {}
+    limit = int(input_data.get("limit", 10))
+    action = input_data.get("job_action")
+    records = [record for record in list(recent_traces) if not action or record["action"] == action]
+    records.sort(key=lambda record: -record["duration"])
+    if input_data.get("summary"):
+        records = [{key: value for key, value in record.items() if key not in ("spans", "stack_samples")} for record in records]
+    return {
+        "enabled": TRACE_JOBS,
+        "file": TRACE_FILE,
+        "recent": len(recent_traces),
+        "traces": records[:limit]
+    }